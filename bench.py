@@ -0,0 +1,473 @@
+""" Build benchmarks. Run with `python3 bench.py [benchmark ...]` """
+import argparse
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from textwrap import dedent
+import time
+
+import swiki
+import modules.io_utilities as file_io
+
+
+FRAME = dedent("""\
+    <html>
+        <head>
+            <title>{{title}}</title>
+            <meta name="description" content="{{description}}">
+        </head>
+        <body>{{content}}</body>
+    </html>""")
+
+
+def make_test_wiki(root: str, page_count: int, links_per_page: int = 5, seed: int = 0) -> str:
+    """ Write a generated wiki of linked pages and return its input directory """
+    rng = random.Random(seed)
+    input_dir = os.path.join(root, 'input')
+    os.makedirs(os.path.join(input_dir, '_swiki'))
+    with open(os.path.join(input_dir, '_swiki', 'frame.html'), 'w') as f:
+        f.write(FRAME)
+    for i in range(page_count):
+        folder = os.path.join(input_dir, f'folder-{i % 10}')
+        os.makedirs(folder, exist_ok=True)
+        linked = ' '.join(f'{{{{Page {rng.randrange(page_count)}}}}}' for _ in range(links_per_page))
+        with open(os.path.join(folder, f'page-{i}.md'), 'w') as f:
+            f.write(dedent(f"""\
+                ---
+                title: Page {i}
+                description: Description of page {i}.
+                ---
+
+                # Heading
+
+                Some *text* with links: {linked}
+
+                * a list item
+                * another list item
+                """))
+    return input_dir
+
+
+def time_build(input_dir: str, output_dir: str, config: dict) -> float:
+    """ Build the wiki once into a fresh output directory and return seconds taken """
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    start = time.perf_counter()
+    swiki.make_wiki(input_dir, output_dir, config)
+    return time.perf_counter() - start
+
+
+def bench_pipeline(page_count: int, latency: float):
+    """ Compare serial and pipelined I/O against a simulated high-latency filesystem """
+    read_file, write_file = file_io.read_file, file_io.write_file
+
+    def slow_read_file(fp: str, max_size: int = None) -> str or None:
+        time.sleep(latency)
+        return read_file(fp, max_size)
+
+    def slow_write_file(fp: str, content: str):
+        time.sleep(latency)
+        write_file(fp, content)
+
+    with tempfile.TemporaryDirectory() as root:
+        input_dir = make_test_wiki(root, page_count)
+        output_dir = os.path.join(root, 'output')
+        file_io.read_file, file_io.write_file = slow_read_file, slow_write_file
+        try:
+            print(f'pipeline: {page_count} pages, {latency * 1000:.1f}ms simulated latency per file')
+            for jobs in (1, 4, 16):
+                config = {'tab_size': 2, 'recent_list_length': 10, 'jobs': jobs}
+                seconds = time_build(input_dir, output_dir, config)
+                print(f'  jobs={jobs:<3} {seconds:.3f}s')
+        finally:
+            file_io.read_file, file_io.write_file = read_file, write_file
+
+
+def bench_cache(page_count: int):
+    """ Compare a cold build with a rebuild that reuses a warm build cache after one page changed """
+    with tempfile.TemporaryDirectory() as root:
+        input_dir = make_test_wiki(root, page_count)
+        output_dir = os.path.join(root, 'output')
+        os.makedirs(output_dir)
+        config = {'tab_size': 2, 'recent_list_length': 10}
+        cache = swiki.new_build_cache()
+        print(f'cache: {page_count} pages')
+        start = time.perf_counter()
+        swiki.make_wiki(input_dir, output_dir, config, cache)
+        print(f'  cold build        {time.perf_counter() - start:.3f}s')
+        changed_fp = os.path.join(input_dir, 'folder-0', 'page-0.md')
+        with open(changed_fp, 'a') as f:
+            f.write('\nAn edit.\n')
+        start = time.perf_counter()
+        swiki.make_wiki(input_dir, output_dir, config, cache, changed_paths={changed_fp})
+        print(f'  warm rebuild      {time.perf_counter() - start:.3f}s')
+
+
+def run_import_timed(args: list, cwd: str) -> tuple:
+    """ Run swiki.py with -X importtime and return (seconds, {module: cumulative import microseconds}) """
+    swiki_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'swiki.py')
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', swiki_path, *args],
+                            capture_output=True, text=True, check=True, cwd=cwd)
+    seconds = time.perf_counter() - start
+    imports = dict()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, module = line[len('import time:'):].split('|')
+            imports[module.strip()] = int(cumulative)
+    return seconds, imports
+
+
+# Modules only builds that need them should import, as each adds milliseconds to every start
+HEAVY_IMPORTS = ('marko', 'cmarkgfm', 'mistune', 'frontmatter', 'yaml', 'pygments', 'concurrent.futures', 'subprocess',
+                 'sqlite3', 'pickle', 'xml.sax', 'modules.sitemap_utilities', 'modules.publish_utilities')
+
+
+def bench_startup(page_count: int):
+    """ Time process startup for help output and a no-op incremental build, and check heavy imports are deferred """
+    baseline_start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    baseline = time.perf_counter() - baseline_start
+    with tempfile.TemporaryDirectory() as root:
+        input_dir = make_test_wiki(root, page_count)
+        output_dir = os.path.join(root, 'output')
+        run_import_timed([input_dir, output_dir, '--incremental'], root)
+        print(f'startup: {page_count} pages, bare interpreter {baseline:.3f}s')
+        for name, args in (('--help', ['--help']),
+                           ('no-op build', [input_dir, output_dir, '--incremental'])):
+            seconds, imports = run_import_timed(args, root)
+            heavy = [module for module in HEAVY_IMPORTS if module in imports]
+            slowest = sorted(imports.items(), key=lambda item: item[1], reverse=True)[:3]
+            print(f'  {name:<12} {seconds:.3f}s (+{seconds - baseline:.3f}s), '
+                  f'heavy imports: {", ".join(heavy) or "none"}, '
+                  f'slowest: {", ".join(f"{module} {us / 1000:.1f}ms" for module, us in slowest)}')
+
+
+def bench_frontmatter(page_count: int):
+    """ Compare per-page front matter parse cost of python-frontmatter and the flat fast path """
+    import frontmatter
+    import modules.frontmatter_utilities as front_matter
+
+    texts = [dedent(f"""\
+        ---
+        title: Page {i}
+        description: Description of page {i}.
+        ---
+
+        Some *text* with a {{{{Page {i + 1}}}}} link.
+        """) for i in range(page_count)]
+    print(f'frontmatter: {page_count} pages')
+    for name, parse in (('python-frontmatter', frontmatter.parse), ('flat fast path', front_matter.parse)):
+        start = time.perf_counter()
+        for text in texts:
+            parse(text)
+        seconds = time.perf_counter() - start
+        print(f'  {name:<20} {seconds:.3f}s ({seconds / page_count * 1e6:.1f}us per page)')
+
+
+def bench_graph(page_count: int):
+    """ Time graph export for a generated in-memory wiki and report output size """
+    rng = random.Random(0)
+    pages = {f'page-{i}': {'metadata': {'title': f'Page {i}'},
+                           'links': [f'Page {rng.randrange(page_count)}' for _ in range(5)]}
+             for i in range(page_count)}
+    outputs = dict()
+
+    def write_data_output(output_file: str, content: str):
+        outputs[output_file] = content
+
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        swiki.write_graph(pages, root, swiki.DEFAULT_GRAPH_DEPTH, write_data_output)
+        seconds = time.perf_counter() - start
+    local_sizes = [len(content) for output_file, content in outputs.items() if output_file != 'graph.json']
+    print(f'graph: {page_count} pages')
+    print(f'  export            {seconds:.3f}s')
+    print(f'  graph.json        {len(outputs["graph.json"]) / 1024:.0f}KiB')
+    print(f'  local graphs      {sum(local_sizes) / len(local_sizes) / 1024:.1f}KiB average, '
+          f'{max(local_sizes) / 1024:.1f}KiB largest')
+
+
+def bench_large(page_count: int):
+    """ Compare peak memory of building the page graph with large pages read into memory or memory-mapped """
+    import tracemalloc
+
+    with tempfile.TemporaryDirectory() as root:
+        input_dir = make_test_wiki(root, page_count)
+        # A handful of generated pages of about 20MiB each, like logs or data dumps
+        lines = 'A log line with *some* text to pad it out a little further.\n' * 999 + 'A {{Page 0}} link.\n'
+        for i in range(4):
+            with open(os.path.join(input_dir, f'dump-{i}.md'), 'w') as f:
+                f.write(f'---\ntitle: Dump {i}\n---\n\n')
+                f.write(lines * (20 * 1024 * 1024 // len(lines)))
+        page_files, _ = swiki.find_source_files(input_dir)
+        print(f'large: {page_count} pages and 4 pages of 20MiB')
+        for name, large_file_size in (('read into memory', float('inf')),
+                                      ('memory-mapped', swiki.DEFAULT_LARGE_FILE_SIZE)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            swiki.build_page_graph(input_dir, page_files, 8, large_file_size=large_file_size)
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'  {name:<17} {seconds:.3f}s, peak {peak / 1024 / 1024:.1f}MiB')
+
+
+def bench_stream(page_count: int):
+    """ Compare peak memory of writing one large page as a whole string or streamed in chunks """
+    import tracemalloc
+
+    lines = 'A line of *text* with a {{Page 0}} link and an <a href="https://example.com">external link</a>.\n\n'
+    page = {'metadata': {'title': 'Large Page', 'description': '', 'last_modified': time.gmtime()},
+            'content': lines * (page_count * 100), 'links': ['Page 0']}
+    render_cache = swiki.new_render_cache()
+    # Render once up front, since both ways render the same Markdown
+    html_size = len(swiki.render_markdown(page['content'], 'large-page', render_cache))
+    print(f'stream: one page of {len(page["content"]) / 1024 / 1024:.1f}MiB, {html_size / 1024 / 1024:.1f}MiB of HTML')
+    with tempfile.TemporaryDirectory() as root:
+        fp = os.path.join(root, 'large-page.html')
+
+        def write_whole():
+            content = swiki.prepare_page_for_file(dict(page), 'large-page', 2, render_cache)
+            file_io.write_file(fp, swiki.fill_frame(FRAME, content, page['metadata']))
+
+        def write_streamed():
+            chunks = swiki.stream_page_for_file(dict(page), 'large-page', 2, render_cache)
+            file_io.write_chunks(fp, swiki.stream_frame(FRAME, chunks, page['metadata']))
+
+        for name, write in (('whole', write_whole), ('streamed', write_streamed)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            write()
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'  {name:<9} {seconds:.3f}s, peak {peak / 1024 / 1024:.1f}MiB above the rendered HTML')
+
+
+def bench_engines(page_count: int):
+    """ Report pages rendered per second by each installed Markdown engine """
+    import modules.markdown_engines as markdown
+
+    texts = [dedent(f"""\
+        # Page {i}
+
+        Some *text* with **bold**, `code` and a {{{{Page {i + 1}}}}} link.
+
+        * a list item
+        * another list item
+
+        | a | b |
+        | --- | --- |
+        | {i} | {i + 1} |
+
+        ```python
+        print({i})
+        ```
+        """) * 5 for i in range(page_count)]
+    print(f'engines: {page_count} pages')
+    for engine in markdown.ENGINES:
+        if not markdown.is_installed(engine):
+            print(f'  {engine:<9} not installed')
+            continue
+        render = markdown.get_renderer(engine)
+        start = time.perf_counter()
+        for text in texts:
+            render(text)
+        seconds = time.perf_counter() - start
+        print(f'  {engine:<9} {page_count / seconds:.0f} pages/s')
+
+
+def bench_highlight(page_count: int):
+    """ Compare highlighting code blocks with an empty cache and with the cache from the last build """
+    import modules.highlight_utilities as highlighting
+
+    # Code-heavy pages sharing a few snippets, as rendered by the Markdown engine
+    snippets = [f'<pre><code class="language-python">def function_{i}(value):\n    return value * {i}\n</code></pre>'
+                for i in range(20)]
+    pages = [''.join(snippets[(i + j) % len(snippets)] for j in range(5)) for i in range(page_count)]
+    cache = dict()
+    print(f'highlight: {page_count} pages with 5 code blocks each')
+    for name in ('cold cache', 'warm cache'):
+        start = time.perf_counter()
+        for page_html in pages:
+            highlighting.highlight_code_blocks(page_html, 'default', cache)
+        print(f'  {name:<11} {time.perf_counter() - start:.3f}s')
+    start = time.perf_counter()
+    for page_html in pages:
+        highlighting.highlight_code_blocks(page_html, 'default', dict())
+    print(f'  {"no cache":<11} {time.perf_counter() - start:.3f}s')
+
+
+def bench_check(page_count: int):
+    """ Compare finding conflicts with swiki.py check against parsing every page as a build does """
+    with tempfile.TemporaryDirectory() as root:
+        input_dir = make_test_wiki(root, page_count)
+        page_files, media_files = swiki.find_source_files(input_dir)
+        print(f'check: {page_count} pages')
+        start = time.perf_counter()
+        swiki.check_wiki(input_dir)
+        print(f'  {"check":<11} {time.perf_counter() - start:.3f}s')
+        start = time.perf_counter()
+        swiki.build_page_graph(input_dir, page_files, 8, media_files=media_files)
+        print(f'  {"page graph":<11} {time.perf_counter() - start:.3f}s')
+
+
+def bench_staged(page_count: int):
+    """ Compare incremental rebuilds after one page changed in place and into a staging folder """
+    with tempfile.TemporaryDirectory() as root:
+        input_dir = make_test_wiki(root, page_count)
+        config = {'tab_size': 2, 'recent_list_length': 10, 'incremental': True}
+        changed_fp = os.path.join(input_dir, 'folder-0', 'page-0.md')
+        print(f'staged: {page_count} pages, one changed')
+        for name, build in (('in place', swiki.make_wiki), ('staged', swiki.make_wiki_staged)):
+            output_dir = os.path.join(root, name.replace(' ', '-'))
+            os.makedirs(output_dir)
+            build(input_dir, output_dir, config)
+            with open(changed_fp, 'a') as f:
+                f.write('\nAn edit.\n')
+            start = time.perf_counter()
+            build(input_dir, output_dir, config)
+            print(f'  {name:<11} {time.perf_counter() - start:.3f}s')
+
+
+def bench_batch(page_count: int):
+    """ Compare building ten wikis with one swiki.py process each and with one batch build """
+    import json
+
+    swiki_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'swiki.py')
+    with tempfile.TemporaryDirectory() as root:
+        wikis = []
+        for i in range(10):
+            # Wikis of different sizes, like a handful of big team wikis and many small ones
+            input_dir = make_test_wiki(os.path.join(root, f'wiki-{i}'), max(1, page_count * (i + 1) // 55), seed=i)
+            wikis.append({'input': input_dir, 'output': os.path.join(root, f'wiki-{i}', 'output')})
+        manifest_fp = os.path.join(root, 'wikis.json')
+        with open(manifest_fp, 'w') as f:
+            json.dump(wikis, f)
+        print(f'batch: 10 wikis, {page_count} pages in all')
+        start = time.perf_counter()
+        for wiki in wikis:
+            subprocess.run([sys.executable, swiki_path, wiki['input'], wiki['output']], check=True, cwd=root)
+        print(f'  {"processes":<11} {time.perf_counter() - start:.3f}s')
+        for workers in (1, 4):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, swiki_path, 'batch', manifest_fp, '-d', '-w', str(workers)],
+                           check=True, cwd=root)
+            print(f'  {f"batch -w {workers}":<11} {time.perf_counter() - start:.3f}s')
+
+
+def run_peak_rss(args: list, cwd: str) -> tuple:
+    """ Run swiki.py and return (seconds, peak resident memory in MiB) """
+    swiki_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'swiki.py')
+    # Linux keeps the peak of the process a child was started from, so swiki.py is started from a small
+    # interpreter rather than from this one, which may have grown from earlier benchmarks
+    code = dedent(f"""\
+        import resource, subprocess, sys, time
+        start = time.perf_counter()
+        subprocess.run({[sys.executable, swiki_path, *args]!r}, check=True)
+        # Kilobytes on Linux
+        print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)""")
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=cwd)
+    seconds, peak = result.stdout.split()[-2:]
+    return float(seconds), int(peak) / 1024
+
+
+def bench_memory(page_count: int):
+    """ Compare time and peak memory of a build with and without a memory budget for the page graph,
+    with the budget a quarter of the page graph's estimated size so page records are kept on disk """
+    with tempfile.TemporaryDirectory() as root:
+        input_dir = make_test_wiki(root, page_count)
+        page_files, _ = swiki.find_source_files(input_dir)
+        estimate = swiki.page_graph_memory(input_dir, page_files) / 1024 / 1024
+        budget = max(1, int(estimate / 4))
+        print(f'memory: {page_count} pages, page graph estimated at {estimate:.1f}MiB')
+        for name, args in (('no budget', []), (f'--max-memory {budget}', ['--max-memory', str(budget)])):
+            # A fresh output folder each, as state left by a previous build is loaded too
+            output_dir = os.path.join(root, f'output-{len(args)}')
+            log_fp = os.path.join(root, 'build.log')
+            if os.path.exists(log_fp):
+                os.remove(log_fp)
+            # -v logs how many page records were written to disk to build.log
+            seconds, peak = run_peak_rss([input_dir, output_dir, '-v', *args], root)
+            with open(log_fp, 'r') as f:
+                spilled = re.search(r'Page records written to disk: (\d+)', f.read())
+            if args and not spilled:
+                raise RuntimeError(f'The page graph stayed in memory with {name}, use more pages')
+            print(f'  {name:<16} {seconds:.3f}s, peak RSS {peak:.0f}MiB, '
+                  f'page records written to disk: {spilled.group(1) if spilled else 0}')
+
+
+def bench_layout(page_count: int):
+    """ Compare build time, the largest output folder and the time to list and stat every output file
+    (as rsync does) for each output layout """
+    with tempfile.TemporaryDirectory() as root:
+        input_dir = make_test_wiki(root, page_count)
+        print(f'layout: {page_count} pages')
+        for layout in swiki.OUTPUT_LAYOUTS:
+            output_dir = os.path.join(root, layout)
+            os.makedirs(output_dir)
+            start = time.perf_counter()
+            swiki.make_wiki(input_dir, output_dir, {'tab_size': 2, 'recent_list_length': 10, 'output_layout': layout})
+            build_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            largest = 0
+            for subfolder, _, files in os.walk(output_dir):
+                largest = max(largest, len(files))
+                for file in files:
+                    os.stat(os.path.join(subfolder, file))
+            print(f'  {layout:<8} build {build_seconds:.3f}s, largest folder {largest} files, '
+                  f'walk {time.perf_counter() - start:.3f}s')
+
+
+def bench_events(page_count: int):
+    """ Compare build time without and with the event log, written from its own thread """
+    with tempfile.TemporaryDirectory() as root:
+        input_dir = make_test_wiki(root, page_count)
+        events_fp = os.path.join(root, 'events.jsonl')
+        print(f'events: {page_count} pages')
+        for label, event_log in [('off', ''), ('on', events_fp)]:
+            output_dir = os.path.join(root, f'output-{label}')
+            os.makedirs(output_dir)
+            start = time.perf_counter()
+            swiki.make_wiki(input_dir, output_dir, {'tab_size': 2, 'recent_list_length': 10, 'event_log': event_log})
+            print(f'  {label:<3} {time.perf_counter() - start:.3f}s')
+        print(f'  log {os.path.getsize(events_fp)} bytes')
+
+
+BENCHMARKS = {
+    'pipeline': lambda args: bench_pipeline(args.pages, args.latency),
+    'cache': lambda args: bench_cache(args.pages),
+    'startup': lambda args: bench_startup(args.pages),
+    'frontmatter': lambda args: bench_frontmatter(args.pages),
+    'graph': lambda args: bench_graph(args.pages),
+    'large': lambda args: bench_large(args.pages),
+    'stream': lambda args: bench_stream(args.pages),
+    'engines': lambda args: bench_engines(args.pages),
+    'highlight': lambda args: bench_highlight(args.pages),
+    'check': lambda args: bench_check(args.pages),
+    'staged': lambda args: bench_staged(args.pages),
+    'batch': lambda args: bench_batch(args.pages),
+    'memory': lambda args: bench_memory(args.pages),
+    'layout': lambda args: bench_layout(args.pages),
+    'events': lambda args: bench_events(args.pages),
+}
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Run build benchmarks.')
+    argparser.add_argument('benchmarks', nargs='*', default=list(BENCHMARKS),
+                           help=f'benchmarks to run: {", ".join(BENCHMARKS)}')
+    argparser.add_argument('--pages', '-p', default=500, type=int,
+                           help='number of pages in the generated wiki')
+    argparser.add_argument('--latency', '-l', default=0.005, type=float,
+                           help='simulated latency in seconds per file operation')
+    args = argparser.parse_args()
+
+    for name in args.benchmarks:
+        BENCHMARKS[name](args)
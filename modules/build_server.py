@@ -0,0 +1,58 @@
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+
+
+def default_socket_path() -> str:
+    """ Per-user socket path used when none is given """
+    return os.environ.get('SWIKI_SOCKET') or os.path.join(tempfile.gettempdir(), f'swiki-{os.getuid()}.sock')
+
+
+def send_request(socket_path: str, request: dict) -> dict:
+    """ Send one JSON request to the build server and wait for its JSON response """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode() + b'\n')
+        with client.makefile('rb') as response:
+            return json.loads(response.readline())
+
+
+def serve(socket_path: str, build):
+    """ Answer build requests on a Unix socket until interrupted.
+    build(request) is called for each request, one at a time, and returns a response dict. """
+    logger = logging.getLogger('build_server')
+
+    class BuildRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+                response = build(request)
+            except Exception as e:
+                logger.exception('Build failed')
+                response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+    # Clear out a socket left behind by a server that didn't shut down cleanly
+    if os.path.exists(socket_path):
+        try:
+            send_request(socket_path, {'command': 'ping'})
+        except OSError:
+            os.remove(socket_path)
+        else:
+            raise RuntimeError(f'Build server already running at {socket_path}')
+
+    # Leave through the cleanup below when stopped by a service manager
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with socketserver.UnixStreamServer(socket_path, BuildRequestHandler) as server:
+        logger.warning(f'Build server listening on {socket_path}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+
+
+STATE_FILE = '.swiki-state.json'
+SOURCE_CACHE_FILE = '.swiki-source-cache.pickle'  # Parsed pages, kept between builds that use git
+MANIFEST_FILE = 'manifest.json'
+
+
+def load_state(output_dir: str) -> dict:
+    """ Load state recorded by the last build, or empty state if there is none """
+    try:
+        with open(os.path.join(output_dir, STATE_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_state(output_dir: str, state: dict):
+    """ Record build state in output directory """
+    with open(os.path.join(output_dir, STATE_FILE), 'w') as f:
+        json.dump(state, f, sort_keys=True)
+
+
+def load_source_cache(output_dir: str, pages_dir: str, fingerprint: str) -> dict:
+    """ Parsed pages saved by save_source_cache() as {source path: (signature, page)}, with paths under
+    pages_dir, or an empty cache if there is none or it was saved with another config fingerprint """
+    # Imported here, as only builds using git need it
+    import pickle
+    try:
+        with open(os.path.join(output_dir, SOURCE_CACHE_FILE), 'rb') as f:
+            saved = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return dict()
+    if saved.get('fingerprint') != fingerprint:
+        return dict()
+    return {os.path.join(pages_dir, path): entry for path, entry in saved['pages'].items()}
+
+
+def save_source_cache(output_dir: str, pages_dir: str, fingerprint: str, source_cache: dict):
+    """ Save parsed pages for the next build, by path relative to pages_dir so the input folder can move,
+    as it does between CI runs. Large pages only point to their content on disk, so they aren't kept. """
+    import pickle
+    pages = {os.path.relpath(fp, pages_dir): entry for fp, entry in source_cache.items()
+             if 'content_location' not in entry[1]}
+    fp = os.path.join(output_dir, SOURCE_CACHE_FILE)
+    # Replaced whole, so a staged build's hard link to the previous one isn't written through
+    with open(f'{fp}.tmp', 'wb') as f:
+        pickle.dump({'fingerprint': fingerprint, 'pages': pages}, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(f'{fp}.tmp', fp)
+
+
+def digest(value) -> str:
+    """ Short stable digest of any JSON-serializable value """
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def digest_items(items) -> str:
+    """ Same as digest(list(items)), without holding every item at once """
+    encoder = json.JSONEncoder(sort_keys=True, default=str)
+    sha = hashlib.sha1(b'[')
+    for i, item in enumerate(items):
+        if i:
+            sha.update(b', ')
+        for chunk in encoder.iterencode(item):
+            sha.update(chunk.encode())
+    sha.update(b']')
+    return sha.hexdigest()[:16]
+
+
+def explain_changes(previous: dict or None, current: dict) -> list:
+    """ Describe which recorded dependencies of an output differ from the current ones """
+    if previous is None:
+        return ['no dependencies were recorded for it by the last build']
+    reasons = []
+    for key in sorted(set(previous) | set(current)):
+        old, new = previous.get(key), current.get(key)
+        if old == new:
+            continue
+        if isinstance(old, list) and isinstance(new, list):
+            added = [item for item in new if item not in old]
+            removed = [item for item in old if item not in new]
+            reasons.append(f'{key} changed (added: {", ".join(added) or "none"}; removed: {", ".join(removed) or "none"})')
+        elif key.startswith('config.'):
+            reasons.append(f'{key} changed from {old!r} to {new!r}')
+        else:
+            reasons.append(f'{key} changed')
+    return reasons
+
+
+def changed_keys(previous: dict, current: dict) -> list:
+    """ Names of the recorded dependencies of an output that differ from the current ones """
+    return sorted(key for key in set(previous) | set(current) if previous.get(key) != current.get(key))
+
+
+def input_fingerprint(pages_dir: str, config: dict, ignore_folders: list = ()) -> str:
+    """ Digest of the path, size and mtime of every input file plus the build config,
+    leaving out folders named in ignore_folders as the build does """
+    fingerprint = hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode())
+    for subfolder, dirs, files in os.walk(pages_dir):
+        dirs[:] = sorted(folder for folder in dirs if folder not in ignore_folders)
+        for file in sorted(files):
+            fp = os.path.join(subfolder, file)
+            stat = os.stat(fp)
+            fingerprint.update(f'{os.path.relpath(fp, pages_dir)}\0{stat.st_mtime_ns}\0{stat.st_size}\n'.encode())
+    return fingerprint.hexdigest()
+
+
+def file_sha256(fp: str) -> str:
+    """ SHA-256 of a file's bytes """
+    sha256 = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def write_manifest(output_dir: str, previous_stats: dict) -> dict:
+    """ Write manifest of every output file's path to its SHA-256, only hashing files
+    whose size or mtime differ from previous_stats. Returns the stats to pass next time. """
+    manifest = dict()
+    stats = dict()
+    for subfolder, dirs, files in os.walk(output_dir):
+        dirs.sort()
+        for file in sorted(files):
+            fp = os.path.join(subfolder, file)
+            path = os.path.relpath(fp, output_dir).replace(os.sep, '/')
+            # Skip the manifest itself and build bookkeeping like the state file
+            if path == MANIFEST_FILE or path.startswith('.swiki-'):
+                continue
+            stat = os.stat(fp)
+            previous = previous_stats.get(path)
+            if previous and previous[:2] == [stat.st_mtime_ns, stat.st_size]:
+                manifest[path] = previous[2]
+            else:
+                manifest[path] = file_sha256(fp)
+            stats[path] = [stat.st_mtime_ns, stat.st_size, manifest[path]]
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, sort_keys=True, indent=0)
+    return stats
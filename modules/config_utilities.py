@@ -0,0 +1,71 @@
+import logging
+import os
+
+ENVIRONMENT_PREFIX = 'SWIKI_'  # SWIKI_TAB_SIZE=4 sets tab_size
+TRUE_VALUES = ['true', 'yes', 'on', '1']
+FALSE_VALUES = ['false', 'no', 'off', '0']
+TYPE_NAMES = {bool: 'true or false', int: 'a whole number', str: 'text'}
+
+
+def parse_bool(value: str) -> bool:
+    """ Read true/false, yes/no, on/off or 1/0 in any case """
+    if value.strip().lower() in TRUE_VALUES:
+        return True
+    if value.strip().lower() in FALSE_VALUES:
+        return False
+    raise ValueError(value)
+
+
+def check_value(schema: dict, key: str, value, source: str):
+    """ Value of a setting cast to its type in the schema, raising RuntimeError naming source if it isn't valid """
+    setting = schema[key]
+    kind = setting['type']
+    try:
+        if kind is bool and isinstance(value, str):
+            value = parse_bool(value)
+        elif type(value) is not kind:
+            value = kind(value.strip() if isinstance(value, str) else value)
+    except (TypeError, ValueError):
+        raise RuntimeError(f'''Setting "{key}" in {source} must be {TYPE_NAMES[kind]}, not "{value}".''')
+    if setting.get('choices') and value not in setting['choices']:
+        raise RuntimeError(f'''Setting "{key}" in {source} must be one of {", ".join(setting['choices'])}, not "{value}".''')
+    if setting.get('minimum') is not None and value < setting['minimum']:
+        raise RuntimeError(f'''Setting "{key}" in {source} must be at least {setting['minimum']}, not {value}.''')
+    return value
+
+
+def check_settings(schema: dict, settings: dict, source: str) -> dict:
+    """ Settings with every value cast and checked against the schema. Settings not in the schema are kept
+    as they are, with a warning, as they may be meant for a newer version or be misspelt. """
+    logger = logging.getLogger('check_settings')
+    checked = dict()
+    for key, value in settings.items():
+        if key in schema:
+            checked[key] = check_value(schema, key, value, source)
+        else:
+            logger.warning(f'Unknown setting "{key}" in {source}')
+            checked[key] = value
+    return checked
+
+
+def read_config_file(config_fp: str) -> dict:
+    """ Settings as text from a file of key = value lines. Blank lines and lines starting with # or ; are skipped. """
+    settings = dict()
+    with open(config_fp, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if '=' not in line:
+                raise RuntimeError(f'''Line {line_number} of {config_fp} should be "key = value", not "{line}".''')
+            key, value = line.split('=', 1)
+            settings[key.strip()] = value.strip()
+    return settings
+
+
+def read_environment(schema: dict, environ: dict = None) -> dict:
+    """ Settings as text from environment variables named like SWIKI_TAB_SIZE """
+    environ = os.environ if environ is None else environ
+    return {key: environ[f'{ENVIRONMENT_PREFIX}{key.upper()}'] for key in schema
+            if f'{ENVIRONMENT_PREFIX}{key.upper()}' in environ}
+
@@ -0,0 +1,51 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+
+class EventLog:
+    """ Writes build events to a file as JSON lines from a background thread, so the build only
+    pays for putting each event on a queue. Events waiting together are appended in one write,
+    so builds in other threads or processes can log to the same file without mixing up lines. """
+
+    def __init__(self, fp: str):
+        self.fp = fp
+        self.fd = os.open(fp, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._write_events, name='event-log', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def emit(self, event: str, **fields):
+        """ Queue an event of the given type, stamped with the current Unix time """
+        self.queue.put({'event': event, 'time': round(time.time(), 6), **fields})
+
+    def close(self):
+        """ Write every queued event and close the file """
+        self.queue.put(None)
+        self.thread.join()
+        os.close(self.fd)
+
+    def _write_events(self):
+        logger = logging.getLogger('event_log')
+        closed = False
+        while not closed:
+            events = [self.queue.get()]
+            while not self.queue.empty():
+                events.append(self.queue.get())
+            closed = events[-1] is None
+            data = ''.join(json.dumps(event, separators=(',', ':'), default=str) + '\n'
+                           for event in events if event is not None).encode()
+            try:
+                while data:
+                    data = data[os.write(self.fd, data):]
+            except OSError as e:
+                logger.warning(f'Could not write events to {self.fp}: {e}')
@@ -0,0 +1,117 @@
+from functools import lru_cache
+import re
+
+# Same delimiters python-frontmatter uses for YAML and JSON front matter
+re_yaml_boundary = re.compile(r'^-{3,}\s*$', re.MULTILINE)
+re_json_boundary = re.compile(r'^(?:{|})$', re.MULTILINE)
+re_yaml_boundary_bytes = re.compile(rb'^-{3,}\s*$', re.MULTILINE)
+re_flat_line = re.compile(r'([A-Za-z_][\w-]*)[ \t]*:(?:[ \t]+(.*?))?[ \t]*')
+re_plain_comment = re.compile(r'\s#')
+
+# Plain scalars YAML would resolve to something other than a string
+YAML_KEYWORDS = {'yes', 'no', 'true', 'false', 'on', 'off', 'y', 'n', 'null', '~'}
+PLAIN_UNSAFE_START = set('-?:,[]{}#&*!|>\'"%@`+.~<=0123456789')
+
+HEAD_SIZE = 64 * 1024  # How far into a large file to look for the end of its front matter
+
+
+def parse_flat_scalar(value: str):
+    """ Parse a flat YAML scalar if it is certain to be a string, else return None """
+    if value.startswith("'") and value.endswith("'") and len(value) > 1:
+        inner = value[1:-1]
+        if "'" in inner.replace("''", ''):
+            return None
+        return inner.replace("''", "'")
+    if value.startswith('"') and value.endswith('"') and len(value) > 1:
+        inner = value[1:-1]
+        if '"' in inner or '\\' in inner:
+            return None
+        return inner
+    if value[0] in PLAIN_UNSAFE_START or value.lower() in YAML_KEYWORDS:
+        return None
+    if ': ' in value or value.endswith(':') or re_plain_comment.search(value):
+        return None
+    return value
+
+
+@lru_cache(maxsize=None)
+def non_printable():
+    """ Pattern matching characters YAML doesn't allow, compiled on first use as it is slow to compile """
+    return re.compile('[^\x09\x0A\x0D\x20-\x7E\x85\xA0-\uD7FF\uE000-\uFFFD\U00010000-\U0010FFFF]')
+
+
+def parse_flat_yaml(fm: str) -> dict or None:
+    """ Parse front matter made only of `key: value` lines with string values.
+    Returns None if anything needs a full YAML parser. """
+    # YAML rejects these, so let it raise the error
+    if non_printable().search(fm):
+        return None
+    metadata = dict()
+    for line in fm.splitlines():
+        if not line.strip() or line.startswith('#'):
+            continue
+        match = re_flat_line.fullmatch(line)
+        if not match or match.group(1).lower() in YAML_KEYWORDS:
+            return None
+        key, value = match.groups()
+        if not value or value.startswith('#'):
+            metadata[key] = None
+            continue
+        value = parse_flat_scalar(value)
+        if value is None:
+            return None
+        metadata[key] = value
+    return metadata
+
+
+def load_yaml(fm: str):
+    """ Load YAML with the C loader if PyYAML was built with it """
+    import yaml
+    return yaml.load(fm, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+def parse(text: str) -> tuple:
+    """ Split text into (metadata, content) the way frontmatter.parse does, without
+    loading YAML for the common case of flat string front matter """
+    text = text.replace('\r\n', '\n').strip()
+    # JSON front matter is rare enough to leave to python-frontmatter
+    if re_json_boundary.match(text):
+        import frontmatter
+        return frontmatter.parse(text)
+    if not re_yaml_boundary.match(text):
+        return dict(), text
+    parts = re_yaml_boundary.split(text, 2)
+    if len(parts) != 3:
+        return dict(), text
+    _, fm, content = parts
+
+    metadata = parse_flat_yaml(fm)
+    if metadata is None:
+        metadata = load_yaml(fm)
+        if not isinstance(metadata, dict):
+            metadata = dict()
+    return metadata, content.strip()
+
+
+def parse_head(data: bytes) -> tuple or None:
+    """ Parse front matter at the start of UTF-8 bytes or a memory map without decoding the rest.
+    Returns (metadata, offset where the content starts), or None if that can't be done
+    from the first HEAD_SIZE bytes and the whole text should go through parse() """
+    head = data[:HEAD_SIZE]
+    start = len(head) - len(head.lstrip())
+    if start == len(head) or head[start:start + 1] in (b'{', b'}'):
+        return None
+    opening = re_yaml_boundary_bytes.match(head, start)
+    if not opening:
+        return dict(), start
+    closing = re_yaml_boundary_bytes.search(head, opening.end())
+    if not closing:
+        return None
+
+    fm = head[opening.end():closing.start()].decode().replace('\r\n', '\n')
+    metadata = parse_flat_yaml(fm)
+    if metadata is None:
+        metadata = load_yaml(fm)
+        if not isinstance(metadata, dict):
+            metadata = dict()
+    return metadata, closing.end()
@@ -0,0 +1,63 @@
+def run_git(repo_dir: str, *args) -> str or None:
+    """ Run a git command in repo_dir and return its output, or None if it failed """
+    # Imported here, as it is slow to import and only builds using git need it
+    import subprocess
+    try:
+        result = subprocess.run(['git', '-c', 'core.quotepath=off', '-C', repo_dir, *args],
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout
+
+
+def last_commit_time(repo_dir: str) -> int or None:
+    """ Unix time of the last commit of the git repository holding repo_dir, or None if there isn't one """
+    output = run_git(repo_dir, 'log', '-1', '--format=%ct')
+    return int(output) if output and output.strip() else None
+
+
+def head_commit(repo_dir: str) -> str or None:
+    """ Hash of the commit checked out in the git repository holding repo_dir, or None if there isn't one """
+    output = run_git(repo_dir, 'rev-parse', '--verify', '--quiet', 'HEAD')
+    return output.strip() if output else None
+
+
+def changed_files(repo_dir: str, since_commit: str) -> set or None:
+    """ Paths relative to repo_dir of files under it that differ from since_commit, including
+    uncommitted and untracked files. None if since_commit isn't known, e.g. in a shallow clone. """
+    if not since_commit:
+        return None
+    changed = run_git(repo_dir, 'diff', '--name-only', '--relative', '--no-renames', '-z', since_commit, '--', '.')
+    untracked = run_git(repo_dir, 'ls-files', '--others', '--exclude-standard', '-z', '--', '.')
+    if changed is None or untracked is None:
+        return None
+    return {path for path in (changed + untracked).split('\0') if path}
+
+
+def last_commit_times(repo_dir: str, paths: set) -> dict:
+    """ Unix time of the last commit that changed each of paths (relative to repo_dir), read from
+    a single `git log` that stops as soon as every path was seen. Paths never committed are left out. """
+    remaining = set(paths)
+    times = dict()
+    if not remaining:
+        return times
+    import subprocess
+    try:
+        process = subprocess.Popen(['git', '-c', 'core.quotepath=off', '-C', repo_dir, 'log',
+                                    '--format=%x01%ct', '--name-only', '--relative', '--', '.'],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return times
+    with process:
+        commit_time = None
+        for line in process.stdout:
+            line = line.rstrip('\n')
+            if line.startswith('\x01'):
+                commit_time = int(line[1:])
+            elif line in remaining:
+                times[line] = commit_time
+                remaining.discard(line)
+                if not remaining:
+                    process.kill()
+                    break
+    return times
@@ -0,0 +1,93 @@
+from collections import deque
+import json
+
+MAX_NEIGHBOURHOOD_NODES = 100  # Keep per-page graphs small enough to load instantly
+
+
+def make_adjacency(filenames: list, links: dict) -> list:
+    """ Turn {filename: [linked filenames]} into sorted, de-duplicated lists of integer ids """
+    ids = {filename: i for i, filename in enumerate(filenames)}
+    adjacency = []
+    for filename in filenames:
+        adjacency.append(sorted({ids[link] for link in links.get(filename, []) if link in ids}))
+    return adjacency
+
+
+def delta_encode(sorted_ids: list) -> list:
+    """ Store each id as the difference from the previous one, which keeps JSON short """
+    previous = 0
+    deltas = []
+    for i in sorted_ids:
+        deltas.append(i - previous)
+        previous = i
+    return deltas
+
+
+def delta_decode(deltas: list) -> list:
+    """ Reverse delta_encode """
+    total = 0
+    sorted_ids = []
+    for delta in deltas:
+        total += delta
+        sorted_ids.append(total)
+    return sorted_ids
+
+
+def make_undirected(adjacency: list) -> list:
+    """ Sorted neighbour lists in both directions of every link """
+    neighbours = [set(targets) for targets in adjacency]
+    for source, targets in enumerate(adjacency):
+        for target in targets:
+            neighbours[target].add(source)
+    return [sorted(node_neighbours) for node_neighbours in neighbours]
+
+
+def neighbourhood(neighbours: list, start: int, depth: int, max_nodes: int = MAX_NEIGHBOURHOOD_NODES) -> list:
+    """ Ids within depth hops of start in breadth-first order, capped at max_nodes """
+    order = [start]
+    seen = {start}
+    frontier = [start]
+    for _ in range(depth):
+        next_frontier = []
+        for node in frontier:
+            for neighbour in neighbours[node]:
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    next_frontier.append(neighbour)
+        order.extend(next_frontier)
+        if len(order) >= max_nodes:
+            return order[:max_nodes]
+        frontier = next_frontier
+    return order
+
+
+def graph_json(filenames: list, titles: list, adjacency: list, paths: list = None) -> str:
+    """ Whole-wiki graph: node filenames and titles by id, and delta-encoded outgoing links.
+    Paths of the pages' HTML are included if given, for output layouts that put pages in subfolders. """
+    data = {'filenames': filenames, 'titles': titles}
+    if paths is not None:
+        data['paths'] = paths
+    data['links'] = [delta_encode(targets) for targets in adjacency]
+    return json.dumps(data, separators=(',', ':'))
+
+
+def encode_strings(values: list) -> list:
+    """ JSON-encode each string once, for reuse across many local graphs """
+    return [json.dumps(value) for value in values]
+
+
+def local_graph_json(encoded_filenames: list, encoded_titles: list, adjacency: list, node_ids: list,
+                     encoded_paths: list = None) -> str:
+    """ Graph of only the given nodes, renumbered from 0 in the given order.
+    Filenames, titles and paths come pre-encoded by encode_strings, since joining strings is much faster than json.dumps. """
+    local_ids = {node: i for i, node in enumerate(node_ids)}
+    links = []
+    for i, source in enumerate(node_ids):
+        for target in adjacency[source]:
+            j = local_ids.get(target)
+            if j is not None:
+                links.append(f'[{i},{j}]')
+    paths = f'"paths":[{",".join([encoded_paths[node] for node in node_ids])}],' if encoded_paths is not None else ''
+    return (f'{{"filenames":[{",".join([encoded_filenames[node] for node in node_ids])}],'
+            f'"titles":[{",".join([encoded_titles[node] for node in node_ids])}],'
+            f'{paths}"links":[{",".join(links)}]}}')
@@ -0,0 +1,78 @@
+from functools import lru_cache
+import hashlib
+import html
+import json
+import os
+import re
+
+HIGHLIGHT_CACHE_FILE = '.swiki-highlight-cache.json'
+CSS_FILE = 'highlight.css'
+CSS_CLASS = 'highlight'
+
+# Fenced code blocks with a language, as every Markdown engine renders them
+re_code_block = re.compile(r'<pre><code class="language-([^"\s]+)">(.*?)</code></pre>', re.DOTALL)
+
+
+def load_cache(output_dir: str) -> dict:
+    """ Load highlighted code blocks saved by the last build, or an empty cache if there are none """
+    try:
+        with open(os.path.join(output_dir, HIGHLIGHT_CACHE_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_cache(output_dir: str, cache: dict):
+    """ Save highlighted code blocks for the next build """
+    with open(os.path.join(output_dir, HIGHLIGHT_CACHE_FILE), 'w') as f:
+        json.dump(cache, f, sort_keys=True)
+
+
+@lru_cache(maxsize=None)
+def get_lexer(language: str):
+    """ Pygments lexer for a language name or alias, or None if Pygments doesn't know it """
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+    try:
+        return get_lexer_by_name(language)
+    except ClassNotFound:
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_formatter(style: str):
+    """ Pygments HTML formatter marking up tokens with the classes of a style's CSS """
+    from pygments.formatters import HtmlFormatter
+    from pygments.util import ClassNotFound
+    try:
+        return HtmlFormatter(style=style, cssclass=CSS_CLASS)
+    except ClassNotFound:
+        raise RuntimeError(f'''Unknown highlight style "{style}".''')
+
+
+def stylesheet(style: str) -> str:
+    """ CSS for highlighted code blocks """
+    return get_formatter(style).get_style_defs(f'.{CSS_CLASS}')
+
+
+def highlight_code_blocks(page_html: str, style: str, cache: dict, used_keys: set = None) -> str:
+    """ Highlight fenced code blocks in rendered HTML. Blocks are looked up in cache by language,
+    code and style first, so a snippet repeated across pages and builds is only highlighted once.
+    Keys of blocks found are added to used_keys, if given. """
+    def highlight_block(match: re.Match) -> str:
+        language, code = match.groups()
+        key = hashlib.sha1(f'{language}\0{style}\0{code}'.encode()).hexdigest()
+        if used_keys is not None:
+            used_keys.add(key)
+        if key not in cache:
+            lexer = get_lexer(language)
+            if lexer is None:
+                cache[key] = match.group()
+            else:
+                from pygments import highlight
+                cache[key] = highlight(html.unescape(code), lexer, get_formatter(style))
+        return cache[key]
+
+    if '<pre><code class="language-' not in page_html:
+        return page_html
+    return re_code_block.sub(highlight_block, page_html)
@@ -0,0 +1,124 @@
+from collections import deque
+import os
+import shutil
+import threading
+
+
+PREFETCH_FACTOR = 4  # How many files per worker may be read ahead or queued for writing
+
+
+def read_file(fp: str, max_size: int = None) -> str or None:
+    """ Read whole text file. Files larger than max_size, if given, are not read and give None """
+    with open(fp, 'r') as f:
+        if max_size is not None and os.fstat(f.fileno()).st_size > max_size:
+            return None
+        return f.read()
+
+
+def open_new(fp: str):
+    """ Open text file for writing as a new file, so other hard links to an existing one keep its contents """
+    try:
+        os.remove(fp)
+    except FileNotFoundError:
+        pass
+    return open(fp, 'w')
+
+
+def write_file(fp: str, content: str):
+    """ Write text file, replacing any existing file """
+    with open_new(fp) as f:
+        f.write(content)
+
+
+def write_chunks(fp: str, chunks):
+    """ Write text file from an iterable of strings, replacing any existing file """
+    with open_new(fp) as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def copy_file(source_fp: str, fp: str):
+    """ Copy file with its modification time, unless fp already has the same size and modification time """
+    source = os.stat(source_fp)
+    try:
+        existing = os.stat(fp)
+        if (existing.st_size, existing.st_mtime_ns) == (source.st_size, source.st_mtime_ns):
+            return
+        os.remove(fp)
+    except FileNotFoundError:
+        pass
+    shutil.copy2(source_fp, fp)
+
+
+def read_head(fp: str, size: int) -> bytes:
+    """ Read up to the first size bytes of a file """
+    with open(fp, 'rb') as f:
+        return f.read(size)
+
+
+def prefetch(read, file_paths: list, jobs: int, *args):
+    """ Yield (fp, read(fp, *args)) in order while a thread pool reads ahead a bounded number of files """
+    # Imported here, as concurrent.futures is slow to import and a build with nothing changed never reads a file
+    from concurrent.futures import ThreadPoolExecutor
+    window = max(1, jobs) * PREFETCH_FACTOR
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        pending = deque()
+        for fp in file_paths:
+            pending.append((fp, pool.submit(read, fp, *args)))
+            if len(pending) >= window:
+                next_fp, future = pending.popleft()
+                yield next_fp, future.result()
+        while pending:
+            next_fp, future = pending.popleft()
+            yield next_fp, future.result()
+
+
+def prefetch_files(file_paths: list, jobs: int, max_size: int = None):
+    """ Yield (fp, contents) in order while a thread pool reads ahead a bounded number of files.
+    Contents are None for files larger than max_size, if given. """
+    return prefetch(read_file, file_paths, jobs, max_size)
+
+
+def prefetch_heads(file_paths: list, jobs: int, size: int):
+    """ Yield (fp, first size bytes) in order while a thread pool reads ahead a bounded number of files """
+    return prefetch(read_head, file_paths, jobs, size)
+
+
+class BoundedWriter:
+    """ Thread pool for output I/O that blocks the producer once too many jobs are queued """
+
+    def __init__(self, jobs: int):
+        self.jobs = max(1, jobs)
+        self.slots = threading.BoundedSemaphore(self.jobs * PREFETCH_FACTOR)
+        self.pool = None
+        self.errors = []
+
+    def __enter__(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(max_workers=self.jobs)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.pool.shutdown(wait=True)
+        if exc_type is None and self.errors:
+            raise self.errors[0]
+
+    def _done(self, future):
+        if future.exception():
+            self.errors.append(future.exception())
+        self.slots.release()
+
+    def submit(self, func, *args):
+        """ Queue func(*args), waiting for a free slot if the queue is full """
+        if self.errors:
+            raise self.errors[0]
+        self.slots.acquire()
+        self.pool.submit(func, *args).add_done_callback(self._done)
+
+    def write(self, fp: str, content: str):
+        """ Queue a text file write """
+        self.submit(write_file, fp, content)
+
+    def write_chunks(self, fp: str, chunks):
+        """ Queue a text file write from an iterable of strings, which is consumed in the pool """
+        self.submit(write_chunks, fp, chunks)
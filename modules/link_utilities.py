@@ -1,26 +1,104 @@
+import html
 import re
 
 re_wikilink = re.compile(r'{{.+?}}')
+re_wikilink_bytes = re.compile(rb'{{.+?}}')
+re_transclusion = re.compile(r'{{!(.+?)}}')
 re_external_link = re.compile(r'<a href=".+?"')
 re_special_characters = re.compile(r'[/()\'\".!?,]')
+# Start of a relative URL in an href or src attribute: no scheme, and not from the site root, a fragment or a query
+re_relative_url = re.compile(r'((?:href|src)=")(?![a-zA-Z][a-zA-Z0-9+.-]*:|[/#?"])')
+re_sentence_end = re.compile(r'[.!?](?=\s)|\n')
+re_line_marker = re.compile(r'^(?:[#>*+-]+|\d+\.)\s+')  # Heading, quote or list item marker
+re_emphasis = re.compile(r'[*`~]+|(?<!\w)_+|_+(?!\w)')
+re_markdown_link = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+re_html_tag = re.compile(r'<[^>]+>')
+# File names in Markdown links and images, HTML attributes and CSS url()s, without any query or fragment
+re_file_reference = re.compile(r'(\]\(\s*<?|(?:href|src)=["\']?|url\(\s*["\']?)([^\s"\'<>()#?]+)')
+
+MAX_FILENAME_LENGTH = 200  # Titles are cut to this many characters for filenames
+MAX_BACKLINK_CONTEXTS = 3  # Mentions shown under each backlink, as a page may link to another many times
+BYTES_PER_CHARACTER = 4  # Most bytes a character takes in UTF-8
 
 
 def kebabify(text: str) -> str:
     """ Format text to filename kebab-case """
-    text = text[:200]  # Enforce max length of 200 chars
+    text = text[:MAX_FILENAME_LENGTH]
     text = re_special_characters.sub('', text)
     return text.replace(' ', '-').lower()
 
 
-def get_local(content: str) -> list:
-    """ Get list of all local link filenames """
+def flat_page_path(filename: str) -> str:
+    """ Path of a page's HTML in the output folder, when pages aren't put in subfolders """
+    return f'{filename}.html'
+
+
+def plain_text(markdown: str) -> str:
+    """ Text of a piece of Markdown on one line, with links replaced by their text and
+    emphasis, HTML tags and any heading, quote or list marker at the start removed """
+    text = re_wikilink.sub(lambda match: match.group()[2:-2].split('|')[0].lstrip('!').strip(), markdown)
+    text = re_html_tag.sub('', re_markdown_link.sub(r'\1', text))
+    return re_emphasis.sub('', re_line_marker.sub('', ' '.join(text.split())))
+
+
+def link_context(text: str, start: int, end: int, context_length: int) -> str:
+    """ Plain text of the sentence around the link at text[start:end], cut to context_length
+    characters either side of it """
+    window_start = max(0, start - context_length)
+    before = text[window_start:start]
+    if boundaries := list(re_sentence_end.finditer(before)):
+        before = before[boundaries[-1].end():]
+    elif window_start > 0:
+        before = '…' + before[before.find(' ') + 1:]  # Whole words only
+    after = text[end:end + context_length]
+    if boundary := re_sentence_end.search(after):
+        after = after[:boundary.end()]
+    elif end + context_length < len(text):
+        after = after.rsplit(' ', 1)[0] + '…'
+    return plain_text(before + text[start:end] + after)
+
+
+def get_local(content: str, contexts: list = None, context_length: int = 0) -> list:
+    """ Get list of all local link filenames. If contexts is given, the text around each link,
+    from link_context(), is added to it in the same order. """
     local_links = list()
     for match in re_wikilink.finditer(content):
         match_text = match.group()[2:-2]  # remove curly braces
+        if match_text.startswith('!'):  # transclusion, not a link
+            continue
         local_links.append(match_text.rsplit('|')[-1].strip())  # filename if filename else text
+        if contexts is not None:
+            contexts.append(link_context(content, match.start(), match.end(), context_length))
     return local_links
 
 
+def get_local_from_bytes(data: bytes, start: int = 0, contexts: list = None, context_length: int = 0) -> tuple:
+    """ Get list of all local link filenames from UTF-8 bytes or a memory map, decoding only
+    the links themselves, and the text around them if contexts is given as for get_local().
+    Also returns whether any page is transcluded. """
+    local_links = list()
+    has_transclusions = False
+    for match in re_wikilink_bytes.finditer(data, start):
+        match_text = match.group()[2:-2].decode()  # remove curly braces
+        if match_text.startswith('!'):  # transclusion, not a link
+            has_transclusions = True
+            continue
+        local_links.append(match_text.rsplit('|')[-1].strip())  # filename if filename else text
+        if contexts is not None:
+            # Decode enough bytes either side for context_length characters, dropping any cut through
+            window = context_length * BYTES_PER_CHARACTER
+            before = data[max(start, match.start() - window):match.start()].decode(errors='ignore')
+            after = data[match.end():match.end() + window].decode(errors='ignore')
+            text = before + match.group().decode() + after
+            contexts.append(link_context(text, len(before), len(text) - len(after), context_length))
+    return local_links, has_transclusions
+
+
+def get_transclusions(content: str) -> list:
+    """ Get list of titles of all pages transcluded with {{!...}} """
+    return [match.group(1).strip() for match in re_transclusion.finditer(content)]
+
+
 def add_external(html: str) -> str:
     """ Modify all anchor tags for external links """
     def add_target_blank(match: re.Match):
@@ -29,29 +107,59 @@ def add_external(html: str) -> str:
     return re_external_link.sub(add_target_blank, html)
 
 
-def add_local(html: str) -> str:
-    """ Replace all {{...|?...}} with anchor tags """
+def add_root(html: str, root: str) -> str:
+    """ Prefix relative URLs in href and src attributes with root, the way back up to the output folder
+    from a page in a subfolder, so they point where they would from the output folder """
+    if not root:
+        return html
+    return re_relative_url.sub(lambda match: match.group(1) + root, html)
+
+
+def get_file_references(text: str) -> set:
+    """ Get set of every file name or URL that Markdown, HTML or CSS refers to """
+    return {match.group(2) for match in re_file_reference.finditer(text)}
+
+
+def rename_files(text: str, names: dict) -> str:
+    """ Replace references to files in Markdown, HTML or CSS with their names in names, if in it """
+    if not names:
+        return text
+    return re_file_reference.sub(lambda match: match.group(1) + names.get(match.group(2), match.group(2)), text)
+
+
+def add_local(html: str, page_path=None) -> str:
+    """ Replace all {{...|?...}} with anchor tags, linking to page_path(filename) in the output folder """
+    page_path = page_path or flat_page_path
+
     def make_link(match: re.Match):
         match_text = match.group()[2:-2].split('|')
         text = filename = match_text[0].strip()
         if len(match_text) == 2:
             filename = match_text[1].strip()
         filename = kebabify(filename)
-        return f'<a href="{filename}.html">{text}</a>'
+        return f'<a href="{page_path(filename)}">{text}</a>'
     return re_wikilink.sub(make_link, html)
 
 
-def add_backlinks(content: str, backlinks: list) -> str:
-    """ Add backlinks section to content """
+def add_backlinks(content: str, backlinks: list, page_path=None) -> str:
+    """ Add backlinks section to content, with the text around each link under it if recorded """
     if not backlinks:
         return content
+    page_path = page_path or flat_page_path
     backlinks_html = '<section id="backlinks"><details><summary>Backlinks</summary><ul>'
-    seen_backlinks = set()
+    seen_backlinks = dict()  # title -> (filename, contexts)
     backlinks = sorted(backlinks, key=lambda backlink: str.lower(backlink.get('title')))
     for backlink in backlinks:
-        title, filename = backlink.get('title'), backlink.get('filename')
+        title, filename, context = backlink.get('title'), backlink.get('filename'), backlink.get('context')
         if title not in seen_backlinks:
-            seen_backlinks.add(title)
-            backlinks_html += f'<li><a href="{filename}.html">{title}</a></li>'
+            seen_backlinks[title] = (filename, [])
+        contexts = seen_backlinks[title][1]
+        if context and context not in contexts and len(contexts) < MAX_BACKLINK_CONTEXTS:
+            contexts.append(context)
+    for title, (filename, contexts) in seen_backlinks.items():
+        backlinks_html += f'<li><a href="{page_path(filename)}">{title}</a>'
+        for context in contexts:
+            backlinks_html += f'<p class="backlink-context">{html.escape(context)}</p>'
+        backlinks_html += '</li>'
     backlinks_html += '</ul></details></section>'
     return content + backlinks_html
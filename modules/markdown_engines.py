@@ -0,0 +1,64 @@
+from importlib.util import find_spec
+import logging
+import threading
+
+DEFAULT_ENGINE = 'marko'
+
+# GitHub Flavored Markdown extensions of cmark-gfm that marko's gfm extension also has
+CMARK_EXTENSIONS = ['table', 'autolink', 'strikethrough', 'tasklist']
+
+
+def make_marko():
+    from marko import Markdown
+    return Markdown(extensions=['gfm']).convert
+
+
+def make_cmarkgfm():
+    import cmarkgfm
+    from cmarkgfm.cmark import Options
+
+    def convert(text: str) -> str:
+        # Pages may contain raw HTML, which cmark drops unless it is told it's safe
+        return cmarkgfm.markdown_to_html_with_extensions(text, options=Options.CMARK_OPT_UNSAFE,
+                                                        extensions=CMARK_EXTENSIONS)
+    return convert
+
+
+def make_mistune():
+    import mistune
+    return mistune.create_markdown(escape=False, plugins=['strikethrough', 'table', 'url', 'task_lists'])
+
+
+# Engine name -> (module it needs, function making a Markdown to HTML function)
+ENGINES = {
+    'marko': ('marko', make_marko),
+    'cmarkgfm': ('cmarkgfm', make_cmarkgfm),  # C, much faster
+    'mistune': ('mistune', make_mistune),  # Pure Python, faster than marko
+}
+
+renderers = threading.local()  # Renderers keep state while converting, so each thread has its own
+
+
+def is_installed(engine: str) -> bool:
+    """ Whether the module an engine needs can be imported """
+    return find_spec(ENGINES[engine][0]) is not None
+
+
+def resolve_engine(engine: str) -> str:
+    """ Name of the engine to use for the configured one, falling back to the default if it isn't installed """
+    logger = logging.getLogger('resolve_engine')
+    if engine not in ENGINES:
+        raise RuntimeError(f'''Unknown Markdown engine "{engine}". Choose from: {", ".join(ENGINES)}.''')
+    if engine != DEFAULT_ENGINE and not is_installed(engine):
+        logger.warning(f'Markdown engine "{engine}" is not installed, using "{DEFAULT_ENGINE}"')
+        return DEFAULT_ENGINE
+    return engine
+
+
+def get_renderer(engine: str = DEFAULT_ENGINE):
+    """ Get this thread's Markdown to HTML function of an engine, importing and creating it on first use """
+    renderer = getattr(renderers, engine, None)
+    if renderer is None:
+        renderer = ENGINES[engine][1]()
+        setattr(renderers, engine, renderer)
+    return renderer
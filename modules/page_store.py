@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import pickle
+import sqlite3
+
+MIN_CACHED_RECORDS = 64  # Enough that a page being changed is never written out halfway through
+INITIAL_RECORD_SIZE = 4096  # Guess at the bytes a page record takes in memory, until some are measured
+MEMORY_PER_PICKLED_BYTE = 12  # Rough size of a record in memory for each byte of it pickled
+
+
+class PageStore(MutableMapping):
+    """ Dict of page records that keeps the most recently used in memory up to max_bytes and the rest
+    in a temporary SQLite database on disk, which is deleted when it is closed. Records are written out when they leave memory, so a record changed
+    in place must be changed right after getting it, or stored again with store[filename] = record.
+    Keeps the order filenames were first added in, like a dict. """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.record_size = INITIAL_RECORD_SIZE
+        self.filenames = dict()  # Every filename, in the order added
+        self.cached = OrderedDict()  # filename -> record, least recently used first
+        self.spilled = 0
+        # An empty name makes a private database in a temporary file
+        self.db = sqlite3.connect('')
+        # It is thrown away after the build, so it needn't survive a crash
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE pages (filename TEXT PRIMARY KEY, record BLOB)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Close and delete the database """
+        self.db.close()
+
+    def _evict(self):
+        capacity = max(MIN_CACHED_RECORDS, int(self.max_bytes // self.record_size))
+        while len(self.cached) > capacity:
+            filename, record = self.cached.popitem(last=False)
+            data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+            # Moving average, so capacity follows the size of records as they grow with backlinks
+            self.record_size += (len(data) * MEMORY_PER_PICKLED_BYTE - self.record_size) / 64
+            self.db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?)', (filename, data))
+            self.spilled += 1
+
+    def __getitem__(self, filename: str):
+        if filename in self.cached:
+            self.cached.move_to_end(filename)
+            return self.cached[filename]
+        if filename not in self.filenames:
+            raise KeyError(filename)
+        data, = self.db.execute('SELECT record FROM pages WHERE filename = ?', (filename,)).fetchone()
+        record = pickle.loads(data)
+        self.cached[filename] = record
+        self._evict()
+        return record
+
+    def __setitem__(self, filename: str, record):
+        self.filenames[filename] = None
+        self.cached[filename] = record
+        self.cached.move_to_end(filename)
+        self._evict()
+
+    def __delitem__(self, filename: str):
+        del self.filenames[filename]
+        self.cached.pop(filename, None)
+        self.db.execute('DELETE FROM pages WHERE filename = ?', (filename,))
+
+    def __contains__(self, filename) -> bool:
+        return filename in self.filenames
+
+    def __iter__(self):
+        # Copy, as reading records may write others out
+        return iter(list(self.filenames))
+
+    def __len__(self) -> int:
+        return len(self.filenames)
@@ -0,0 +1,133 @@
+import json
+import re
+
+SCRIPT_FILE = 'preview.js'
+FOLDER_NAME = 'preview'  # Holds <filename>.json for each page
+EXCERPT_LENGTH = 300  # Most characters of a page's first paragraph kept in its preview
+HEAD_SIZE = 16 * 1024  # Bytes read from the start of a large page to find its first paragraph
+
+re_paragraph_break = re.compile(r'\n\s*\n')
+# Blocks that aren't prose: headings, code fences, tables, HTML, rules and embedded pages
+re_not_prose = re.compile(r'#|```|~~~|\||<|(?:[-*_]\s*){3,}$|{{!')
+
+# Shows a page's preview when hovering a link to it, and hints the browser to fetch the page.
+# Previews are found next to this script, by the filename at the end of the link.
+SCRIPT = '''(function () {
+  var root = new URL('.', document.currentScript.src);
+  var previews = new Map();
+  var prefetched = new Set();
+  var box = document.createElement('div');
+  var style = document.createElement('style');
+  var timer;
+  box.id = 'link-preview';
+  box.setAttribute('role', 'tooltip');
+  box.hidden = true;
+  document.body.appendChild(box);
+  // First in the head, so the site's own CSS overrides it
+  style.textContent = '#link-preview{position:absolute;z-index:10;max-width:24em;padding:.5em .75em;' +
+    'background:#fff;color:#222;border:1px solid #ccc;border-radius:4px;box-shadow:0 2px 8px rgba(0,0,0,.15)}' +
+    '#link-preview p{margin:.25em 0 0}';
+  document.head.insertBefore(style, document.head.firstChild);
+
+  function previewUrl(link) {
+    var url = new URL(link.getAttribute('href'), location.href);
+    if (link.target === '_blank' || url.origin !== location.origin || !url.pathname.endsWith('.html')) {
+      return null;
+    }
+    var name = decodeURIComponent(url.pathname.split('/').pop().slice(0, -5));
+    return name === 'index' ? null : new URL('preview/' + encodeURIComponent(name) + '.json', root);
+  }
+
+  function prefetch(href) {
+    if (prefetched.has(href)) {
+      return;
+    }
+    prefetched.add(href);
+    var hint = document.createElement('link');
+    hint.rel = 'prefetch';
+    hint.href = href;
+    document.head.appendChild(hint);
+  }
+
+  function paragraph(text) {
+    var p = document.createElement('p');
+    p.textContent = text;
+    return p;
+  }
+
+  function show(link, url) {
+    prefetch(link.href);
+    if (!previews.has(url.href)) {
+      previews.set(url.href, fetch(url).then(function (response) {
+        return response.ok ? response.json() : null;
+      }).catch(function () {
+        return null;
+      }));
+    }
+    previews.get(url.href).then(function (preview) {
+      if (!preview || !link.matches(':hover')) {
+        return;
+      }
+      var title = document.createElement('strong');
+      title.textContent = preview.title;
+      box.replaceChildren(title);
+      [preview.description, preview.excerpt].forEach(function (text) {
+        if (text) {
+          box.appendChild(paragraph(text));
+        }
+      });
+      var rect = link.getBoundingClientRect();
+      box.style.left = rect.left + window.scrollX + 'px';
+      box.style.top = rect.bottom + window.scrollY + 4 + 'px';
+      box.hidden = false;
+    });
+  }
+
+  document.addEventListener('mouseover', function (event) {
+    var link = event.target.closest && event.target.closest('a[href]');
+    var url = link && previewUrl(link);
+    if (url) {
+      clearTimeout(timer);
+      timer = setTimeout(function () { show(link, url); }, 100);
+    }
+  });
+  document.addEventListener('mouseout', function (event) {
+    var link = event.target.closest && event.target.closest('a[href]');
+    if (link && !link.contains(event.relatedTarget)) {
+      clearTimeout(timer);
+      box.hidden = true;
+    }
+  });
+})();
+'''
+
+
+def first_paragraph(markdown: str) -> str:
+    """ Markdown of the first block of prose in a page, skipping headings, code, tables and the like """
+    for block in re_paragraph_break.split(markdown):
+        block = block.strip()
+        if block and not re_not_prose.match(block):
+            return block
+    return ''
+
+
+def shorten(text: str, length: int = EXCERPT_LENGTH) -> str:
+    """ Cut text to at most length characters, at the end of a word """
+    if len(text) <= length:
+        return text
+    return text[:length].rsplit(' ', 1)[0] + '…'
+
+
+def preview_json(title: str, description: str, excerpt: str) -> str:
+    """ Compact JSON of a page's preview """
+    data = {'title': title, 'description': description, 'excerpt': shorten(excerpt)}
+    return json.dumps(data, separators=(',', ':'))
+
+
+def add_script(frame: str) -> str:
+    """ Load the preview script in a frame, at the end of its head if it has one """
+    tag = f'<script src="{SCRIPT_FILE}" defer></script>'
+    for closing_tag in ('</head>', '</body>'):
+        if closing_tag in frame:
+            return frame.replace(closing_tag, tag + closing_tag, 1)
+    return frame + tag
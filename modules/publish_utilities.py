@@ -0,0 +1,66 @@
+import os
+import secrets
+import shutil
+
+STAGING_MARKER = '.swiki-'  # Staging folders are hidden siblings of the output folder named with this
+
+
+def staging_prefix(output_dir: str) -> str:
+    """ Path prefix of staging folders for an output folder """
+    parent, name = os.path.split(os.path.abspath(output_dir))
+    return os.path.join(parent, f'.{name}{STAGING_MARKER}')
+
+
+def link_tree(source_dir: str, dest_dir: str, copied_files: set):
+    """ Hard link every file in source_dir into dest_dir, copying files that can't be linked
+    and those in copied_files (paths relative to source_dir), which are written in place """
+    for subfolder, dirs, files in os.walk(source_dir):
+        rel_path = os.path.relpath(subfolder, source_dir)
+        dest_subfolder = os.path.normpath(os.path.join(dest_dir, rel_path))
+        for folder in dirs:
+            os.mkdir(os.path.join(dest_subfolder, folder))
+        for file in files:
+            fp = os.path.join(subfolder, file)
+            dest_fp = os.path.join(dest_subfolder, file)
+            if os.path.normpath(os.path.join(rel_path, file)) in copied_files:
+                shutil.copy2(fp, dest_fp)
+                continue
+            try:
+                os.link(fp, dest_fp)
+            except OSError:
+                shutil.copy2(fp, dest_fp)
+
+
+def stage(output_dir: str, copied_files: set) -> str:
+    """ Make a staging folder next to output_dir holding hard links to its current files, and return its path """
+    staging_dir = staging_prefix(output_dir) + secrets.token_hex(4)
+    os.mkdir(staging_dir)
+    if os.path.isdir(output_dir):
+        link_tree(output_dir, staging_dir, copied_files)
+    return staging_dir
+
+
+def discard(staging_dir: str):
+    """ Delete a staging folder after a failed build """
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def swap(staging_dir: str, output_dir: str):
+    """ Put a staging folder in place of output_dir. If output_dir is a symlink, it is pointed at the
+    staging folder in one atomic rename. A folder is renamed out of the way first, so there is a moment
+    without one. The old build is deleted if it was a staging folder or the replaced folder. """
+    if os.path.islink(output_dir):
+        previous_dir = os.path.join(os.path.dirname(output_dir), os.readlink(output_dir))
+        link = f'{staging_dir}.link'
+        os.symlink(os.path.basename(staging_dir), link)
+        os.replace(link, output_dir)
+        # Only delete builds this made, never a folder the link was set up to point to
+        if os.path.abspath(previous_dir).startswith(staging_prefix(output_dir)):
+            shutil.rmtree(previous_dir, ignore_errors=True)
+    elif os.path.isdir(output_dir):
+        previous_dir = f'{staging_dir}.old'
+        os.rename(output_dir, previous_dir)
+        os.rename(staging_dir, output_dir)
+        shutil.rmtree(previous_dir, ignore_errors=True)
+    else:
+        os.rename(staging_dir, output_dir)
@@ -0,0 +1,70 @@
+import html
+import re
+import time
+from urllib.parse import quote
+
+# Limits of a single sitemap file from sitemaps.org
+SITEMAP_URL_LIMIT = 50000
+SITEMAP_SIZE_LIMIT = 50 * 1024 * 1024
+UNKNOWN_TIME = time.gmtime(0)  # Last modified time of pages that don't exist yet
+
+re_sitemap_part = re.compile(r'sitemap-\d+\.xml')  # Files make_sitemaps() splits big sitemaps into
+
+SITEMAP_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+SITEMAP_FOOTER = '</urlset>\n'
+SITEMAP_INDEX_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+SITEMAP_INDEX_FOOTER = '</sitemapindex>\n'
+
+
+def page_url(site_url: str, path: str) -> str:
+    """ Absolute URL of an output file """
+    return f'{site_url.rstrip("/")}/{quote(path)}'
+
+
+def format_lastmod(last_modified: time.struct_time or None) -> str:
+    """ W3C datetime for <lastmod>, or empty if the time isn't known """
+    if last_modified is None or last_modified == UNKNOWN_TIME:
+        return ''
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', last_modified)
+
+
+def url_entry(tag: str, url: str, lastmod: str) -> str:
+    """ One <url> or <sitemap> element, with the URL escaped as sitemaps.org asks, quotes included """
+    lastmod_element = f'<lastmod>{lastmod}</lastmod>' if lastmod else ''
+    return f'<{tag}><loc>{html.escape(url)}</loc>{lastmod_element}</{tag}>\n'
+
+
+def make_sitemaps(site_url: str, entries: list) -> dict:
+    """ Sitemap files for (output path, last modified) entries, as {output file: XML}.
+    Past the limits of one sitemap, they are split into sitemap-1.xml, sitemap-2.xml...
+    with sitemap.xml as the index of them. """
+    chunks = []
+    chunk, chunk_size = [], len(SITEMAP_HEADER) + len(SITEMAP_FOOTER)
+    for path, last_modified in entries:
+        lastmod = format_lastmod(last_modified)
+        entry = url_entry('url', page_url(site_url, path), lastmod)
+        entry_size = len(entry.encode())
+        if chunk and (len(chunk) >= SITEMAP_URL_LIMIT or chunk_size + entry_size > SITEMAP_SIZE_LIMIT):
+            chunks.append(chunk)
+            chunk, chunk_size = [], len(SITEMAP_HEADER) + len(SITEMAP_FOOTER)
+        chunk.append((entry, lastmod))
+        chunk_size += entry_size
+    chunks.append(chunk)
+
+    if len(chunks) == 1:
+        return {'sitemap.xml': SITEMAP_HEADER + ''.join(entry for entry, _ in chunk) + SITEMAP_FOOTER}
+    sitemaps = dict()
+    index_entries = []
+    for i, chunk in enumerate(chunks, 1):
+        sitemap_file = f'sitemap-{i}.xml'
+        sitemaps[sitemap_file] = SITEMAP_HEADER + ''.join(entry for entry, _ in chunk) + SITEMAP_FOOTER
+        # W3C datetimes in UTC sort in time order
+        index_entries.append(url_entry('sitemap', page_url(site_url, sitemap_file),
+                                       max(lastmod for _, lastmod in chunk)))
+    sitemaps['sitemap.xml'] = SITEMAP_INDEX_HEADER + ''.join(index_entries) + SITEMAP_INDEX_FOOTER
+    return sitemaps
+
+
+def robots_txt(site_url: str) -> str:
+    """ robots.txt allowing everything and pointing crawlers to the sitemap """
+    return f'User-agent: *\nAllow: /\n\nSitemap: {page_url(site_url, "sitemap.xml")}\n'
@@ -1,25 +1,80 @@
 import argparse
+import functools
+import hashlib
+import json
 import logging
+import mmap
 import os
 import re
-import shutil
 import sys
 from textwrap import dedent
+import threading
 import time
 
-from marko import Markdown
-import frontmatter
-
+import modules.build_state as build_state
+import modules.config_utilities as config_utils
+import modules.event_log as event_log
+import modules.frontmatter_utilities as front_matter
+import modules.git_utilities as git
+import modules.graph_utilities as graph
+import modules.highlight_utilities as highlighting
+import modules.io_utilities as file_io
 import modules.link_utilities as links
+import modules.markdown_engines as markdown
+import modules.preview_utilities as previews
 
 
 IGNORE = ['.DS_Store']
+IGNORE_FOLDERS = ['.git']
 RESERVED = ['index']
+# Files the build generates in the output folder, which media files can't be named
+DATA_OUTPUTS = ['sitemap.xml', 'graph.json', build_state.MANIFEST_FILE, previews.SCRIPT_FILE]
 
 DATE_FORMAT = '%Y%m%d%H%M'
 STUBS_FOLDER_NAME = 'Wiki Stubs'
-
-marko = Markdown(extensions=['gfm'])
+DEFAULT_JOBS = 8  # Threads used for reading and writing files
+DEFAULT_BATCH_WORKERS = 1  # Wikis built at once in batch builds. Rendering holds the GIL, so more help slow disks
+DEFAULT_TRANSCLUSION_DEPTH = 10
+DEFAULT_GRAPH_DEPTH = 2  # Hops around each page included in its local graph
+DEFAULT_LARGE_FILE_SIZE = 4 * 1024 * 1024  # Pages bigger than this in bytes are memory-mapped, not kept in memory
+STREAM_CHUNK_SIZE = 1024 * 1024  # Rough size in characters of each piece of a large page written at a time
+PAGE_RECORD_MEMORY = 2048  # Rough bytes a parsed page takes in memory besides its content
+GRAPH_FOLDER_NAME = 'graph'
+# Where page HTML goes in the output folder: all in it, in folders named by a hash, or in folders like the input's
+OUTPUT_LAYOUTS = ['flat', 'hashed', 'folders']
+HASHED_FOLDER_LENGTH = 2  # Hex digits naming each folder of the hashed layout, so pages are spread over 256
+ASSET_HASH_LENGTH = 10  # Hex digits of a file's SHA-256 put in its name with hashed_assets
+# Config values that change rendered pages and the sitemap
+PAGE_CONFIG_KEYS = ['tab_size', 'markdown_engine', 'highlight_style', 'output_layout']
+INDEX_CONFIG_KEYS = ['recent_list_length', 'markdown_engine', 'highlight_style', 'output_layout']
+# Settings from config.ini, SWIKI_* environment variables and the command line. 'output' marks those that
+# change what is built, which make up the config fingerprint.
+CONFIG_SCHEMA = {
+    'tab_size': {'type': int, 'default': 2, 'output': True, 'minimum': 0},
+    'recent_list': {'type': bool, 'default': False, 'output': True},
+    'recent_list_length': {'type': int, 'default': 10, 'output': True, 'minimum': 0},
+    'jobs': {'type': int, 'default': DEFAULT_JOBS, 'minimum': 1},
+    'incremental': {'type': bool, 'default': False},
+    'transclusion_depth': {'type': int, 'default': DEFAULT_TRANSCLUSION_DEPTH, 'output': True, 'minimum': 0},
+    'graph': {'type': bool, 'default': False, 'output': True},
+    'graph_depth': {'type': int, 'default': DEFAULT_GRAPH_DEPTH, 'output': True, 'minimum': 0},
+    'large_file_size': {'type': int, 'default': DEFAULT_LARGE_FILE_SIZE, 'minimum': 0},
+    'reproducible': {'type': bool, 'default': False, 'output': True},
+    'source_date_epoch': {'type': int, 'default': 0, 'output': True, 'minimum': 0},
+    'git': {'type': bool, 'default': False, 'output': True},
+    'site_url': {'type': str, 'default': '', 'output': True},
+    'sitemap_stubs': {'type': bool, 'default': True, 'output': True},
+    'markdown_engine': {'type': str, 'default': markdown.DEFAULT_ENGINE, 'output': True,
+                        'choices': list(markdown.ENGINES)},
+    'highlight_style': {'type': str, 'default': '', 'output': True},
+    'max_memory': {'type': int, 'default': 0, 'minimum': 0},
+    'output_layout': {'type': str, 'default': 'flat', 'output': True, 'choices': OUTPUT_LAYOUTS},
+    'backlink_context': {'type': int, 'default': 0, 'output': True, 'minimum': 0},
+    'previews': {'type': bool, 'default': False, 'output': True},
+    'event_log': {'type': str, 'default': ''},
+    'hashed_assets': {'type': bool, 'default': False, 'output': True},
+    'page_ids': {'type': bool, 'default': False, 'output': True},
+}
 
 
 #############
@@ -28,62 +83,259 @@ marko = Markdown(extensions=['gfm'])
 
 
 def update_config(internal_config: dict, external_config_fp: str):
-    """ Update default config with any user values """
+    """ Update config with the values in a config file, checked against CONFIG_SCHEMA.
+    Raises RuntimeError on a value of the wrong type, and keeps unknown keys as text with a warning. """
     logger = logging.getLogger('update_config')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          internal_config: {internal_config}\n\
-          external_config_fp: {external_config_fp}'))
-
-    with open(external_config_fp, 'r') as f:
-        config_file = f.read()
-    for line in config_file.split('\n'):
-        if line == '':
-            continue
-        key, value = line.split('=', 1)
-        key, value = key.strip(), value.strip()
-        # Cast the config value to the type that's in the default
-        internal_config[key] = type(internal_config.get(key, 'string'))(value)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              internal_config: {internal_config}\n\
+              external_config_fp: {external_config_fp}'))
+
+    settings = config_utils.read_config_file(external_config_fp)
+    internal_config.update(config_utils.check_settings(CONFIG_SCHEMA, settings, external_config_fp))
+
+
+def load_config(pages_dir: str, settings: dict, overrides: dict = None) -> dict:
+    """ Config for building a wiki, from lowest to highest precedence: defaults, settings, the wiki's
+    config file, SWIKI_* environment variables, then overrides such as flags given on the command line.
+    Raises RuntimeError if any value doesn't fit CONFIG_SCHEMA. """
+    config = {key: setting['default'] for key, setting in CONFIG_SCHEMA.items()}
+    config.update(config_utils.check_settings(CONFIG_SCHEMA, settings, 'settings'))
+
+    config_fp = os.path.join(pages_dir, '_swiki', 'config.ini')
+    if os.path.isfile(config_fp):
+        update_config(config, config_fp)
+    for key, value in config_utils.read_environment(CONFIG_SCHEMA).items():
+        config.update(config_utils.check_settings(CONFIG_SCHEMA, {key: value},
+                                                  f'{config_utils.ENVIRONMENT_PREFIX}{key.upper()}'))
+    config.update(config_utils.check_settings(CONFIG_SCHEMA, overrides or dict(), 'command line flags'))
+    if config['reproducible'] and not config['source_date_epoch']:
+        # Resolve the epoch once so it is part of the fingerprint and the same for the whole build
+        config['source_date_epoch'] = source_date_epoch(pages_dir) or 0
+    return config
+
+
+def output_config(config: dict) -> dict:
+    """ Only the settings in CONFIG_SCHEMA that change what is built """
+    return {key: config.get(key, setting['default']) for key, setting in CONFIG_SCHEMA.items() if setting.get('output')}
+
+
+def config_fingerprint(config: dict) -> str:
+    """ Digest of every setting that changes what is built, so outputs and caches
+    from a build with a different one are known to be out of date """
+    return build_state.digest(output_config(config))
+
+
+def incremental_fingerprint(pages_dir: str, output_dir: str, config: dict) -> tuple:
+    """ Fingerprint of the input and config for incremental builds, and whether the last build
+    had the same one with nothing changed since, so this build can be skipped """
+    previous_state = build_state.load_state(output_dir)
+    if config['git']:
+        # Nothing changed if the last build was of a clean checkout and git has no changes since
+        fingerprint = config_fingerprint(config)
+        unchanged = previous_state.get('git_clean') and \
+            git.changed_files(pages_dir, previous_state.get('git_commit')) == set()
+    else:
+        fingerprint = build_state.input_fingerprint(pages_dir, output_config(config), IGNORE_FOLDERS)
+        unchanged = True
+    return fingerprint, bool(unchanged) and previous_state.get('input_fingerprint') == fingerprint
+
+
+def record_fingerprint(output_dir: str, fingerprint: str):
+    """ Record input fingerprint of a finished build for the next incremental build """
+    state = build_state.load_state(output_dir)
+    state['input_fingerprint'] = fingerprint
+    build_state.save_state(output_dir, state)
+
+
+def new_render_cache(shared_html: dict = None) -> dict:
+    """ Make empty cache of rendered Markdown. HTML is kept by engine and text, so pages
+    with the same text share it, and shared_html can be given to share it between wikis. """
+    return {
+        'pages': dict(),  # page filename -> key of its last render
+        'html': shared_html if shared_html is not None else dict(),  # render key -> rendered HTML
+        'hits': 0,  # Renders reused, counted for the event log
+    }
+
+
+def new_build_cache(shared: dict = None) -> dict:
+    """ Make empty cache for state kept between builds of the same wiki. Rendered Markdown and highlighted
+    code can be shared between the caches of several wikis through shared, from new_shared_cache(). """
+    return {
+        'sources': dict(),  # source path -> ((stat signature, backlink context length), parsed page)
+        'renders': new_render_cache(shared['renders'] if shared is not None else None),
+        'outputs': dict(),  # output file -> digest of last written content
+        'highlights': shared['highlights'] if shared is not None else dict(),  # code block key -> highlighted HTML
+        'shared': shared is not None,  # Shared renders and highlights are kept, as other wikis may use them
+    }
+
+
+def new_shared_cache() -> dict:
+    """ Make empty cache of rendered Markdown and highlighted code for several wikis built in one process """
+    return {
+        'renders': dict(),  # render key -> rendered HTML
+        'highlights': dict(),  # code block key -> highlighted HTML
+    }
+
+
+def source_signature(fp: str) -> tuple:
+    """ Cheap signature that changes when a file is edited """
+    stat = os.stat(fp)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def source_date_epoch(pages_dir: str) -> int or None:
+    """ Time reproducible builds treat as now: SOURCE_DATE_EPOCH if set, else the time of the last git commit """
+    if os.environ.get('SOURCE_DATE_EPOCH'):
+        return int(os.environ['SOURCE_DATE_EPOCH'])
+    return git.last_commit_time(pages_dir)
 
 
-def delete_current_html(directory: str):
-    """ Delete all existing HTML files in directory """
+def git_history(pages_dir: str, page_files: list) -> dict:
+    """ Checked out commit of the git repository holding pages_dir, whether any file in pages_dir
+    has uncommitted changes, and the last commit time of each committed page by source path """
+    commit = git.head_commit(pages_dir)
+    if commit is None:
+        raise RuntimeError(f'''Input folder "{pages_dir}" is not in a git repository with any commits.''')
+    uncommitted = git.changed_files(pages_dir, commit) or set()
+    paths = {os.path.join(rel_path, file) for rel_path, file in [*page_files, ('_swiki', 'index.md')]}
+    times = git.last_commit_times(pages_dir, paths - uncommitted)
+    return {'commit': commit,
+            'clean': not uncommitted,
+            'timestamps': {os.path.join(pages_dir, path): commit_time for path, commit_time in times.items()}}
+
+
+def git_changed_paths(pages_dir: str, state: dict) -> set or None:
+    """ Source paths of files in pages_dir git shows changed since the last build, including untracked files.
+    None if that isn't known: the last build had uncommitted changes, or its commit is missing as in a shallow clone. """
+    if not state.get('git_clean'):
+        return None
+    changed = git.changed_files(pages_dir, state.get('git_commit'))
+    return {os.path.join(pages_dir, path) for path in changed} if changed is not None else None
+
+
+def build_epoch(pages_dir: str, build_config: dict) -> int:
+    """ Time a reproducible build of pages_dir treats as now """
+    epoch = build_config.get('source_date_epoch') or source_date_epoch(pages_dir)
+    if epoch is None:
+        raise RuntimeError('Reproducible builds need SOURCE_DATE_EPOCH to be set or the input folder to be in a git repository.')
+    return epoch
+
+
+def delete_current_html(directory: str, layout: str = 'flat'):
+    """ Delete all existing HTML files in directory, and in its subfolders if the output layout puts pages there.
+    Also delete the parts of a split sitemap, which are generated alongside them. """
     logger = logging.getLogger('delete_current_html')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          directory: {directory}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              directory: {directory}\n\
+              layout: {layout}'))
 
-    for file in os.listdir(directory):
-        if os.path.splitext(file)[1] == '.html':
-            os.remove(os.path.join(directory, file))
+    import modules.sitemap_utilities as sitemaps
+    for subfolder, _, files in os.walk(directory):
+        for file in files:
+            if os.path.splitext(file)[1] == '.html' or (subfolder == directory and sitemaps.re_sitemap_part.fullmatch(file)):
+                os.remove(os.path.join(subfolder, file))
+        if layout == 'flat':
+            break
 
 
-def copy_css_file(pages_dir: str, output_dir: str):
-    """ If CSS files in _swiki directory, copy to output """
+def copy_css_file(pages_dir: str, output_dir: str, highlight_style: str = None, stylesheets: dict = None):
+    """ If CSS files in _swiki directory, copy to output. With a highlight style,
+    also write the CSS for highlighted code unless _swiki has its own.
+    With stylesheets from hash_assets(), write those under their hashed names instead. """
     logger = logging.getLogger('copy_css_file')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          pages_dir: {pages_dir}\n\
-          output_dir: {output_dir}'))
-
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              pages_dir: {pages_dir}\n\
+              output_dir: {output_dir}\n\
+              highlight_style: {highlight_style}'))
+
+    if stylesheets is not None:
+        for file, css in stylesheets.items():
+            # A file with a hashed name always holds the same CSS, so one already there is up to date
+            if not os.path.isfile(os.path.join(output_dir, file)):
+                file_io.write_file(os.path.join(output_dir, file), css)
+        return
     swiki_folder = os.path.join(pages_dir, '_swiki')
+    if highlight_style and not os.path.isfile(os.path.join(swiki_folder, highlighting.CSS_FILE)):
+        file_io.write_file(os.path.join(output_dir, highlighting.CSS_FILE), highlighting.stylesheet(highlight_style))
     if not os.path.isdir(swiki_folder):
         return
     for file in os.listdir(swiki_folder):
         if os.path.splitext(file)[1] == '.css':
-            shutil.copy2(os.path.join(swiki_folder, file), os.path.join(output_dir, file))
+            file_io.copy_file(os.path.join(swiki_folder, file), os.path.join(output_dir, file))
 
 
-def copy_media(current_folder: str, media_file: str, output_dir: str):
-    """ If non-Markdown file exists in folder, copy to output """
+def copy_media(current_folder: str, media_file: str, output_dir: str, output_name: str = None):
+    """ If non-Markdown file exists in folder, copy to output (as output_name if given)
+    unless an unchanged copy is already there """
     logger = logging.getLogger('copy_media')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          current_folder: {current_folder}\n\
-          media_file: {media_file}\n\
-          output_dir: {output_dir}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              current_folder: {current_folder}\n\
+              media_file: {media_file}\n\
+              output_dir: {output_dir}'))
+
+    file_io.copy_file(os.path.join(current_folder, media_file),
+                      os.path.join(output_dir, output_name or os.path.basename(media_file)))
+
 
-    shutil.copy2(os.path.join(current_folder, media_file), output_dir)
+def read_css_files(pages_dir: str, highlight_style: str = None) -> dict:
+    """ CSS that copy_css_file() writes, as {file: CSS} """
+    swiki_folder = os.path.join(pages_dir, '_swiki')
+    stylesheets = dict()
+    if highlight_style and not os.path.isfile(os.path.join(swiki_folder, highlighting.CSS_FILE)):
+        stylesheets[highlighting.CSS_FILE] = highlighting.stylesheet(highlight_style)
+    if os.path.isdir(swiki_folder):
+        for file in sorted(os.listdir(swiki_folder)):
+            if os.path.splitext(file)[1] == '.css':
+                stylesheets[file] = file_io.read_file(os.path.join(swiki_folder, file))
+    return stylesheets
+
+
+def hashed_asset_name(file: str, sha256: str) -> str:
+    """ Name of a file with the start of the SHA-256 of its content, like main.1a2b3c4d5e.css """
+    stem, extension = os.path.splitext(file)
+    return f'{stem}.{sha256[:ASSET_HASH_LENGTH]}{extension}'
+
+
+def hash_assets(pages_dir: str, media_files: list, highlight_style: str, previous_stats: dict) -> tuple:
+    """ Content-hashed names of media and CSS files as {file: hashed name}, the CSS to write under its
+    hashed names with the media it refers to renamed, and the stats of media to pass next time:
+    {path: [mtime_ns, size, sha256]}. Only media whose size or mtime differ from previous_stats is read. """
+    logger = logging.getLogger('hash_assets')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              pages_dir: {pages_dir}\n\
+              media_files: {media_files}\n\
+              highlight_style: {highlight_style}'))
+
+    names = dict()
+    stats = dict()
+    for subfolder, file in media_files:
+        fp = os.path.join(subfolder, file)
+        path = os.path.relpath(fp, pages_dir)
+        stat = os.stat(fp)
+        previous = previous_stats.get(path)
+        if previous and previous[:2] == [stat.st_mtime_ns, stat.st_size]:
+            sha256 = previous[2]
+        else:
+            sha256 = build_state.file_sha256(fp)
+        stats[path] = [stat.st_mtime_ns, stat.st_size, sha256]
+        names[os.path.basename(file)] = hashed_asset_name(os.path.basename(file), sha256)
+    stylesheets = dict()
+    # Named after media, so CSS is renamed when an image it uses changes
+    for file, css in read_css_files(pages_dir, highlight_style).items():
+        css = links.rename_files(css, names)
+        names[file] = hashed_asset_name(file, hashlib.sha256(css.encode()).hexdigest())
+        stylesheets[names[file]] = css
+    return names, stylesheets, stats
 
 
 ################
@@ -94,11 +346,12 @@ def copy_media(current_folder: str, media_file: str, output_dir: str):
 def place_in_container(element: str, html_id: str or None, content: str) -> str:
     """ Place content in container with ID """
     logger = logging.getLogger('place_in_container')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          element: {element}\n\
-          html_id: {html_id}\n\
-          content: {content}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              element: {element}\n\
+              html_id: {html_id}\n\
+              content: {content}'))
 
     id_attr = f' id="{html_id}"' if html_id else ''
     return f'<{element}{id_attr}>{content}</{element}>'
@@ -106,45 +359,101 @@ def place_in_container(element: str, html_id: str or None, content: str) -> str:
 
 def add_last_modified(content: str, last_modified: time) -> str:
     logger = logging.getLogger('add_last_modified')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          content: {content}\n\
-          last_modified: {last_modified}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              content: {content}\n\
+              last_modified: {last_modified}'))
 
     if last_modified == time.gmtime(0):
         return content
     return f'{content}\n<p class="last-modified">Last modified: {time.strftime(DATE_FORMAT, last_modified)}</p>'
 
 
-def make_page_dict(root: str, rel_path: str, file: str) -> dict:
-    """ Make dict of all page specific data """
+def make_page_dict(root: str, rel_path: str, file: str, file_contents: str = None, context_length: int = 0) -> dict:
+    """ Make dict of all page specific data. If context_length is set, the text around each link,
+    up to that many characters either side, is kept for the backlinks of the page linked to. """
     logger = logging.getLogger('make_page_dict')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          root: {root}\n\
-          rel_path: {rel_path}\n\
-          file: {file}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              root: {root}\n\
+              rel_path: {rel_path}\n\
+              file: {file}'))
 
     page = {'folder': rel_path}
     fp = os.path.join(root, rel_path, file)
-    with open(fp, 'r') as f:
-        file_contents = f.read()
-    page['metadata'], page['content'] = frontmatter.parse(file_contents)
+    # Contents may already have been read ahead by the build pipeline
+    if file_contents is None:
+        file_contents = file_io.read_file(fp)
+    page['metadata'], page['content'] = front_matter.parse(file_contents)
     page['metadata']['description'] = page['metadata'].get('description') or ''
     last_modified = time.gmtime(os.path.getmtime(fp))
     page['metadata']['last_modified'] = last_modified
-    page['links'] = links.get_local(page.get('content'))
+    if context_length:
+        page['link_contexts'] = []
+        page['links'] = links.get_local(page.get('content'), page['link_contexts'], context_length)
+    else:
+        page['links'] = links.get_local(page.get('content'))
+    return page
+
+
+def make_large_page_dict(root: str, rel_path: str, file: str, context_length: int = 0) -> dict:
+    """ Make dict of all page specific data for a large page by memory-mapping it,
+    only recording where its content is instead of keeping the content in memory """
+    logger = logging.getLogger('make_large_page_dict')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              root: {root}\n\
+              rel_path: {rel_path}\n\
+              file: {file}'))
+
+    page = {'folder': rel_path}
+    fp = os.path.join(root, rel_path, file)
+    with open(fp, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+        head = front_matter.parse_head(source)
+        if head is None:
+            logger.info(f'Front matter of large page needs a full read: {fp}')
+            return make_page_dict(root, rel_path, file, file_io.read_file(fp), context_length)
+        page['metadata'], content_start = head
+        if context_length:
+            page['link_contexts'] = []
+        page['links'], page['has_transclusions'] = links.get_local_from_bytes(source, content_start,
+                                                                              page.get('link_contexts'), context_length)
+    stat = os.stat(fp)
+    page['metadata']['description'] = page['metadata'].get('description') or ''
+    page['metadata']['last_modified'] = time.gmtime(stat.st_mtime)
+    page['content_location'] = [fp, content_start, stat.st_size, stat.st_mtime_ns]
     return page
 
 
+def has_content(page_info: dict) -> bool:
+    """ Whether page was made from a file, as opposed to a stub only linked to """
+    return page_info.get('content') is not None or 'content_location' in page_info
+
+
+def load_content(page_info: dict, size: int = -1) -> str or None:
+    """ Get page's Markdown content, reading it back from disk if the page was too large to keep in memory.
+    With size, only that many bytes from the start of the content are read back. """
+    if 'content_location' not in page_info:
+        return page_info.get('content')
+    fp, content_start = page_info['content_location'][:2]
+    with open(fp, 'rb') as f:
+        f.seek(content_start)
+        # Reading part of the content can stop partway through a character
+        return f.read(size).decode(errors='ignore' if size >= 0 else 'strict').replace('\r\n', '\n').strip()
+
+
 def add_page_to_sitemap(title: str, folder: str, sitemap: dict):
     """ Add page info to sitemap """
     logger = logging.getLogger('add_page_to_sitemap')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          title: {title}\n\
-          folder: {folder}\n\
-          sitemap: {sitemap}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              title: {title}\n\
+              folder: {folder}\n\
+              sitemap: {sitemap}'))
 
     if not sitemap.get(folder):
         sitemap[folder] = []
@@ -152,11 +461,14 @@ def add_page_to_sitemap(title: str, folder: str, sitemap: dict):
     return sitemap
 
 
-def load_frame(swiki_dir: str) -> str:
+def load_frame(swiki_dir: str, preview_script: bool = False) -> str:
+    """ Load the frame every page is placed in, loading the link preview script if preview_script """
     logger = logging.getLogger('load_frame')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          swiki_dir: {swiki_dir}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              swiki_dir: {swiki_dir}\n\
+              preview_script: {preview_script}'))
 
     with open(os.path.join(swiki_dir, 'frame.html'), 'r') as f:
         frame = f.read()
@@ -164,18 +476,32 @@ def load_frame(swiki_dir: str) -> str:
     frame = re.sub(r'(?<=\n)\s*', '', frame)
     frame = re.sub(r'(?<=>)\s*(?=<)', '', frame)
     frame = re.sub(r'(?<=[;{}(*/)])[\s]*', '', frame)
+    if preview_script:
+        frame = previews.add_script(frame)
 
     return frame
 
 
+def split_frame(frame: str, metadata: dict) -> tuple or None:
+    """ Fill out HTML frame with page information and split it into the HTML before and after
+    the content, or give None if the frame doesn't hold the content exactly once """
+    frame = frame.replace('{{title}}', metadata.get('title', ''))
+    frame = frame.replace('{{description}}', metadata.get('description', ''))
+    parts = frame.split('{{content}}')
+    if len(parts) != 2:
+        return None
+    return parts[0], parts[1]
+
+
 def fill_frame(frame: str, content: str, metadata: dict) -> str:
     """ Fill out HTML frame with page information """
     logger = logging.getLogger('fill_frame')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          frame: {frame}\n\
-          content: {content}\n\
-          metadata: {metadata}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              frame: {frame}\n\
+              content: {content}\n\
+              metadata: {metadata}'))
 
     frame = frame.replace('{{title}}', metadata.get('title', ''))
     frame = frame.replace('{{description}}', metadata.get('description', ''))
@@ -183,12 +509,13 @@ def fill_frame(frame: str, content: str, metadata: dict) -> str:
     return frame
 
 
-def format_recent_list(pages: dict, max_length: int) -> str:
+def format_recent_list(pages: dict, max_length: int, page_path=None) -> str:
     logger = logging.getLogger('format_recent_list')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          pages: {pages}\n\
-          max_length: {max_length}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              pages: {pages}\n\
+              max_length: {max_length}'))
 
     last_modified_list = []
     for filename, page_info in pages.items():
@@ -197,40 +524,256 @@ def format_recent_list(pages: dict, max_length: int) -> str:
              'filename': filename,
              'last_modified': page_info['metadata'].get('last_modified')}
         )
+    # Sort by filename first so pages modified at the same time always come in the same order
+    last_modified_list.sort(key=lambda item: item['filename'])
     last_modified_list.sort(key=lambda item: item['last_modified'], reverse=True)
     recent_list = last_modified_list[:max_length]
+    page_path = page_path or links.flat_page_path
 
     html = '<section class="recent-list"><h2>Recent Changes:</h2><ul>'
     for page in recent_list:
         formatted_lm_time = time.strftime(DATE_FORMAT, page.get('last_modified'))
         title, filename = page.get('title'), page.get('filename')
-        html += f'''<li>{formatted_lm_time}: <a href="{filename}.html">{title}</a></li>'''
+        html += f'''<li>{formatted_lm_time}: <a href="{page_path(filename)}">{title}</a></li>'''
     html += '</ul></section>'
     return html
 
 
-def prepare_page_for_file(page_info: dict, filename: str, tab_size: int) -> str:
-    logger = logging.getLogger('prepare_page_for_file')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          page_info: {page_info}\n\
-          filename: {filename}\n\
-          tab_size: {tab_size}'))
-
-    # If page is linked to but it hasn't been made yet, give it placeholder metadata
+def fill_page_metadata(page_info: dict, filename: str):
+    """ Give page full metadata, using placeholders for pages that are linked to but not made yet """
     if not page_info.get('metadata'):
         page_info['metadata'] = dict()
     page_info['metadata'] = {'title': page_info['metadata'].get('title', filename),
                              'description': page_info['metadata'].get('description', ''),
                              'last_modified': page_info['metadata'].get('last_modified', time.gmtime(0))}
+
+
+def transclusion_dependencies(page_info: dict) -> dict:
+    """ Record pages transcluded into this one and the content they expanded to """
+    if not page_info.get('transclusions'):
+        return dict()
+    return {'transclusions': page_info['transclusions'],
+            'transcluded_content': build_state.digest(page_info['expanded_content'])}
+
+
+def backlink_context_dependencies(page_info: dict) -> dict:
+    """ Record the text around links to this page shown with its backlinks """
+    contexts = sorted({(backlink['filename'], backlink['context'])
+                       for backlink in page_info.get('backlinks', []) if backlink.get('context')})
+    if not contexts:
+        return dict()
+    return {'backlink_contexts': build_state.digest(contexts)}
+
+
+def asset_dependencies(page_info: dict, asset_names: dict = None) -> dict:
+    """ Record the hashed names of the files a page refers to """
+    if not asset_names:
+        return dict()
+    content = page_info.get('expanded_content')
+    if content is None:
+        content = page_info.get('content')
+    if content is None and 'content_location' in page_info:
+        # Not kept in memory, so depend on every file
+        return {'assets': build_state.digest(sorted(asset_names.items()))}
+    used = sorted((file, asset_names[file]) for file in links.get_file_references(content or '') if file in asset_names)
+    return {'assets': build_state.digest(used)} if used else dict()
+
+
+def digest_frame(frame: str, asset_names: dict = None) -> str:
+    """ Digest of the frame, and of the hashed names of the files it refers to """
+    if not asset_names:
+        return build_state.digest(frame)
+    return build_state.digest([frame, sorted((file, asset_names[file]) for file in links.get_file_references(frame)
+                                             if file in asset_names)])
+
+
+def page_dependencies(page_info: dict, frame_digest: str, build_config: dict, page_path=None,
+                      asset_names: dict = None) -> dict:
+    """ Record everything the rendered page depends on """
+    backlinks = sorted({(backlink['title'], backlink['filename']) for backlink in page_info.get('backlinks', [])})
+    dependencies = {
+        'source': build_state.digest([page_info.get('metadata'),
+                                      page_info.get('content', page_info.get('content_location'))]),
+        'backlinks': [filename for _, filename in backlinks],
+        'backlink_titles': build_state.digest(backlinks),
+        'frame': frame_digest,
+        **backlink_context_dependencies(page_info),
+        **transclusion_dependencies(page_info),
+        **asset_dependencies(page_info, asset_names),
+    }
+    if (build_config.get('output_layout') == 'folders' or build_config.get('page_ids')) and page_path is not None:
+        # Where linked pages are written moves with their input folder or id
+        content = page_info.get('expanded_content')
+        targets = links.get_local(content) if content is not None else page_info.get('links', [])
+        dependencies['link_paths'] = build_state.digest([page_path(links.kebabify(target)) for target in targets] +
+                                                        [page_path(filename) for _, filename in backlinks])
+    for key in PAGE_CONFIG_KEYS:
+        dependencies[f'config.{key}'] = build_config.get(key)
+    return dependencies
+
+
+def index_dependencies(index: dict, pages: dict, frame_digest: str, build_config: dict,
+                       asset_names: dict = None) -> dict:
+    """ Record everything the rendered sitemap depends on """
+    # One page at a time, as pages may be kept on disk
+    page_list = ((filename, pages[filename].get('folder'), pages[filename].get('metadata'))
+                 for filename in sorted(pages) if filename != '{{SITE INDEX}}')
+    dependencies = {
+        'source': build_state.digest([index.get('metadata'), index.get('content')]),
+        'pages': build_state.digest_items(page_list),
+        'frame': frame_digest,
+        **transclusion_dependencies(index),
+        **asset_dependencies(index, asset_names),
+    }
+    for key in INDEX_CONFIG_KEYS:
+        dependencies[f'config.{key}'] = build_config.get(key)
+    return dependencies
+
+
+def expand_transclusions(pages: dict, max_depth: int):
+    """ Replace {{!Title}} in each page with the content of that page, expanding each page once.
+    Sets 'expanded_content' and 'transclusions' on every page that embeds another. """
+    logger = logging.getLogger('expand_transclusions')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              max_depth: {max_depth}'))
+
+    # filename -> (expanded content, filenames transcluded directly or indirectly, nesting depth)
+    expanded = dict()
+
+    def too_deep(filename: str):
+        title = pages[filename]['metadata'].get('title', filename)
+        return RuntimeError(f'''Transclusion of "{title}" is nested more than {max_depth} levels deep.''')
+
+    def expand(filename: str, chain: tuple) -> tuple:
+        if filename in expanded:
+            if len(chain) + expanded[filename][2] > max_depth:
+                raise too_deep(filename)
+            return expanded[filename]
+        if filename in chain:
+            titles = [pages[name]['metadata'].get('title', name) for name in (*chain, filename)]
+            raise RuntimeError(f'''Transclusion cycle: "{'" -> "'.join(titles)}".''')
+        if len(chain) > max_depth:
+            raise too_deep(filename)
+
+        content = load_content(pages[filename]) or ''
+        transclusions = set()
+        depth = 0
+
+        def transclude(match: re.Match) -> str:
+            nonlocal depth
+            title = match.group(1).strip()
+            target = links.kebabify(title)
+            if not has_content(pages.get(target, dict())):
+                logger.warning(f'Transcluded page "{title}" does not exist')
+                return title
+            target_content, target_transclusions, target_depth = expand(target, (*chain, filename))
+            transclusions.add(target)
+            transclusions.update(target_transclusions)
+            depth = max(depth, target_depth + 1)
+            return target_content
+
+        if '{{!' in content:
+            content = links.re_transclusion.sub(transclude, content)
+        expanded[filename] = (content, transclusions, depth)
+        return expanded[filename]
+
+    for filename, info in pages.items():
+        # Large pages are only read back here if they embed others
+        if not has_content(info) or info.get('has_transclusions') is False:
+            continue
+        content, transclusions, _ = expand(filename, tuple())
+        if transclusions:
+            info['expanded_content'] = content
+            info['transclusions'] = sorted(transclusions)
+            # Store it again, as expanding may have moved it out of memory in a page store
+            pages[filename] = info
+
+
+def render_markdown(text: str, filename: str, render_cache: dict or None,
+                    engine: str = markdown.DEFAULT_ENGINE) -> str:
+    """ Convert Markdown to HTML, reusing an earlier render of the same text with the same engine """
+    logger = logging.getLogger('render_markdown')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              text: {text}\n\
+              filename: {filename}\n\
+              engine: {engine}'))
+
+    if render_cache is None:
+        return markdown.get_renderer(engine)(text)
+    key = hashlib.sha1(f'{engine}\0{text}'.encode()).hexdigest()
+    render_cache['pages'][filename] = key
+    html = render_cache['html'].get(key)
+    if html is not None:
+        logger.debug(f'Render cache hit: {filename}')
+        render_cache['hits'] += 1
+        return html
+    html = markdown.get_renderer(engine)(text)
+    render_cache['html'][key] = html
+    return html
+
+
+def clamp_last_modified(pages: dict, epoch: int):
+    """ Make no page newer than epoch, so file times from a fresh checkout don't change the output """
+    latest = time.gmtime(epoch)
+    for info in pages.values():
+        last_modified = info.get('metadata', dict()).get('last_modified')
+        if last_modified is not None and last_modified > latest:
+            info['metadata']['last_modified'] = latest
+
+
+def page_markdown(page_info: dict) -> str:
+    """ Markdown to render for a page, with embedded pages expanded """
+    content = page_info.get('expanded_content')
+    if content is None:
+        content = load_content(page_info)
+    if content is None:
+        content = 'There\'s currently nothing here.'
+    return content
+
+
+def is_large_page(page_info: dict, large_file_size: int) -> bool:
+    """ Whether page is big enough to be memory-mapped and written out in chunks """
+    if 'content_location' in page_info:
+        return True
+    return len(page_info.get('expanded_content') or '') > large_file_size
+
+
+def split_chunks(text: str, chunk_size: int = STREAM_CHUNK_SIZE):
+    """ Yield pieces of text of about chunk_size characters, only split after newlines """
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start + chunk_size)
+        end = len(text) if end == -1 else end + 1
+        yield text[start:end]
+        start = end
+
+
+def prepare_page_for_file(page_info: dict, filename: str, tab_size: int, render_cache: dict = None,
+                          engine: str = markdown.DEFAULT_ENGINE, highlight=None, page_path=None) -> str:
+    logger = logging.getLogger('prepare_page_for_file')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              page_info: {page_info}\n\
+              filename: {filename}\n\
+              tab_size: {tab_size}'))
+
+    # If page is linked to but it hasn't been made yet, give it placeholder metadata
+    fill_page_metadata(page_info, filename)
     logger.debug(f'Page metadata: {page_info["metadata"]}')
 
-    content = marko.convert(page_info.get('content', 'There\'s currently nothing here.'))
+    content = render_markdown(page_markdown(page_info), filename, render_cache, engine)
+    if highlight is not None:
+        content = highlight(content)
     content = content.replace('\t', ' ' * tab_size)
     content = f'<h1 id="title">{page_info["metadata"].get("title")}</h1>{content}'
     content = links.add_external(content)
-    content = links.add_local(content)
-    content = links.add_backlinks(content, page_info.get('backlinks', []))
+    content = links.add_local(content, page_path)
+    content = links.add_backlinks(content, page_info.get('backlinks', []), page_path)
     content = add_last_modified(content, page_info['metadata'].get('last_modified'))
 
     content = place_in_container('article', 'content', content)
@@ -239,32 +782,82 @@ def prepare_page_for_file(page_info: dict, filename: str, tab_size: int) -> str:
     return content
 
 
-def make_sitemap_header(index: dict, pages: dict, recent_list_length: int) -> str:
+def stream_page_for_file(page_info: dict, filename: str, tab_size: int, render_cache: dict = None,
+                         engine: str = markdown.DEFAULT_ENGINE, highlight=None, page_path=None):
+    """ Same HTML as prepare_page_for_file, given as an iterator of pieces so a large page
+    is never copied whole. Markdown is rendered straight away, so the pieces can be
+    consumed in another thread. Links can't span lines, so each piece is linked on its own. """
+    logger = logging.getLogger('stream_page_for_file')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              filename: {filename}\n\
+              tab_size: {tab_size}'))
+
+    fill_page_metadata(page_info, filename)
+    html = render_markdown(page_markdown(page_info), filename, render_cache, engine)
+    if highlight is not None:
+        html = highlight(html)
+
+    title = page_info['metadata'].get('title')
+    backlinks = page_info.get('backlinks', [])
+    last_modified = page_info['metadata'].get('last_modified')
+
+    def chunks():
+        yield '<main id="main"><article id="content">'
+        yield links.add_local(links.add_external(f'<h1 id="title">{title}</h1>'), page_path)
+        for chunk in split_chunks(html):
+            yield links.add_local(links.add_external(chunk.replace('\t', ' ' * tab_size)), page_path)
+        yield links.add_backlinks('', backlinks, page_path)
+        yield add_last_modified('', last_modified)
+        yield '</article></main>'
+    return chunks()
+
+
+def stream_frame(frame: str, chunks, metadata: dict):
+    """ Same HTML as fill_frame, yielded in pieces """
+    frame_parts = split_frame(frame, metadata)
+    if frame_parts is None:
+        yield fill_frame(frame, ''.join(chunks), metadata)
+        return
+    yield frame_parts[0]
+    yield from chunks
+    yield frame_parts[1]
+
+
+def make_sitemap_header(index: dict, pages: dict, recent_list_length: int,
+                        engine: str = markdown.DEFAULT_ENGINE, highlight=None, page_path=None) -> str:
     logger = logging.getLogger('make_sitemap_header')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          index: {index}\n\
-          pages: {pages}\n\
-          recent_list_length: {recent_list_length}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              index: {index}\n\
+              pages: {pages}\n\
+              recent_list_length: {recent_list_length}'))
 
     index_html = f'<h1 id="title">{index["metadata"].get("title", "Sitemap")}</h1>'
-    index_html += marko.convert(index.get('content', ''))
-    index_html += format_recent_list(pages, recent_list_length)
+    index_content = markdown.get_renderer(engine)(index.get('expanded_content', index.get('content', '')))
+    index_html += highlight(index_content) if highlight is not None else index_content
+    index_html += format_recent_list(pages, recent_list_length, page_path)
     return index_html
 
 
-def make_wiki_index(sitemap: dict, pages: dict) -> str:
+def make_wiki_index(sitemap: dict, pages: dict, page_path=None) -> str:
     logger = logging.getLogger('make_wiki_index')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          sitemap: {sitemap}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              sitemap: {sitemap}'))
+
+    page_path = page_path or links.flat_page_path
 
     def convert_folder_to_html(folder_name: str, display_name: str = None) -> str:
         inner_logger = logger.getChild('convert_folder_to_html')
-        inner_logger.debug(dedent(f'\
-            Running with:\n\
-              folder_name: {folder_name}\n\
-              display_name: {display_name}'))
+        if inner_logger.isEnabledFor(logging.DEBUG):
+            inner_logger.debug(dedent(f'\
+                Running with:\n\
+                  folder_name: {folder_name}\n\
+                  display_name: {display_name}'))
 
         if not display_name:
             display_name = folder_name if folder_name else "[root]"
@@ -273,7 +866,7 @@ def make_wiki_index(sitemap: dict, pages: dict) -> str:
         html = f'<details><summary>{display_name}</summary><ul>'
         for filename in sorted_folder_list:
             page_info = pages.get(filename)
-            formatted_title = f'<a href="{filename}.html">{page_info["metadata"].get("title")}</a>'
+            formatted_title = f'<a href="{page_path(filename)}">{page_info["metadata"].get("title")}</a>'
             if description := page_info["metadata"].get("description"):
                 html += f'<li>{formatted_title} - {description}</li>'
             else:
@@ -293,11 +886,12 @@ def make_wiki_index(sitemap: dict, pages: dict) -> str:
 def make_sitemap(sitemap_html: str, frame: str, index_metadata: dict) -> str:
     """ Make sitemap out of index content and frame """
     logger = logging.getLogger('make_sitemap')
-    logger.debug(dedent(f'\
-        Running with:\n\
-          sitemap_html: {sitemap_html}\n\
-          frame: {frame}\n\
-          index_metadata: {index_metadata}'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              sitemap_html: {sitemap_html}\n\
+              frame: {frame}\n\
+              index_metadata: {index_metadata}'))
 
     page_html = place_in_container('main', 'main', sitemap_html)
     return fill_frame(frame, page_html, index_metadata)
@@ -308,20 +902,76 @@ def make_sitemap(sitemap_html: str, frame: str, index_metadata: dict) -> str:
 ################
 
 
-def make_wiki(pages_dir: str, output_dir: str, build_config: dict):
-    """ Create flat wiki out of all pages """
-    logger = logging.getLogger('make_wiki')
-    logger.debug(dedent(f'\
-        Running with\n\
-          pages_dir: {pages_dir}\n\
-          output_dir: {output_dir}\n\
-          build_config: {build_config}'))
-
-    pages = dict()
-    media_files = set()
+def load_pages(pages_dir: str, page_files: list, jobs: int, source_cache: dict = None, changed_paths: set = None,
+               large_file_size: int = DEFAULT_LARGE_FILE_SIZE, timestamps: dict = None, context_length: int = 0):
+    """ Yield (rel_path, file, page) for each page file, reading ahead in a thread pool.
+    Pages in source_cache are reused unless they changed on disk, are in changed_paths or were
+    parsed with another context_length. Pages larger than large_file_size bytes are memory-mapped instead of read.
+    Pages in timestamps (source path -> Unix time) are last modified then instead of at their mtime. """
+    logger = logging.getLogger('load_pages')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              pages_dir: {pages_dir}\n\
+              page_files: {page_files}\n\
+              jobs: {jobs}\n\
+              changed_paths: {changed_paths}'))
+
+    page_fps = [os.path.join(pages_dir, rel_path, file) for rel_path, file in page_files]
+    signatures = dict()
+    if source_cache is not None:
+        for fp in page_fps:
+            # Trust the caller's list of changed paths and skip stat calls if given
+            if changed_paths is not None and fp not in changed_paths and fp in source_cache:
+                signatures[fp] = (source_cache[fp][0][0], context_length)
+            else:
+                signatures[fp] = (source_signature(fp), context_length)
+        stale_fps = {fp for fp in page_fps
+                     if fp not in source_cache or source_cache[fp][0] != signatures[fp]
+                     or (changed_paths is not None and fp in changed_paths)}
+    else:
+        stale_fps = set(page_fps)
+    logger.info(f'Reading {len(stale_fps)} of {len(page_fps)} pages')
+
+    prefetched = file_io.prefetch_files([fp for fp in page_fps if fp in stale_fps], jobs, large_file_size)
+    for (rel_path, file), fp in zip(page_files, page_fps):
+        if fp not in stale_fps:
+            page = source_cache[fp][1]
+        else:
+            _, file_contents = next(prefetched)
+            if file_contents is None:
+                page = make_large_page_dict(pages_dir, rel_path, file, context_length)
+            else:
+                page = make_page_dict(pages_dir, rel_path, file, file_contents, context_length)
+            if source_cache is not None:
+                source_cache[fp] = (signatures[fp], page)
+        # The build adds backlinks and placeholder metadata, so keep the cached page pristine
+        page = dict(page, metadata=dict(page['metadata']))
+        if timestamps and fp in timestamps:
+            page['metadata']['last_modified'] = time.gmtime(timestamps[fp])
+        yield rel_path, file, page
+
+    if source_cache is not None:
+        for fp in set(source_cache) - set(page_fps):
+            del source_cache[fp]
+
+
+def find_source_files(pages_dir: str) -> tuple:
+    """ Walk input directory and return lists of (rel_path, file) for pages and (folder, file) for media.
+    Files that would be written to the same output are left for find_conflicts() to report. """
+    logger = logging.getLogger('find_source_files')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              pages_dir: {pages_dir}'))
 
-    for subfolder, _, files in os.walk(pages_dir):
+    page_files = []
+    media_files = []
+    for subfolder, dirs, files in os.walk(pages_dir):
         logger.info(f'Folder: {subfolder}')
+        # Walk in the same order on every filesystem, so pages and backlinks always come in the same order
+        dirs[:] = sorted(folder for folder in dirs if folder not in IGNORE_FOLDERS)
+        files.sort()
         rel_path = subfolder.replace(pages_dir, '').lstrip('/')
         logger.debug(f'New relative path: {rel_path}')
         # Ignore all folders with preceding underscore
@@ -337,86 +987,928 @@ def make_wiki(pages_dir: str, output_dir: str, build_config: dict):
                 continue
             if extension != '.md':
                 logger.debug(f'Media file found: {file}')
-                if file in media_files:
-                    raise RuntimeError(f'''File "{rel_path}/{file}" conflicts with another file "{file}".''')
-                copy_media(subfolder, file, output_dir)
-                media_files.add(file)
+                media_files.append((subfolder, file))
                 continue
-            page = make_page_dict(pages_dir, rel_path, file)
-            page_filename = links.kebabify(page['metadata'].get('title') or filename)
-            if page_filename in RESERVED:
-                logger.debug(f'Filename in RESERVED: {page_filename}')
-                page_filename += '_'
-
-            # add backlinks to all pages this page links to
-            for link in page['links']:
-                link_filename = links.kebabify(link)
-                # if page being linked to does not yet exist, give it the title
-                # as seen in the current page (e.g. Bob Fossil, not bob-fossil).
-                # This will be overwritten by the given title if the page exists.
-                if not pages.get(link_filename):
-                    pages[link_filename] = dict()
-                if not pages[link_filename].get('metadata'):
-                    pages[link_filename]['metadata'] = {'title': link, 'description': ''}
-                if not pages[link_filename].get('backlinks'):
-                    pages[link_filename]['backlinks'] = []
-                # add current page to "backlinks"
-                pages[link_filename]['backlinks'].append({'title': page['metadata'].get('title', page_filename),
-                                                          'filename': page_filename})
-
-            # add page info to pages dict
-            if pages.get(page_filename) and pages[page_filename].get('folder') is not None:
-                current_folder = page.get('folder') + '/' if page.get('folder') else ''
-                existing_folder = rel_path + '/' if rel_path else ''
-                raise RuntimeError(f'''Page "{current_folder}{page['metadata'].get('title')}" with filename "{page_filename}" conflicts with page "{existing_folder}{pages[page_filename]['metadata'].get('title')}" with filename "{page_filename}".''')
-            elif pages.get(page_filename):
-                pages[page_filename] |= page
-            else:
-                pages[page_filename] = page
+            page_files.append((rel_path, file))
+    return page_files, media_files
+
+
+def pages_size(pages_dir: str, page_files: list) -> int:
+    """ Total size in bytes of page files """
+    return sum(os.path.getsize(os.path.join(pages_dir, rel_path, file)) for rel_path, file in page_files)
+
+
+def page_graph_memory(pages_dir: str, page_files: list) -> int:
+    """ Rough bytes the page graph of page files takes in memory """
+    return len(page_files) * PAGE_RECORD_MEMORY + 2 * pages_size(pages_dir, page_files)
+
+
+def page_output_filename(title: str) -> str:
+    """ Output filename, without extension, of a page with a title """
+    page_filename = links.kebabify(title)
+    if page_filename in RESERVED:
+        page_filename += '_'
+    return page_filename
+
+
+def page_output_folder(filename: str, folder: str or None, layout: str) -> str:
+    """ Folder in the output folder the HTML of a page goes in, given the input folder it is in (None for stubs) """
+    if layout == 'hashed':
+        return hashlib.sha1(filename.encode()).hexdigest()[:HASHED_FOLDER_LENGTH]
+    if layout == 'folders':
+        folder = STUBS_FOLDER_NAME if folder is None else folder
+        # Named like page filenames, so links to them need no escaping
+        return '/'.join(links.kebabify(part) or '_' for part in folder.split('/') if part)
+    return ''
+
+
+def find_id_conflicts(pages: dict, ids: dict) -> list:
+    """ Messages for every page whose id gives it the same output filename as another page """
+    conflicts = []
+    owners = dict()  # output filename -> page filename
+    for filename in sorted(pages):
+        if filename == '{{SITE INDEX}}':
+            continue
+        name = ids.get(filename, filename)
+        if name not in owners:
+            owners[name] = filename
+            continue
+        titles = [pages[owner]['metadata'].get('title', owner) for owner in (owners[name], filename)]
+        conflicts.append(f'''Page "{titles[1]}" conflicts with page "{titles[0]}" with filename "{name}".''')
+    return conflicts
+
+
+def make_page_path(pages: dict, layout: str, page_ids: bool = False):
+    """ Function giving the path in the output folder of the HTML of a page from its filename.
+    With page_ids, pages with an id in their front matter are named by it instead of their title.
+    Raises RuntimeError if ids make two pages share an output filename. """
+    if layout not in OUTPUT_LAYOUTS:
+        raise RuntimeError(f'''Unknown output layout "{layout}". Choose from: {", ".join(OUTPUT_LAYOUTS)}.''')
+    ids = dict()
+    if page_ids:
+        ids = {filename: page_output_filename(str(info['metadata']['id'])) for filename, info in pages.items()
+               if filename != '{{SITE INDEX}}' and info.get('metadata', dict()).get('id') not in (None, '')}
+        if conflicts := find_id_conflicts(pages, ids):
+            raise RuntimeError('\n'.join(conflicts))
+    if layout == 'flat' and not ids:
+        return links.flat_page_path
+    folders = None
+    if layout == 'folders':
+        folders = {filename: page_output_folder(filename, info.get('folder'), layout)
+                   for filename, info in pages.items() if filename != '{{SITE INDEX}}'}
+
+    def page_path(filename: str) -> str:
+        name = ids.get(filename, filename)
+        folder = folders.get(filename, '') if folders is not None else page_output_folder(name, None, layout)
+        return f'{folder}/{name}.html' if folder else f'{name}.html'
+    return page_path
+
+
+def page_root(output_file: str) -> str:
+    """ Relative URL of the output folder from an output file """
+    return '../' * output_file.count('/')
+
+
+def source_name(folder: str, name: str) -> str:
+    """ Name of a page or file with its folder, for messages """
+    return f'{folder}/{name}' if folder else name
+
+
+def find_conflicts(pages_dir: str, page_titles: list, media_files: list) -> list:
+    """ Messages for every source that would be written to the same output as another: pages with the
+    same filename, media files with the same name and media files named like a page, the index or a generated file.
+    page_titles holds (rel_path, title) of each page, with the file name as title if it has none. """
+    logger = logging.getLogger('find_conflicts')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              pages_dir: {pages_dir}\n\
+              page_titles: {page_titles}\n\
+              media_files: {media_files}'))
+
+    import modules.sitemap_utilities as sitemaps
+    conflicts = []
+    page_sources = dict()
+    for rel_path, title in page_titles:
+        page_filename = page_output_filename(title)
+        if page_filename not in page_sources:
+            page_sources[page_filename] = (rel_path, title)
+            continue
+        existing_title = page_sources[page_filename][1]
+        message = f'''Page "{source_name(rel_path, title)}" with filename "{page_filename}" conflicts with page "{source_name(*page_sources[page_filename])}" with filename "{page_filename}".'''
+        if max(len(title), len(existing_title)) > links.MAX_FILENAME_LENGTH:
+            message += f' Titles are cut to {links.MAX_FILENAME_LENGTH} characters for filenames.'
+        conflicts.append(message)
+
+    media_sources = dict()
+    for subfolder, file in media_files:
+        rel_path = subfolder.replace(pages_dir, '').lstrip('/')
+        filename, extension = os.path.splitext(file)
+        if file in media_sources:
+            conflicts.append(f'''File "{source_name(rel_path, file)}" conflicts with file "{source_name(media_sources[file], file)}".''')
+            continue
+        media_sources[file] = rel_path
+        if extension == '.html' and filename in page_sources:
+            conflicts.append(f'''File "{source_name(rel_path, file)}" conflicts with page "{source_name(*page_sources[filename])}" with filename "{filename}".''')
+        elif file == 'index.html':
+            conflicts.append(f'''File "{source_name(rel_path, file)}" conflicts with the wiki index "index.html".''')
+        elif file in DATA_OUTPUTS or sitemaps.re_sitemap_part.fullmatch(file):
+            conflicts.append(f'''File "{source_name(rel_path, file)}" conflicts with the generated file "{file}".''')
+    return conflicts
+
+
+def find_filename_warnings(page_titles: list) -> list:
+    """ Messages for pages whose filename isn't their kebab-case title: reserved names get
+    an underscore, and long titles are cut short """
+    warnings = []
+    for rel_path, title in page_titles:
+        page_filename = page_output_filename(title)
+        if page_filename != links.kebabify(title):
+            warnings.append(f'''Page "{source_name(rel_path, title)}" has filename "{page_filename}" because "{links.kebabify(title)}" is reserved.''')
+        if len(title) > links.MAX_FILENAME_LENGTH:
+            warnings.append(f'''Page "{source_name(rel_path, title)}" has filename "{page_filename}" cut to {links.MAX_FILENAME_LENGTH} characters.''')
+        if not page_filename:
+            warnings.append(f'''Page "{source_name(rel_path, title)}" has an empty filename.''')
+    return warnings
+
+
+def build_page_graph(pages_dir: str, page_files: list, jobs: int, source_cache: dict = None,
+                     changed_paths: set = None, large_file_size: int = DEFAULT_LARGE_FILE_SIZE,
+                     timestamps: dict = None, media_files: list = (), pages: dict = None,
+                     context_length: int = 0) -> dict:
+    """ Parse all pages and link them together with backlinks, including stubs for missing pages.
+    Once all pages are parsed, raises RuntimeError listing every conflict between them and media_files.
+    Pages are added to pages if given, such as a PageStore, else to a new dict.
+    If context_length is set, each backlink keeps the text around its link as its context. """
+    logger = logging.getLogger('build_page_graph')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              pages_dir: {pages_dir}\n\
+              page_files: {page_files}\n\
+              jobs: {jobs}'))
+
+    pages = pages if pages is not None else dict()
+    page_titles = []
+    for rel_path, file, page in load_pages(pages_dir, page_files, jobs, source_cache, changed_paths,
+                                           large_file_size, timestamps, context_length):
+        filename = os.path.splitext(file)[0]
+        page_titles.append((rel_path, page['metadata'].get('title') or filename))
+        page_filename = page_output_filename(page['metadata'].get('title') or filename)
+
+        # add backlinks to all pages this page links to, which keep the contexts instead of this page
+        contexts = page.pop('link_contexts', None) or [None] * len(page['links'])
+        for link, context in zip(page['links'], contexts):
+            link_filename = links.kebabify(link)
+            # if page being linked to does not yet exist, give it the title
+            # as seen in the current page (e.g. Bob Fossil, not bob-fossil).
+            # This will be overwritten by the given title if the page exists.
+            if not pages.get(link_filename):
+                pages[link_filename] = dict()
+            if not pages[link_filename].get('metadata'):
+                pages[link_filename]['metadata'] = {'title': link, 'description': ''}
+            if not pages[link_filename].get('backlinks'):
+                pages[link_filename]['backlinks'] = []
+            # add current page to "backlinks"
+            backlink = {'title': page['metadata'].get('title', page_filename), 'filename': page_filename}
+            if context:
+                backlink['context'] = context
+            pages[link_filename]['backlinks'].append(backlink)
+
+        # add page info to pages dict
+        if pages.get(page_filename) and pages[page_filename].get('folder') is not None:
+            # Reported with all other conflicts once every page is parsed
+            logger.debug(f'Conflicting page: {rel_path}/{file}')
+            continue
+        elif pages.get(page_filename):
+            pages[page_filename] |= page
+        else:
+            pages[page_filename] = page
 
-            logger.debug(f'Page dict created: {pages[page_filename]}')
+        logger.debug(f'Page dict created: {pages[page_filename]}')
 
-    swiki_dir = os.path.join(pages_dir, '_swiki')
+    if conflicts := find_conflicts(pages_dir, page_titles, media_files):
+        raise RuntimeError('\n'.join(conflicts))
 
     # If there is an index file, build page dict
-    if os.path.isfile(os.path.join(swiki_dir, 'index.md')):
+    index_fp = os.path.join(pages_dir, '_swiki', 'index.md')
+    if os.path.isfile(index_fp):
         pages['{{SITE INDEX}}'] = make_page_dict(pages_dir, '_swiki', 'index.md')
+        if timestamps and index_fp in timestamps:
+            pages['{{SITE INDEX}}']['metadata']['last_modified'] = time.gmtime(timestamps[index_fp])
         logger.debug(f'Index file: {pages["{{SITE INDEX}}"]}')
 
-    # Load frame file
-    frame = load_frame(swiki_dir)
+    return pages
 
-    # Build all files and populate sitemap dict
-    sitemap = dict()
-    index = {'metadata': dict()}
+
+def source_size(page_info: dict) -> int:
+    """ Bytes of Markdown a page was made from, after its front matter """
+    if 'content_location' in page_info:
+        _, content_start, size = page_info['content_location'][:3]
+        return size - content_start
+    return len((page_info.get('content') or '').encode())
+
+
+def rebuild_reasons(build_config: dict, previous: dict or None, current: dict) -> list:
+    """ Short names of why an output is built, for the event log: the dependencies that changed,
+    or full_build, new_output or missing_output """
+    if not build_config.get('incremental'):
+        return ['full_build']
+    if previous is None:
+        return ['new_output']
+    # With nothing changed, the output is only built again if it was deleted
+    return build_state.changed_keys(previous, current) or ['missing_output']
+
+
+def render_cache_result(render_cache: dict or None, hits_before: int) -> str or None:
+    """ hit if the page just rendered reused an earlier render, given the render cache's hits before it """
+    if render_cache is None:
+        return None
+    return 'hit' if render_cache['hits'] > hits_before else 'miss'
+
+
+def count_bytes(chunks, on_done):
+    """ Pass chunks of text through, then call on_done(bytes_out=...) with the bytes they take in UTF-8 """
+    size = 0
+    for chunk in chunks:
+        size += len(chunk.encode())
+        yield chunk
+    on_done(bytes_out=size)
+
+
+def make_wiki(pages_dir: str, output_dir: str, build_config: dict,
+              cache: dict = None, changed_paths: set = None):
+    """ Create flat wiki out of all pages. A cache from new_build_cache() keeps
+    parsed pages, renders and output digests for the next build of the same wiki. """
+    logger = logging.getLogger('make_wiki')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with\n\
+              pages_dir: {pages_dir}\n\
+              output_dir: {output_dir}\n\
+              build_config: {build_config}'))
+
+    import modules.sitemap_utilities as sitemaps
+    build_start = time.perf_counter()
+    # Record the engine actually used, which is the default if the configured one isn't installed
+    engine = markdown.resolve_engine(build_config.get('markdown_engine', markdown.DEFAULT_ENGINE))
+    build_config = {**build_config, 'markdown_engine': engine}
+    jobs = build_config.get('jobs', DEFAULT_JOBS)
+    state = build_state.load_state(output_dir)
+    previous_dependencies = state.get('outputs', dict())
+    dependencies = dict()
+
+    page_files, media_files = find_source_files(pages_dir)
+    source_cache = cache['sources'] if cache is not None else None
+    history = git_history(pages_dir, page_files) if build_config.get('git') else dict()
+    if cache is None and history:
+        # A fresh checkout gives every file a new mtime, so between runs (as in CI) the files git changed
+        # since the last build tell which pages to read again. Without them, pages are checked by their stat.
+        if changed_paths is None:
+            changed_paths = git_changed_paths(pages_dir, state)
+            logger.info(f'Changed since last build: {len(changed_paths) if changed_paths is not None else "unknown"}')
+        source_cache = build_state.load_source_cache(output_dir, pages_dir, config_fingerprint(build_config))
+    large_file_size = build_config.get('large_file_size', DEFAULT_LARGE_FILE_SIZE)
+    store = None
+    max_memory = build_config.get('max_memory', 0) * 1024 * 1024
+    if max_memory and page_graph_memory(pages_dir, page_files) > max_memory:
+        logger.info(f'Page graph is over {max_memory} bytes, keeping it on disk')
+        # Leave page content in the page files, and keep page records past half the budget on disk
+        large_file_size = 0
+        # Only imported over budget, as pickle and sqlite3 slow every start
+        import modules.page_store as page_store
+        store = page_store.PageStore(max_memory // 2)
+        if engine == 'cmarkgfm':
+            logger.warning('The cmarkgfm engine keeps memory for every page it renders, so builds can go over max_memory')
+    events = event_log.EventLog(build_config['event_log']) if build_config.get('event_log') else None
+    try:
+        # Raises on conflicting pages or media before any output is written
+        pages = build_page_graph(pages_dir, page_files, jobs, source_cache, changed_paths, large_file_size,
+                                 history.get('timestamps'), media_files, store, build_config.get('backlink_context', 0))
+        page_path = make_page_path(pages, build_config.get('output_layout', 'flat'), build_config.get('page_ids', False))
+        expand_transclusions(pages, build_config.get('transclusion_depth', DEFAULT_TRANSCLUSION_DEPTH))
+        if build_config.get('reproducible'):
+            clamp_last_modified(pages, build_epoch(pages_dir, build_config))
+        asset_names, stylesheets = dict(), None
+        if build_config.get('hashed_assets'):
+            asset_names, stylesheets, state['assets'] = hash_assets(pages_dir, media_files, build_config.get('highlight_style'),
+                                                                    state.get('assets', dict()))
+        else:
+            state.pop('assets', None)
+        phases = dict()  # phase -> seconds, for the event log
+
+        def end_phase(phase: str):
+            phases[phase] = time.perf_counter() - build_start - sum(phases.values())
+
+        end_phase('parse')
+        totals = {'pages': 0, 'rendered': 0, 'streamed': 0, 'skipped': 0, 'unchanged_outputs': 0,
+                  'render_cache_hits': 0, 'render_cache_misses': 0, 'bytes_in': 0, 'bytes_out': 0}
+        # Streamed pages are logged from the writer's threads once written
+        totals_lock = threading.Lock()
+
+        def log_page(filename: str, output_file: str, action: str, **fields):
+            with totals_lock:
+                totals['pages'] += 1
+                totals[action] += 1
+                totals['bytes_in'] += fields.get('bytes_in', 0)
+                totals['bytes_out'] += fields.get('bytes_out', 0)
+                if fields.get('written') is False:
+                    totals['unchanged_outputs'] += 1
+                if fields.get('render_cache'):
+                    totals['render_cache_hits' if fields['render_cache'] == 'hit' else 'render_cache_misses'] += 1
+            events.emit('page', input=pages_dir, page=filename, output=output_file, action=action, **fields)
+
+        with file_io.BoundedWriter(jobs) as writer:
+            for subfolder, file in media_files:
+                writer.submit(copy_media, subfolder, file, output_dir, asset_names.get(file))
+
+            # Load frame file
+            swiki_dir = os.path.join(pages_dir, '_swiki')
+            frame = load_frame(swiki_dir, build_config.get('previews', False))
+            frame_digest = digest_frame(frame, asset_names)
+
+            highlight = None
+            highlight_style = build_config.get('highlight_style')
+            if highlight_style:
+                highlight_cache = cache['highlights'] if cache is not None else highlighting.load_cache(output_dir)
+                if cache is not None and cache['shared']:
+                    # A shared cache only lasts the one process, so each wiki still keeps the highlights it uses
+                    saved_highlights = highlighting.load_cache(output_dir)
+                    highlight_cache.update(saved_highlights)
+                used_highlights = set()
+
+                def highlight(page_html: str) -> str:
+                    return highlighting.highlight_code_blocks(page_html, highlight_style, highlight_cache, used_highlights)
+            # Unused highlights can only be dropped if every output was rendered this time
+            rendered_all = True
+
+            def write_output(fp: str, content: str):
+                # Skip writing output that is identical to what the last cached build wrote
+                if cache is not None:
+                    digest = hashlib.sha1(content.encode()).digest()
+                    # Keyed by path in the output folder, which stays the same when building into a staging copy
+                    output_file = os.path.relpath(fp, output_dir)
+                    written_outputs[output_file] = digest
+                    if cache['outputs'].get(output_file) == digest and os.path.isfile(fp):
+                        logger.debug(f'Output unchanged: {fp}')
+                        return False
+                writer.write(fp, content)
+                return True
+
+            def write_data_output(output_file: str, content: str):
+                # Generated data files depend only on their own content
+                dependencies[output_file] = {'content': build_state.digest(content)}
+                output_fp = os.path.join(output_dir, output_file)
+                if build_config.get('incremental') and os.path.isfile(output_fp) \
+                        and previous_dependencies.get(output_file) == dependencies[output_file]:
+                    return
+                write_output(output_fp, content)
+
+            # Build all files and populate sitemap dict. Writes drain through the
+            # writer's pool while the next page renders.
+            written_outputs = dict()
+            render_cache = cache['renders'] if cache is not None else None
+            sitemap = dict()
+            index = {'metadata': dict()}
+            output_folders = {''}
+            for filename, info in pages.items():
+                logger.info(f'Page: {filename}')
+                # If it's the index/sitemap page, don't build it
+                if filename == '{{SITE INDEX}}':
+                    index = info
+                    continue
+                output_file = page_path(filename)
+                dependencies[output_file] = page_dependencies(info, frame_digest, build_config, page_path, asset_names)
+                # If page doesn't belong to a folder, then it is a stub
+                dest_folder = info.get('folder', STUBS_FOLDER_NAME)
+                sitemap = add_page_to_sitemap(filename, dest_folder, sitemap)
+                fill_page_metadata(info, filename)
+
+                output_fp = os.path.join(output_dir, output_file)
+                if build_config.get('incremental') and os.path.isfile(output_fp) \
+                        and previous_dependencies.get(output_file) == dependencies[output_file]:
+                    logger.debug(f'Dependencies unchanged: {output_file}')
+                    rendered_all = False
+                    if events is not None:
+                        log_page(filename, output_file, 'skipped')
+                    continue
+                if events is not None:
+                    page_start = time.perf_counter()
+                    render_hits = render_cache['hits'] if render_cache is not None else 0
+                    page_event = {'reasons': rebuild_reasons(build_config, previous_dependencies.get(output_file),
+                                                             dependencies[output_file]),
+                                  'bytes_in': source_size(info)}
+                output_folder = os.path.dirname(output_file)
+                if output_folder not in output_folders:
+                    os.makedirs(os.path.join(output_dir, output_folder), exist_ok=True)
+                    output_folders.add(output_folder)
+                # Links are made from the output folder, so pages in subfolders point them back up to it
+                root = page_root(output_file)
+                if is_large_page(info, large_file_size):
+                    # Stream large pages straight to the file instead of building nested copies
+                    chunks = stream_page_for_file(info, filename, build_config['tab_size'], render_cache, engine, highlight,
+                                                  page_path)
+                    logger.debug(f'Streaming file: {output_file}')
+                    output_chunks = (links.add_root(links.rename_files(chunk, asset_names), root)
+                                     for chunk in stream_frame(frame, chunks, info['metadata']))
+                    if events is not None:
+                        # Rendered up front, then framed and counted as the writer takes each chunk
+                        page_event['render_cache'] = render_cache_result(render_cache, render_hits)
+                        page_event['seconds'] = {'render': time.perf_counter() - page_start}
+                        log_streamed = functools.partial(log_page, filename, output_file, 'streamed', written=True,
+                                                         **page_event)
+                        output_chunks = count_bytes(output_chunks, log_streamed)
+                    writer.write_chunks(output_fp, output_chunks)
+                    continue
+                file_content = prepare_page_for_file(info, filename, build_config['tab_size'], render_cache, engine,
+                                                     highlight, page_path)
+                if events is not None:
+                    render_end = time.perf_counter()
+                filled_frame = fill_frame(frame, file_content, info.get('metadata', dict()))
+                filled_frame = links.add_root(links.rename_files(filled_frame, asset_names), root)
+                logger.debug(f'Writing file: {output_file}')
+                written = write_output(output_fp, filled_frame)
+                if events is not None:
+                    log_page(filename, output_file, 'rendered', render_cache=render_cache_result(render_cache, render_hits),
+                             seconds={'render': render_end - page_start, 'frame': time.perf_counter() - render_end},
+                             bytes_out=len(filled_frame.encode()), written=written, **page_event)
+            end_phase('pages')
+
+            dependencies['index.html'] = index_dependencies(index, pages, frame_digest, build_config, asset_names)
+            index_fp = os.path.join(output_dir, 'index.html')
+            if build_config.get('incremental') and os.path.isfile(index_fp) \
+                    and previous_dependencies.get('index.html') == dependencies['index.html']:
+                rendered_all = False
+            else:
+                sitemap_header = make_sitemap_header(index, pages, build_config.get('recent_list_length'), engine,
+                                                     highlight, page_path)
+                wiki_index = make_wiki_index(sitemap, pages, page_path)
+                sitemap_html = sitemap_header + wiki_index
+                filled_frame = make_sitemap(sitemap_html, frame, index['metadata'])
+
+                logger.debug(f'Writing sitemap: index.html')
+                write_output(index_fp, links.rename_files(filled_frame, asset_names))
+            end_phase('index')
+
+            if build_config.get('graph'):
+                # Paths are only given when they can't be told from filenames
+                write_graph(pages, output_dir, build_config.get('graph_depth', DEFAULT_GRAPH_DEPTH), write_data_output,
+                            page_path if page_path is not links.flat_page_path else None)
+            if build_config.get('previews'):
+                write_previews(pages, output_dir, write_data_output, page_path)
+            if build_config.get('site_url'):
+                write_sitemap(pages, build_config['site_url'], build_config.get('sitemap_stubs', True),
+                              'robots.txt' not in {file for _, file in media_files}, write_data_output, page_path)
+            end_phase('data')
+        # Waiting for the writer to finish writing pages out
+        end_phase('write')
+        # Parts of a sitemap split by an earlier, bigger build would otherwise still be served
+        for file in os.listdir(output_dir):
+            if sitemaps.re_sitemap_part.fullmatch(file) and file not in dependencies:
+                os.remove(os.path.join(output_dir, file))
+        copy_css_file(pages_dir, output_dir, highlight_style, stylesheets)
+        # Remove files under hashed names that the last build wrote and this one didn't
+        for file in set(state.get('asset_files', [])) - set(asset_names.values()):
+            if os.path.isfile(os.path.join(output_dir, file)):
+                os.remove(os.path.join(output_dir, file))
+        state['asset_files'] = sorted(set(asset_names.values()))
+        if highlight_style:
+            if cache is not None and cache['shared']:
+                kept_highlights = used_highlights if rendered_all else used_highlights | set(saved_highlights)
+                highlighting.save_cache(output_dir, {key: highlight_cache[key] for key in kept_highlights})
+            else:
+                if rendered_all:
+                    for key in set(highlight_cache) - used_highlights:
+                        del highlight_cache[key]
+                if cache is None:
+                    highlighting.save_cache(output_dir, highlight_cache)
+
+        state['outputs'] = dependencies
+        if history:
+            state['git_commit'], state['git_clean'] = history['commit'], history['clean']
+            if cache is None:
+                build_state.save_source_cache(output_dir, pages_dir, config_fingerprint(build_config), source_cache)
+        if build_config.get('reproducible'):
+            state['manifest'] = build_state.write_manifest(output_dir, state.get('manifest', dict()))
+        build_state.save_state(output_dir, state)
+
+        if store is not None:
+            logger.info(f'Page records written to disk: {store.spilled}')
+        if cache is not None:
+            cache['outputs'] = written_outputs
+            renders = cache['renders']
+            for filename in set(renders['pages']) - set(pages):
+                del renders['pages'][filename]
+            if not cache['shared']:
+                for key in set(renders['html']) - set(renders['pages'].values()):
+                    del renders['html'][key]
+        end_phase('finish')
+        if events is not None:
+            events.emit('build', input=pages_dir, output=output_dir, seconds=time.perf_counter() - build_start,
+                        phases=phases, **totals)
+    finally:
+        # Also on errors, so a failed build in the build server doesn't leave the file and thread open
+        if events is not None:
+            events.close()
+        if store is not None:
+            store.close()
+
+
+def make_wiki_staged(pages_dir: str, output_dir: str, build_config: dict, cache: dict = None,
+                     changed_paths: set = None, delete_html: bool = False):
+    """ Build wiki into a staging folder next to output_dir, starting from hard links to its current
+    files, then swap it in whole so output_dir never holds a partly written build """
+    logger = logging.getLogger('make_wiki_staged')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              pages_dir: {pages_dir}\n\
+              output_dir: {output_dir}\n\
+              delete_html: {delete_html}'))
+
+    import modules.publish_utilities as publish
+    # Bookkeeping files are rewritten in place, so they are copied instead of linked
+    staging_dir = publish.stage(output_dir, {build_state.STATE_FILE, build_state.MANIFEST_FILE,
+                                             highlighting.HIGHLIGHT_CACHE_FILE})
+    logger.info(f'Staging folder: {staging_dir}')
+    try:
+        if delete_html:
+            delete_current_html(staging_dir, build_config.get('output_layout', 'flat'))
+        make_wiki(pages_dir, staging_dir, build_config, cache, changed_paths)
+    except BaseException:
+        publish.discard(staging_dir)
+        raise
+    publish.swap(staging_dir, output_dir)
+
+
+def load_batch_manifest(manifest_fp: str) -> list:
+    """ Load (input_dir, output_dir) pairs of wikis to build from a JSON list of {"input": ..., "output": ...}.
+    Relative paths are relative to the manifest's folder. """
+    with open(manifest_fp, 'r') as f:
+        try:
+            entries = json.load(f)
+        except ValueError as e:
+            raise RuntimeError(f'''Batch manifest "{manifest_fp}" is not valid JSON: {e}''')
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_fp))
+    wikis = []
+    for entry in entries if isinstance(entries, list) else [entries]:
+        if not isinstance(entry, dict) or not entry.get('input') or not entry.get('output'):
+            raise RuntimeError(f'''Batch manifest "{manifest_fp}" entry {entry} needs an "input" and an "output".''')
+        wikis.append((os.path.join(manifest_dir, entry['input']), os.path.join(manifest_dir, entry['output'])))
+    return wikis
+
+
+def wiki_size(pages_dir: str) -> int:
+    """ Total size in bytes of a wiki's pages, to tell which builds take longest """
+    page_files, _ = find_source_files(pages_dir)
+    return pages_size(pages_dir, page_files)
+
+
+def build_wikis(wikis: list, settings: dict, workers: int = DEFAULT_BATCH_WORKERS, staged: bool = False,
+                delete_html: bool = False) -> list:
+    """ Build several wikis in one process, sharing rendered Markdown and highlighted code between them.
+    wikis holds (input_dir, output_dir) pairs, and settings apply to every wiki before its own config file.
+    Wikis are built by a pool of workers, largest first, so the longest builds don't start last.
+    Returns (input_dir, output_dir, error message or None) for each wiki, in the order given. """
+    logger = logging.getLogger('build_wikis')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              wikis: {wikis}\n\
+              settings: {settings}\n\
+              workers: {workers}'))
+
+    shared = new_shared_cache()
+
+    def build(input_dir: str, output_dir: str):
+        config = load_config(input_dir, settings)
+        fingerprint = None
+        if config['incremental'] and not delete_html:
+            fingerprint, unchanged = incremental_fingerprint(input_dir, output_dir, config)
+            if unchanged:
+                logger.info(f'No changes since last build: {input_dir}')
+                return
+        start = time.perf_counter()
+        if staged:
+            make_wiki_staged(input_dir, output_dir, config, new_build_cache(shared), delete_html=delete_html)
+        else:
+            if not os.path.isdir(output_dir):
+                os.mkdir(output_dir)
+            if delete_html:
+                delete_current_html(output_dir, config['output_layout'])
+            make_wiki(input_dir, output_dir, config, new_build_cache(shared))
+        if fingerprint:
+            record_fingerprint(output_dir, fingerprint)
+        logger.info(f'Built {input_dir} in {time.perf_counter() - start:.3f}s')
+
+    # By position in wikis, as the same input may be built to several outputs
+    errors = dict()
+    sizes = dict()
+    for i, (input_dir, _) in enumerate(wikis):
+        if os.path.isdir(input_dir):
+            sizes[i] = wiki_size(input_dir)
+        else:
+            errors[i] = f'Input folder not found: {input_dir}'
+    futures = dict()
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for i in sorted(sizes, key=sizes.get, reverse=True):
+            futures[i] = pool.submit(build, *wikis[i])
+    for i, future in futures.items():
+        # One broken wiki shouldn't stop the others being built
+        if error := future.exception():
+            logger.error(f'Build of {wikis[i][0]} to {wikis[i][1]} failed: {error!r}')
+            errors[i] = str(error)
+    return [(input_dir, output_dir, errors.get(i)) for i, (input_dir, output_dir) in enumerate(wikis)]
+
+
+def write_graph(pages: dict, output_dir: str, depth: int, write_data_output, page_path=None):
+    """ Write link graph of the whole wiki to graph.json and each page's neighbourhood to graph/.
+    With page_path, the graphs also give the path of each page's HTML. """
+    logger = logging.getLogger('write_graph')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              output_dir: {output_dir}\n\
+              depth: {depth}'))
+
+    filenames = sorted(filename for filename in pages if filename != '{{SITE INDEX}}')
+    titles = [pages[filename]['metadata'].get('title', filename) for filename in filenames]
+    page_links = {filename: [links.kebabify(link) for link in pages[filename].get('links', [])]
+                  for filename in filenames}
+    adjacency = graph.make_adjacency(filenames, page_links)
+    paths = [page_path(filename) for filename in filenames] if page_path is not None else None
+    write_data_output('graph.json', graph.graph_json(filenames, titles, adjacency, paths))
+
+    os.makedirs(os.path.join(output_dir, GRAPH_FOLDER_NAME), exist_ok=True)
+    neighbours = graph.make_undirected(adjacency)
+    encoded_filenames, encoded_titles = graph.encode_strings(filenames), graph.encode_strings(titles)
+    encoded_paths = graph.encode_strings(paths) if paths is not None else None
+    for node, filename in enumerate(filenames):
+        node_ids = graph.neighbourhood(neighbours, node, depth)
+        write_data_output(f'{GRAPH_FOLDER_NAME}/{filename}.json',
+                          graph.local_graph_json(encoded_filenames, encoded_titles, adjacency, node_ids, encoded_paths))
+
+
+def write_previews(pages: dict, output_dir: str, write_data_output, page_path=None):
+    """ Write each page's title, description and the start of its first paragraph to preview/,
+    named like the page's HTML given by page_path, and the script that shows them when hovering links """
+    logger = logging.getLogger('write_previews')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              output_dir: {output_dir}'))
+
+    os.makedirs(os.path.join(output_dir, previews.FOLDER_NAME), exist_ok=True)
     for filename, info in pages.items():
-        logger.info(f'Page: {filename}')
-        # If it's the index/sitemap page, don't build it
         if filename == '{{SITE INDEX}}':
-            index = info
             continue
-        file_content = prepare_page_for_file(info, filename, build_config['tab_size'])
-        filled_frame = fill_frame(frame, file_content, info.get('metadata', dict()))
-        logger.debug(f'Writing file: {filename}.html')
-        with open(os.path.join(output_dir, f'{filename}.html'), 'w') as f:
-            f.write(filled_frame)
+        # Large pages are only read back as far as their first paragraph is likely to go
+        content = info.get('expanded_content')
+        if content is None:
+            content = load_content(info, previews.HEAD_SIZE) or ''
+        excerpt = links.plain_text(previews.first_paragraph(content))
+        name = os.path.basename((page_path or links.flat_page_path)(filename))[:-len('.html')]
+        write_data_output(f'{previews.FOLDER_NAME}/{name}.json',
+                          previews.preview_json(info['metadata'].get('title', filename),
+                                                info['metadata'].get('description', ''), excerpt))
+    write_data_output(previews.SCRIPT_FILE, previews.SCRIPT)
+
+
+def write_sitemap(pages: dict, site_url: str, include_stubs: bool, write_robots: bool, write_data_output,
+                  page_path=None):
+    """ Write sitemap.xml of every page from the page records, and robots.txt pointing to it """
+    logger = logging.getLogger('write_sitemap')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              site_url: {site_url}\n\
+              include_stubs: {include_stubs}\n\
+              write_robots: {write_robots}'))
+
+    import modules.sitemap_utilities as sitemaps
+    filenames = sorted(filename for filename, info in pages.items()
+                       if filename != '{{SITE INDEX}}' and (include_stubs or info.get('folder') is not None))
+    page_path = page_path or links.flat_page_path
+    entries = [(page_path(filename), pages[filename]['metadata'].get('last_modified')) for filename in filenames]
+    # The sitemap page changes whenever any page does
+    known_times = [last_modified for _, last_modified in entries if sitemaps.format_lastmod(last_modified)]
+    entries.insert(0, ('', max(known_times) if known_times else None))
+    for output_file, content in sitemaps.make_sitemaps(site_url, entries).items():
+        write_data_output(output_file, content)
+    if write_robots:
+        write_data_output('robots.txt', sitemaps.robots_txt(site_url))
+
+
+def explain_page(pages_dir: str, output_dir: str, build_config: dict, page: str) -> list:
+    """ List reasons the output for a page (given by title or filename) would be rebuilt """
+    logger = logging.getLogger('explain_page')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              pages_dir: {pages_dir}\n\
+              output_dir: {output_dir}\n\
+              page: {page}'))
+
+    engine = markdown.resolve_engine(build_config.get('markdown_engine', markdown.DEFAULT_ENGINE))
+    build_config = {**build_config, 'markdown_engine': engine}
+    page_files, media_files = find_source_files(pages_dir)
+    history = git_history(pages_dir, page_files) if build_config.get('git') else dict()
+    pages = build_page_graph(pages_dir, page_files, build_config.get('jobs', DEFAULT_JOBS),
+                             large_file_size=build_config.get('large_file_size', DEFAULT_LARGE_FILE_SIZE),
+                             timestamps=history.get('timestamps'),
+                             context_length=build_config.get('backlink_context', 0))
+    expand_transclusions(pages, build_config.get('transclusion_depth', DEFAULT_TRANSCLUSION_DEPTH))
+    if build_config.get('reproducible'):
+        clamp_last_modified(pages, build_epoch(pages_dir, build_config))
+    state = build_state.load_state(output_dir)
+    asset_names = dict()
+    if build_config.get('hashed_assets'):
+        asset_names, _, _ = hash_assets(pages_dir, media_files, build_config.get('highlight_style'),
+                                        state.get('assets', dict()))
+    frame = load_frame(os.path.join(pages_dir, '_swiki'), build_config.get('previews', False))
+    frame_digest = digest_frame(frame, asset_names)
+    page_path = make_page_path(pages, build_config.get('output_layout', 'flat'), build_config.get('page_ids', False))
+
+    filename = page[:-len('.html')] if page.endswith('.html') else page
+    if filename not in pages and links.kebabify(filename) not in pages:
+        # Or by the path of its HTML in the output folder, which may be named by the page's id
+        output_files = {page_path(filename): filename for filename in pages if filename != '{{SITE INDEX}}'}
+        filename = output_files.get(f'{filename}.html', filename.rsplit('/', 1)[-1])
+    if filename == 'index':
+        current = index_dependencies(pages.get('{{SITE INDEX}}', {'metadata': dict()}),
+                                     pages, frame_digest, build_config, asset_names)
+        output_file = 'index.html'
+    elif filename in pages or links.kebabify(filename) in pages:
+        filename = filename if filename in pages else links.kebabify(filename)
+        current = page_dependencies(pages[filename], frame_digest, build_config, page_path, asset_names)
+        output_file = page_path(filename)
+    else:
+        raise ValueError(f'No page with title or filename "{page}"')
+
+    previous = state.get('outputs', dict()).get(output_file)
+    if not os.path.isfile(os.path.join(output_dir, output_file)):
+        return [f'{output_file} has not been built']
+    return build_state.explain_changes(previous, current)
+
+
+def check_wiki(pages_dir: str, jobs: int = DEFAULT_JOBS) -> tuple:
+    """ Find every conflict between outputs without building, reading only the front matter of pages.
+    Returns (conflicts, warnings) as lists of messages. """
+    logger = logging.getLogger('check_wiki')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              pages_dir: {pages_dir}\n\
+              jobs: {jobs}'))
+
+    page_files, media_files = find_source_files(pages_dir)
+    page_fps = [os.path.join(pages_dir, rel_path, file) for rel_path, file in page_files]
+    page_titles = []
+    heads = file_io.prefetch_heads(page_fps, jobs, front_matter.HEAD_SIZE)
+    for (rel_path, file), (fp, head) in zip(page_files, heads):
+        parsed = front_matter.parse_head(head)
+        if parsed is None:
+            # JSON front matter, or front matter running past the head, needs the whole file
+            parsed = front_matter.parse(file_io.read_file(fp))
+        page_titles.append((rel_path, parsed[0].get('title') or os.path.splitext(file)[0]))
+    return find_conflicts(pages_dir, page_titles, media_files), find_filename_warnings(page_titles)
+
+
+def serve_builds(socket_path: str):
+    """ Run a build server that keeps each wiki's parsed pages and renders in memory between builds """
+    logger = logging.getLogger('serve_builds')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(dedent(f'\
+            Running with:\n\
+              socket_path: {socket_path}'))
+
+    import modules.build_server as build_server
+
+    caches = dict()
+
+    def build(request: dict) -> dict:
+        if request.get('command') == 'ping':
+            return {'ok': True}
+        input_dir, output_dir = request['input_dir'], request['output_dir']
+        if not os.path.isdir(input_dir):
+            return {'ok': False, 'error': f'Input folder not found: {input_dir}'}
+        if not request.get('staged'):
+            if not os.path.isdir(output_dir):
+                os.mkdir(output_dir)
+            if request.get('delete_current_html'):
+                delete_current_html(output_dir, request['config'].get('output_layout', 'flat'))
+
+        changed_paths = request.get('changed_paths')
+        changed_paths = set(changed_paths) if changed_paths is not None else None
+        # Start over when settings that change the output do, so nothing cached under other settings is reused
+        fingerprint = config_fingerprint(request['config'])
+        if caches.get((input_dir, output_dir), (None,))[0] != fingerprint:
+            caches[(input_dir, output_dir)] = (fingerprint, new_build_cache())
+        cache = caches[(input_dir, output_dir)][1]
+        start = time.perf_counter()
+        try:
+            if request.get('staged'):
+                make_wiki_staged(input_dir, output_dir, request['config'], cache, changed_paths,
+                                 request.get('delete_current_html'))
+            else:
+                make_wiki(input_dir, output_dir, request['config'], cache, changed_paths)
+        except Exception:
+            # A failed build may leave the cache half updated
+            del caches[(input_dir, output_dir)]
+            raise
+        seconds = time.perf_counter() - start
+        logger.info(f'Built {input_dir} in {seconds:.3f}s')
+        return {'ok': True, 'seconds': seconds}
+
+    build_server.serve(socket_path, build)
+
 
-        # If page doesn't belong to a folder, then it is a stub
-        dest_folder = info.get('folder', STUBS_FOLDER_NAME)
-        sitemap = add_page_to_sitemap(filename, dest_folder, sitemap)
+if __name__ == "__main__" and sys.argv[1:2] == ['serve-build']:
+    import modules.build_server as build_server
+
+    argparser = argparse.ArgumentParser(prog='swiki.py serve-build',
+                                        description='Keep wikis in memory and build them on request.')
+    argparser.add_argument('--socket', '-s', default=build_server.default_socket_path(),
+                           help='path of the Unix socket to listen on')
+    argparser.add_argument('-v', '--verbose', action='count', default=0,
+                           help='print debug information during builds. Use -vv for more details')
+    args = argparser.parse_args(sys.argv[2:])
 
-    sitemap_header = make_sitemap_header(index, pages, build_config.get('recent_list_length'))
-    wiki_index = make_wiki_index(sitemap, pages)
-    sitemap_html = sitemap_header + wiki_index
-    filled_frame = make_sitemap(sitemap_html, frame, index['metadata'])
+    logging.basicConfig(filename=f"build.log", level=logging.WARN - args.verbose * 10)
+    serve_builds(args.socket)
 
-    logger.debug(f'Writing sitemap: index.html')
-    with open(os.path.join(output_dir, 'index.html'), 'w') as f:
-        f.write(filled_frame)
-    copy_css_file(pages_dir, output_dir)
+elif __name__ == "__main__" and sys.argv[1:2] == ['check']:
+    argparser = argparse.ArgumentParser(prog='swiki.py check',
+                                        description='Report every page and file that would overwrite another, '
+                                                    'without building. Exits with 1 if there are any.')
+    argparser.add_argument('input_dir', metavar='input', type=str,
+                           help='the path to the input directory')
+    argparser.add_argument('--jobs', '-j', default=DEFAULT_JOBS, type=int,
+                           help='number of threads used to read files')
+    args = argparser.parse_args(sys.argv[2:])
 
+    if not os.path.isdir(args.input_dir):
+        sys.exit(f'Input folder not found: {args.input_dir}')
+    conflicts, warnings = check_wiki(args.input_dir, args.jobs)
+    for warning in warnings:
+        print(f'Warning: {warning}', file=sys.stderr)
+    for conflict in conflicts:
+        print(f'Error: {conflict}', file=sys.stderr)
+    sys.exit(1 if conflicts else 0)
+
+elif __name__ == "__main__" and sys.argv[1:2] == ['batch']:
+    argparser = argparse.ArgumentParser(prog='swiki.py batch',
+                                        description='Build several wikis listed in a manifest in one process.')
+    argparser.add_argument('manifest', type=str,
+                           help='JSON list of {"input": ..., "output": ...} folders, relative to the manifest')
+    argparser.add_argument('--workers', '-w', default=DEFAULT_BATCH_WORKERS, type=int,
+                           help='number of wikis built at the same time')
+    argparser.add_argument('--jobs', '-j', default=DEFAULT_JOBS, type=int,
+                           help='number of threads used to read and write files of each wiki')
+    argparser.add_argument('--delete-current-html', '-d', action='store_true',
+                           help='delete all HTML in output directories before building')
+    argparser.add_argument('--staged', '-S', action='store_true',
+                           help='build into staging copies of the output directories and swap them in when done')
+    argparser.add_argument('--incremental', '-i', action='store_true',
+                           help='skip wikis with no input file or setting changed since their last build')
+    argparser.add_argument('--graph', '-g', action='store_true',
+                           help='write the link graph of each wiki')
+    argparser.add_argument('--git', '-G', action='store_true',
+                           help='take last modified times and changes since the last build from git')
+    argparser.add_argument('--reproducible', '-R', action='store_true',
+                           help='build the same output on any machine and write manifest.json of output hashes')
+    argparser.add_argument('--max-memory', '-m', default=0, type=int, metavar='MIB',
+                           help='keep the page graph of a wiki on disk if it would take more than this many MiB')
+    argparser.add_argument('--output-layout', '-L', default='flat', choices=OUTPUT_LAYOUTS,
+                           help='put page HTML in the output folder, in folders named by a hash, or in folders like the input')
+    argparser.add_argument('--event-log', '-E', default='', metavar='PATH',
+                           help='append a JSON line for each page built and a summary of each build to this file')
+    argparser.add_argument('-v', '--verbose', action='count', default=0,
+                           help='print debug information during builds. Use -vv for more details')
+    args = argparser.parse_args(sys.argv[2:])
 
-if __name__ == "__main__":
+    logging.basicConfig(filename=f"build.log", level=logging.WARN - args.verbose * 10)
+    try:
+        batch = load_batch_manifest(args.manifest)
+    except (OSError, RuntimeError) as e:
+        sys.exit(str(e))
+    results = build_wikis(batch, {
+        'jobs': args.jobs,
+        'incremental': args.incremental,
+        'graph': args.graph,
+        'git': args.git,
+        'reproducible': args.reproducible,
+        'max_memory': args.max_memory,
+        'output_layout': args.output_layout,
+        'event_log': args.event_log,
+    }, args.workers, args.staged, args.delete_current_html)
+    failed = [result for result in results if result[2]]
+    for input_dir, output_dir, error in failed:
+        print(f'{input_dir} -> {output_dir}: {error}', file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+elif __name__ == "__main__":
     argparser = argparse.ArgumentParser(description='Create wiki at output dir from input dir.')
     argparser.add_argument('input_dir', metavar='input', type=str,
                            help='the path to the input directory')
@@ -424,10 +1916,45 @@ if __name__ == "__main__":
                            help='the path to the output directory')
     argparser.add_argument('--delete-current-html', '-d', action='store_true',
                            help='delete all HTML in output directory before building')
-    argparser.add_argument('--recent-list', '-rl', default=False, action="store_true",
+    argparser.add_argument('--staged', '-S', action='store_true',
+                           help='build into a staging copy of the output directory and swap it in when done')
+    # Settings left out are None, so config.ini and SWIKI_* environment variables apply
+    argparser.add_argument('--recent-list', '-rl', default=None, action="store_true",
                            help='create most recently modified pages list on index')
-    argparser.add_argument('--recent-list-length', '-rll', default=10,
+    argparser.add_argument('--recent-list-length', '-rll', default=None, type=int,
                            help='length of most recently modified pages list')
+    argparser.add_argument('--jobs', '-j', default=None, type=int,
+                           help=f'number of threads used to read and write files (default {DEFAULT_JOBS})')
+    argparser.add_argument('--graph', '-g', default=None, action='store_true',
+                           help='write the link graph to graph.json and each page\'s local graph to graph/')
+    argparser.add_argument('--incremental', '-i', default=None, action='store_true',
+                           help='skip the build if no input file or setting changed since the last build')
+    argparser.add_argument('--site-url', '-u', default=None,
+                           help='public URL of the wiki, to write sitemap.xml and robots.txt with')
+    argparser.add_argument('--git', '-G', default=None, action='store_true',
+                           help='take last modified times and changes since the last build from git')
+    argparser.add_argument('--reproducible', '-R', default=None, action='store_true',
+                           help='build the same output on any machine and write manifest.json of output hashes')
+    argparser.add_argument('--max-memory', '-m', default=None, type=int, metavar='MIB',
+                           help='keep the page graph on disk if it would take more than this many MiB of memory')
+    argparser.add_argument('--output-layout', '-L', default=None, choices=OUTPUT_LAYOUTS,
+                           help='put page HTML in the output folder, in folders named by a hash, or in folders like the input')
+    argparser.add_argument('--previews', '-P', default=None, action='store_true',
+                           help='write a preview of each page and a script showing them when hovering links')
+    argparser.add_argument('--hashed-assets', '-H', default=None, action='store_true',
+                           help='name media and CSS by a hash of their content, so they can be cached forever')
+    argparser.add_argument('--page-ids', '-I', default=None, action='store_true',
+                           help="name a page's HTML by the id in its front matter, so renaming the page keeps its URL")
+    argparser.add_argument('--backlink-context', '-b', default=None, type=int, metavar='CHARACTERS',
+                           help='show the text around each link to a page with its backlinks, up to this many characters either side')
+    argparser.add_argument('--event-log', '-E', default=None, metavar='PATH',
+                           help='append a JSON line for each page built and a summary of the build to this file')
+    argparser.add_argument('--explain', '-e', metavar='PAGE',
+                           help="explain why a page (title or filename) would be rebuilt, then exit")
+    argparser.add_argument('--socket', '-s', default=os.environ.get('SWIKI_SOCKET'),
+                           help='send the build to the build server at this socket, if running')
+    argparser.add_argument('--changed', '-c', nargs='+', action='extend',
+                           help='files changed since the last build (with --socket)')
     argparser.add_argument('-v', '--verbose', action='count', default=0,
                            help='print debug information during build. Use -vv for more details')
     args = argparser.parse_args()
@@ -435,21 +1962,80 @@ if __name__ == "__main__":
     # Set log level to either INFO or DEBUG, if -v or -vv
     logging.basicConfig(filename=f"build.log", level=logging.WARN - args.verbose * 10)
 
-    if not os.path.isdir(args.input_dir):
-        sys.exit(f'Input folder not found: {args.input_dir}')
-    if not os.path.isdir(args.output_dir):
-        os.mkdir(args.output_dir)
-    if args.delete_current_html:
-        delete_current_html(args.output_dir)
-
-    config = {
-        'tab_size': 2,
+    flags = {
         'recent_list': args.recent_list,
         'recent_list_length': args.recent_list_length,
+        'jobs': args.jobs,
+        'incremental': args.incremental,
+        'graph': args.graph,
+        'reproducible': args.reproducible,
+        'git': args.git,
+        'site_url': args.site_url,
+        'max_memory': args.max_memory,
+        'output_layout': args.output_layout,
+        'backlink_context': args.backlink_context,
+        'previews': args.previews,
+        'hashed_assets': args.hashed_assets,
+        'page_ids': args.page_ids,
+        'event_log': args.event_log,
     }
-
-    config_fp = os.path.join(args.input_dir, '_swiki', 'config.ini')
-    if os.path.isfile(config_fp):
-        update_config(config, config_fp)
-
-    make_wiki(args.input_dir, args.output_dir, config)
+    try:
+        config = load_config(args.input_dir, dict(), {key: value for key, value in flags.items() if value is not None})
+    except (OSError, RuntimeError) as e:
+        sys.exit(str(e))
+
+    if args.explain:
+        try:
+            reasons = explain_page(args.input_dir, args.output_dir, config, args.explain)
+        except ValueError as e:
+            sys.exit(str(e))
+        if reasons:
+            print(f'{args.explain} would be rebuilt because:')
+            for reason in reasons:
+                print(f'  - {reason}')
+        else:
+            print(f'{args.explain} is up to date')
+        sys.exit()
+
+    fingerprint = None
+    if config['incremental'] and not args.delete_current_html and os.path.isdir(args.input_dir):
+        fingerprint, unchanged = incremental_fingerprint(args.input_dir, args.output_dir, config)
+        if unchanged:
+            logging.info('No changes since last build')
+            sys.exit()
+
+    response = None
+    if args.socket:
+        import modules.build_server as build_server
+
+        request = {
+            'input_dir': os.path.abspath(args.input_dir),
+            'output_dir': os.path.abspath(args.output_dir),
+            'delete_current_html': args.delete_current_html,
+            'staged': args.staged,
+            'changed_paths': [os.path.abspath(fp) for fp in args.changed] if args.changed else None,
+            # The server runs in its own folder, so paths in the config are made absolute too
+            'config': {**config, 'event_log': os.path.abspath(config['event_log'])} if config.get('event_log') else config,
+        }
+        try:
+            response = build_server.send_request(args.socket, request)
+        except OSError:
+            logging.warning(f'No build server at {args.socket}, building locally')
+    if response is not None:
+        if not response.get('ok'):
+            sys.exit(response.get('error'))
+    else:
+        if not os.path.isdir(args.input_dir):
+            sys.exit(f'Input folder not found: {args.input_dir}')
+        if args.staged:
+            make_wiki_staged(args.input_dir, args.output_dir, config, delete_html=args.delete_current_html)
+        else:
+            if not os.path.isdir(args.output_dir):
+                os.mkdir(args.output_dir)
+            if args.delete_current_html:
+                delete_current_html(args.output_dir, config['output_layout'])
+
+            make_wiki(args.input_dir, args.output_dir, config)
+
+    if fingerprint:
+        record_fingerprint(args.output_dir, fingerprint)
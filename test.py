@@ -1,11 +1,30 @@
+import hashlib
+import json
+import logging
+import math
 import os
+import re
 import shutil
+import subprocess
 from textwrap import dedent
+import threading
 import time
 import unittest
+from unittest import mock
 
+import bench
 import swiki
+import modules.build_state as build_state
+import modules.event_log as event_log
+import modules.frontmatter_utilities as front_matter
+import modules.git_utilities as git
+import modules.graph_utilities as graph
+import modules.highlight_utilities as highlighting
+import modules.io_utilities as file_io
 import modules.link_utilities as link
+import modules.markdown_engines as markdown
+import modules.preview_utilities as previews
+import modules.sitemap_utilities as sitemaps
 
 
 def touch(path, content: str = ''):
@@ -70,12 +89,54 @@ class LinkUtilitiesTestCase(unittest.TestCase):
         actual_local_links = link.get_local(test_content)
         self.assertListEqual(expected_local_links, actual_local_links)
 
+    def test_get_local_skips_transclusions(self):
+        test_content = """A {{local link}} and an embedded {{!Glossary}}."""
+        self.assertListEqual(['local link'], link.get_local(test_content))
+
+    def test_get_local_from_bytes(self):
+        test_content = """---\ntitle: {{not a link}}\n---\nA {{local link}}, a {{local link|with another name}} and {{!Glossary}}."""
+        expected_output = (['local link', 'with another name'], True)
+        self.assertEqual(expected_output, link.get_local_from_bytes(test_content.encode(), test_content.index('A')))
+
+    def test_get_local_contexts(self):
+        test_content = """# Notes\n\n- First point. Read {{Cats|cat}} and *{{dogs}}* for more! Unrelated.\n{{Fish}} is """ + 'long ' * 20
+        contexts = []
+        self.assertListEqual(['cat', 'dogs', 'Fish'], link.get_local(test_content, contexts, 30))
+        self.assertListEqual(['Read Cats and dogs for more!', 'Read Cats and dogs for more!', 'Fish is long long long long long…'],
+                             contexts)
+        contexts = []
+        link.get_local_from_bytes(test_content.encode(), 0, contexts, 30)
+        self.assertListEqual(['Read Cats and dogs for more!', 'Read Cats and dogs for more!', 'Fish is long long long long long…'],
+                             contexts)
+
+    def test_get_transclusions(self):
+        test_content = """A {{local link}}, an embedded {{!Glossary}} and {{! Disclaimer }}."""
+        self.assertListEqual(['Glossary', 'Disclaimer'], link.get_transclusions(test_content))
+
     def test_add_local(self):
         test_content = """A {{local link}}, a {{local link|with another name}}, and an <a href="www.example.com">external link</a>."""
         expected_output = """A <a href="local-link.html">local link</a>, a <a href="with-another-name.html">local link</a>, and an <a href="www.example.com">external link</a>."""
         actual_output = link.add_local(test_content)
         self.assertEqual(expected_output, actual_output)
 
+    def test_add_root(self):
+        test_content = ('<link href="main.css"><a href="docs/page.html">Page</a><img src="cat.png"> '
+                        '<a href="https://example.com">External</a> <a href="/about">About</a> <a href="#top">Top</a>')
+        expected_output = ('<link href="../main.css"><a href="../docs/page.html">Page</a><img src="../cat.png"> '
+                           '<a href="https://example.com">External</a> <a href="/about">About</a> <a href="#top">Top</a>')
+        self.assertEqual(expected_output, link.add_root(test_content, '../'))
+        self.assertEqual(test_content, link.add_root(test_content, ''))
+
+    def test_rename_files(self):
+        test_content = ('<link href="main.css"><img src=\'cat.png\'> ![Cat](cat.png) '
+                        'body { background: url("cat.png#top"); } <a href="page.html">Page</a>')
+        self.assertEqual({'main.css', 'cat.png', 'page.html'}, link.get_file_references(test_content))
+        expected_output = ('<link href="main.1a2b.css"><img src=\'cat.3c4d.png\'> ![Cat](cat.3c4d.png) '
+                           'body { background: url("cat.3c4d.png#top"); } <a href="page.html">Page</a>')
+        test_names = {'main.css': 'main.1a2b.css', 'cat.png': 'cat.3c4d.png'}
+        self.assertEqual(expected_output, link.rename_files(test_content, test_names))
+        self.assertEqual(test_content, link.rename_files(test_content, dict()))
+
     def test_add_external(self):
         test_content = """A {{local link}}, a {{local link|with another name}}, and an <a href="www.example.com">external link</a>."""
         expected_output = """A {{local link}}, a {{local link|with another name}}, and an <a href="www.example.com" target="_blank">external link</a>."""
@@ -100,6 +161,320 @@ class LinkUtilitiesTestCase(unittest.TestCase):
         actual_content = link.add_backlinks(test_content, test_backlinks)
         self.assertEqual(expected_content, actual_content)
 
+    def test_add_backlinks_contexts(self):
+        test_backlinks = [{**self.test_backlinks[0], 'context': 'See <this> yeah'},
+                          {**self.test_backlinks[0], 'context': 'Or that'},
+                          {**self.test_backlinks[0], 'context': 'See <this> yeah'},
+                          self.test_backlinks[1]]
+        expected_content = """<section id="backlinks"><details><summary>Backlinks</summary><ul><li><a href="yeah.html">yeah</a><p class="backlink-context">See &lt;this&gt; yeah</p><p class="backlink-context">Or that</p></li><li><a href="yeah-2.html">yeah 2</a></li></ul></details></section>"""
+        self.assertEqual(expected_content, link.add_backlinks('', test_backlinks))
+
+
+class IOUtilitiesTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_path = make_test_directory()
+
+    def tearDown(self):
+        empty(self.test_path)
+
+    def test_prefetch_files_in_order(self):
+        # SET UP
+        test_paths = []
+        for i in range(20):
+            test_paths.append(os.path.join(self.test_path, f'{i}.md'))
+            touch(test_paths[-1], f'content {i}')
+
+        # TEST
+        actual_output = list(file_io.prefetch_files(test_paths, 3))
+        expected_output = [(fp, f'content {i}') for i, fp in enumerate(test_paths)]
+        self.assertListEqual(expected_output, actual_output)
+
+    def test_read_file_max_size(self):
+        test_fp = os.path.join(self.test_path, 'test.md')
+        touch(test_fp, 'content')
+        self.assertEqual('content', file_io.read_file(test_fp, 7))
+        self.assertIsNone(file_io.read_file(test_fp, 6))
+
+    def test_bounded_writer(self):
+        with file_io.BoundedWriter(2) as writer:
+            for i in range(20):
+                writer.write(os.path.join(self.test_path, f'{i}.html'), f'content {i}')
+        for i in range(20):
+            with open(os.path.join(self.test_path, f'{i}.html'), 'r') as f:
+                self.assertEqual(f.read(), f'content {i}')
+
+    def test_bounded_writer_raises_errors(self):
+        with self.assertRaises(FileNotFoundError):
+            with file_io.BoundedWriter(2) as writer:
+                writer.write(os.path.join(self.test_path, 'missing', 'test.html'), 'content')
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.isdir(cls.test_path):
+            shutil.rmtree(cls.test_path)
+
+
+class BuildStateTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.test_path = make_test_directory()
+
+    def tearDown(self):
+        empty(self.test_path)
+
+    def test_load_state_if_not_exists(self):
+        self.assertEqual(build_state.load_state(self.test_path), dict())
+
+    def test_save_and_load_state(self):
+        build_state.save_state(self.test_path, {'input_fingerprint': 'abc'})
+        self.assertEqual(build_state.load_state(self.test_path), {'input_fingerprint': 'abc'})
+
+    def test_input_fingerprint(self):
+        # SET UP
+        test_file = os.path.join(self.test_path, 'test.md')
+        touch(test_file, 'test')
+        test_config = {'tab_size': 2}
+        fingerprint = build_state.input_fingerprint(self.test_path, test_config)
+
+        # TEST
+        self.assertEqual(fingerprint, build_state.input_fingerprint(self.test_path, test_config))
+        self.assertNotEqual(fingerprint, build_state.input_fingerprint(self.test_path, {'tab_size': 4}))
+        touch(test_file, ' and more')
+        self.assertNotEqual(fingerprint, build_state.input_fingerprint(self.test_path, test_config))
+
+    def test_input_fingerprint_ignores_folders(self):
+        touch(os.path.join(self.test_path, 'test.md'), 'test')
+        os.makedirs(os.path.join(self.test_path, '.git'), exist_ok=True)
+        fingerprint = build_state.input_fingerprint(self.test_path, dict(), swiki.IGNORE_FOLDERS)
+        touch(os.path.join(self.test_path, '.git', 'index'), 'changed by git status')
+        self.assertEqual(fingerprint, build_state.input_fingerprint(self.test_path, dict(), swiki.IGNORE_FOLDERS))
+        self.assertNotEqual(fingerprint, build_state.input_fingerprint(self.test_path, dict()))
+
+    def test_explain_changes(self):
+        previous = {'source': 'a', 'backlinks': ['one', 'two'], 'config.tab_size': 2}
+        current = {'source': 'a', 'backlinks': ['two', 'three'], 'config.tab_size': 4}
+        expected_reasons = ['backlinks changed (added: three; removed: one)',
+                            'config.tab_size changed from 2 to 4']
+        self.assertListEqual(expected_reasons, build_state.explain_changes(previous, current))
+        self.assertListEqual([], build_state.explain_changes(current, current))
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.isdir(cls.test_path):
+            shutil.rmtree(cls.test_path)
+
+
+class EventLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_path = make_test_directory()
+        self.test_events_path = os.path.join(self.test_path, 'events.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_path)
+
+    def test_event_log(self):
+        touch(self.test_events_path, '{"event":"earlier"}\n')
+        with event_log.EventLog(self.test_events_path) as events:
+            for i in range(100):
+                events.emit('page', page=f'page-{i}', seconds={'render': 0.5})
+        with open(self.test_events_path, 'r') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(101, len(lines))
+        self.assertEqual({'event': 'earlier'}, lines[0])
+        self.assertEqual(['page-0', 'page-99'], [lines[1]['page'], lines[-1]['page']])
+        self.assertEqual({'event', 'time', 'page', 'seconds'}, set(lines[-1]))
+
+
+class FrontmatterUtilitiesTestCase(unittest.TestCase):
+    def test_parse_flat(self):
+        test_content = '---\ntitle: A title\ndescription: \'It\'\'s quoted\'\n---\n\nThe content\n'
+        expected_output = ({'title': 'A title', 'description': 'It\'s quoted'}, 'The content')
+        self.assertEqual(expected_output, front_matter.parse(test_content))
+
+    def test_parse_flat_skips_yaml(self):
+        self.assertEqual(front_matter.parse_flat_yaml('title: A title\ndescription:'),
+                         {'title': 'A title', 'description': None})
+        for test_fm in ('title: 2021', 'title: yes', 'title: [a, b]', 'title: a # comment',
+                        'tags:\n  - a', 'title: "escaped \\" quote"', 'on: x'):
+            self.assertIsNone(front_matter.parse_flat_yaml(test_fm), test_fm)
+
+    def test_parse_falls_back_to_yaml(self):
+        test_content = '---\ntitle: 2021\ntags:\n  - a\n  - b\n---\nThe content'
+        expected_output = ({'title': 2021, 'tags': ['a', 'b']}, 'The content')
+        self.assertEqual(expected_output, front_matter.parse(test_content))
+
+    def test_parse_no_frontmatter(self):
+        test_content = '{{A link}} and some content\n'
+        self.assertEqual((dict(), '{{A link}} and some content'), front_matter.parse(test_content))
+
+    def test_parse_matches_frontmatter(self):
+        import frontmatter
+        for test_content in ('---\ntitle: A\r\n---\r\nThe content', '---\n---\nThe content',
+                             '--- \ntitle: A:B\n----\nThe content', '---\ntitle: A\nNo closing',
+                             '{\n"title": "JSON"\n}\nThe content', '---\ntitle: \'A\'\' B\'\n---\n'):
+            self.assertEqual(frontmatter.parse(test_content), front_matter.parse(test_content), test_content)
+
+    def test_parse_head_matches_parse(self):
+        for test_content in ('---\ntitle: A\r\n---\r\nThe content', '---\n---\nThe content',
+                             '\n--- \ntitle: A:B\n----\nThe content', 'No front matter',
+                             '---\ntitle: 2021\ntags:\n  - a\n---\nThe content'):
+            metadata, content_start = front_matter.parse_head(test_content.encode())
+            expected_output = front_matter.parse(test_content)
+            self.assertEqual(expected_output, (metadata, test_content[content_start:].strip()), test_content)
+
+    def test_parse_head_needs_full_parse(self):
+        for test_content in ('{\n"title": "JSON"\n}\nThe content', '---\ntitle: A\nNo closing', '  \n'):
+            self.assertIsNone(front_matter.parse_head(test_content.encode()), test_content)
+
+
+class GraphUtilitiesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.filenames = ['a', 'b', 'c', 'd']
+        self.adjacency = graph.make_adjacency(self.filenames, {'a': ['c', 'b', 'b', 'missing'], 'c': ['d']})
+
+    def test_make_adjacency(self):
+        self.assertListEqual(self.adjacency, [[1, 2], [], [3], []])
+
+    def test_delta_encode(self):
+        self.assertListEqual(graph.delta_encode([3, 4, 10]), [3, 1, 6])
+        self.assertListEqual(graph.delta_decode([3, 1, 6]), [3, 4, 10])
+
+    def test_neighbourhood(self):
+        neighbours = graph.make_undirected(self.adjacency)
+        self.assertListEqual(graph.neighbourhood(neighbours, 1, 1), [1, 0])
+        self.assertListEqual(graph.neighbourhood(neighbours, 1, 2), [1, 0, 2])
+        self.assertListEqual(graph.neighbourhood(neighbours, 1, 3), [1, 0, 2, 3])
+        self.assertListEqual(graph.neighbourhood(neighbours, 1, 3, max_nodes=2), [1, 0])
+
+    def test_local_graph_json(self):
+        expected_output = '{"filenames":["c","a","d"],"titles":["C","A","D"],"links":[[0,2],[1,0]]}'
+        actual_output = graph.local_graph_json(graph.encode_strings(self.filenames),
+                                               graph.encode_strings(['A', 'B', 'C', 'D']), self.adjacency, [2, 0, 3])
+        self.assertEqual(expected_output, actual_output)
+
+
+class MarkdownEnginesTestCase(unittest.TestCase):
+    # Everything pages commonly use, which every engine should render the same way
+    test_content = dedent("""\
+        # Heading
+
+        Some *text* with **bold**, `code`, ~~struck~~ and a {{Local Link|file}}.
+
+        * item one
+        * item two
+
+        1. first
+        2. second
+
+        > quote
+
+        ```python
+        def f():
+        \treturn 1
+        ```
+
+        | a | b |
+        | --- | --- |
+        | 1 | 2 |
+
+        A [link](https://example.com), https://example.com and <span class="raw">raw HTML</span>.
+        """)
+
+    @staticmethod
+    def normalize(html: str) -> str:
+        return re.sub(r'>\s+<', '><', html).strip()
+
+    def test_resolve_engine(self):
+        self.assertEqual('marko', markdown.resolve_engine('marko'))
+        with self.assertRaises(RuntimeError):
+            markdown.resolve_engine('nothing')
+
+    def test_engines_match_default(self):
+        expected_output = self.normalize(markdown.get_renderer()(self.test_content))
+        for engine in markdown.ENGINES:
+            if not markdown.is_installed(engine):
+                continue
+            with self.subTest(engine=engine):
+                self.assertEqual(expected_output, self.normalize(markdown.get_renderer(engine)(self.test_content)))
+
+
+class HighlightUtilitiesTestCase(unittest.TestCase):
+    test_html = '<p>Code:</p><pre><code class="language-python">print(&quot;hi&quot;)\n</code></pre>'
+
+    def test_highlight_code_blocks(self):
+        test_cache = dict()
+        test_used_keys = set()
+        actual_output = highlighting.highlight_code_blocks(self.test_html, 'default', test_cache, test_used_keys)
+        self.assertTrue(actual_output.startswith('<p>Code:</p><div class="highlight"><pre>'))
+        self.assertIn('<span class="nb">print</span>', actual_output)
+        self.assertEqual(set(test_cache), test_used_keys)
+
+        # Repeated blocks come from the cache
+        key, = test_cache
+        test_cache[key] = '<div>cached</div>'
+        self.assertEqual('<p>Code:</p><div>cached</div>',
+                         highlighting.highlight_code_blocks(self.test_html, 'default', test_cache))
+
+    def test_highlight_unknown_language(self):
+        test_html = '<pre><code class="language-nothing">code</code></pre>'
+        self.assertEqual(test_html, highlighting.highlight_code_blocks(test_html, 'default', dict()))
+
+    def test_stylesheet(self):
+        self.assertIn('.highlight .k', highlighting.stylesheet('default'))
+        with self.assertRaises(RuntimeError):
+            highlighting.stylesheet('nothing')
+
+
+class SitemapUtilitiesTestCase(unittest.TestCase):
+    def test_make_sitemaps(self):
+        test_entries = [('', time.gmtime(86400)), ('a & b.html', None)]
+        expected_output = {'sitemap.xml': dedent("""\
+            <?xml version="1.0" encoding="UTF-8"?>
+            <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+            <url><loc>https://example.com/</loc><lastmod>1970-01-02T00:00:00Z</lastmod></url>
+            <url><loc>https://example.com/a%20%26%20b.html</loc></url>
+            </urlset>
+            """)}
+        self.assertEqual(expected_output, sitemaps.make_sitemaps('https://example.com/', test_entries))
+
+    def test_url_entry_quotes(self):
+        test_url = 'https://example.com/?page=Don\'t "Panic" & <Relax>'
+        expected_output = '<url><loc>https://example.com/?page=Don&#x27;t &quot;Panic&quot; &amp; &lt;Relax&gt;</loc></url>\n'
+        self.assertEqual(expected_output, sitemaps.url_entry('url', test_url, ''))
+        sitemap = sitemaps.make_sitemaps('https://example.com/wiki\'s', [('Don\'t Panic.html', None)])['sitemap.xml']
+        self.assertIn('<loc>https://example.com/wiki&#x27;s/Don%27t%20Panic.html</loc>', sitemap)
+
+    def test_make_sitemaps_split(self):
+        test_entries = [(f'{i}.html', time.gmtime(i * 86400)) for i in range(1, 6)]
+        url_limit = sitemaps.SITEMAP_URL_LIMIT
+        sitemaps.SITEMAP_URL_LIMIT = 2
+        try:
+            actual_output = sitemaps.make_sitemaps('https://example.com', test_entries)
+        finally:
+            sitemaps.SITEMAP_URL_LIMIT = url_limit
+        self.assertListEqual(['sitemap-1.xml', 'sitemap-2.xml', 'sitemap-3.xml', 'sitemap.xml'], sorted(actual_output))
+        self.assertEqual(2, actual_output['sitemap-1.xml'].count('<url>'))
+        self.assertIn('<sitemap><loc>https://example.com/sitemap-3.xml</loc><lastmod>1970-01-06T00:00:00Z</lastmod></sitemap>',
+                      actual_output['sitemap.xml'])
+
+
+class PreviewUtilitiesTestCase(unittest.TestCase):
+    def test_first_paragraph(self):
+        test_content = '# Heading\n\n```\ncode\n```\n\n| a | b |\n\n{{!Glossary}}\n\nFirst *real*\nparagraph.\n\nSecond.'
+        self.assertEqual('First *real*\nparagraph.', previews.first_paragraph(test_content))
+        self.assertEqual('', previews.first_paragraph('# Only a heading'))
+
+    def test_preview_json(self):
+        expected_output = '{"title":"Cats","description":"","excerpt":"' + 'word ' * 59 + 'word\\u2026"}'
+        self.assertEqual(expected_output, previews.preview_json('Cats', '', 'word ' * 100))
+
+    def test_add_script(self):
+        script = '<script src="preview.js" defer></script>'
+        self.assertEqual(f'<html><head><title></title>{script}</head><body></body></html>',
+                         previews.add_script('<html><head><title></title></head><body></body></html>'))
+        self.assertEqual(f'<main>{{{{content}}}}</main>{script}', previews.add_script('<main>{{content}}</main>'))
+
 
 class InitTestCase(unittest.TestCase):
     @classmethod
@@ -153,6 +528,59 @@ class InitTestCase(unittest.TestCase):
         self.assertEqual(test_config.get('tab_size'), 2)
         self.assertEqual(test_config.get('new_item'), '123abc')
 
+    def test_update_config_types(self):
+        # SET UP
+        swiki_folder = os.path.join(self.test_path, '_swiki')
+        os.mkdir(swiki_folder)
+        test_config_fp = os.path.join(swiki_folder, 'config.ini')
+        touch(test_config_fp, '# Comment\nrecent_list = False\n\ngraph = yes\nsite_url = https://example.com/a=b\n')
+
+        # TEST
+        test_config = {'recent_list': True, 'graph': False}
+        swiki.update_config(test_config, test_config_fp)
+        self.assertEqual({'recent_list': False, 'graph': True, 'site_url': 'https://example.com/a=b'}, test_config)
+
+    def test_update_config_invalid(self):
+        # SET UP
+        swiki_folder = os.path.join(self.test_path, '_swiki')
+        os.mkdir(swiki_folder)
+        test_config_fp = os.path.join(swiki_folder, 'config.ini')
+
+        # TEST
+        for content in ('tab_size = four', 'graph = maybe', 'output_layout = deep', 'jobs = 0', 'tab_size 4'):
+            with self.subTest(content=content):
+                with open(test_config_fp, 'w') as f:
+                    f.write(content)
+                with self.assertRaises(RuntimeError):
+                    swiki.update_config(dict(), test_config_fp)
+        with open(test_config_fp, 'w') as f:
+            f.write('tab_sise = 4')
+        with self.assertLogs('check_settings', logging.WARNING):
+            swiki.update_config(dict(), test_config_fp)
+
+    def test_load_config(self):
+        # SET UP
+        swiki_folder = os.path.join(self.test_path, '_swiki')
+        os.mkdir(swiki_folder)
+        touch(os.path.join(swiki_folder, 'config.ini'), 'tab_size = 4\ngraph = true\nrecent_list_length = 5')
+
+        # TEST
+        settings = {'tab_size': 8, 'jobs': 2, 'recent_list_length': '20'}
+        with mock.patch.dict(os.environ, {'SWIKI_GRAPH': 'off', 'SWIKI_RECENT_LIST_LENGTH': '6'}):
+            config = swiki.load_config(self.test_path, settings, {'recent_list_length': 7})
+        self.assertEqual((4, 2, False, 7, 'flat'), (config['tab_size'], config['jobs'], config['graph'],
+                                                    config['recent_list_length'], config['output_layout']))
+        with mock.patch.dict(os.environ, {'SWIKI_JOBS': 'many'}):
+            with self.assertRaises(RuntimeError):
+                swiki.load_config(self.test_path, dict())
+
+    def test_config_fingerprint(self):
+        config = swiki.load_config(self.test_path, dict())
+        fingerprint = swiki.config_fingerprint(config)
+        self.assertEqual(fingerprint, swiki.config_fingerprint({**config, 'jobs': 1, 'max_memory': 64}))
+        self.assertNotEqual(fingerprint, swiki.config_fingerprint({**config, 'tab_size': 4}))
+        self.assertNotEqual(fingerprint, swiki.config_fingerprint({**config, 'output_layout': 'hashed'}))
+
     @classmethod
     def tearDownClass(cls):
         if os.path.isdir(cls.test_path):
@@ -494,6 +922,40 @@ class SitemapTestCase(unittest.TestCase):
         self.assertDictEqual(test_sitemap, result_sitemap)
 
 
+class ExpandTransclusionsTestCase(unittest.TestCase):
+    def make_pages(self, contents: dict) -> dict:
+        return {link.kebabify(title): {'folder': '', 'metadata': {'title': title}, 'content': content}
+                for title, content in contents.items()}
+
+    def test_nested(self):
+        pages = self.make_pages({'Page': 'Intro {{!Snippet}} end', 'Snippet': 'snip {{!Inner}}',
+                                 'Inner': 'inner', 'Plain': 'plain {{Snippet}}'})
+        swiki.expand_transclusions(pages, 10)
+        self.assertEqual(pages['page']['expanded_content'], 'Intro snip inner end')
+        self.assertListEqual(pages['page']['transclusions'], ['inner', 'snippet'])
+        self.assertEqual(pages['snippet']['expanded_content'], 'snip inner')
+        self.assertNotIn('expanded_content', pages['plain'])
+
+    def test_missing(self):
+        pages = self.make_pages({'Page': 'See {{!Missing Page}}.'})
+        swiki.expand_transclusions(pages, 10)
+        self.assertNotIn('expanded_content', pages['page'])
+
+    def test_cycle(self):
+        pages = self.make_pages({'A': '{{!B}}', 'B': '{{!C}}', 'C': '{{!A}}'})
+        with self.assertRaises(RuntimeError) as e:
+            swiki.expand_transclusions(pages, 10)
+        self.assertEqual(str(e.exception), 'Transclusion cycle: "A" -> "B" -> "C" -> "A".')
+
+    def test_depth_limit(self):
+        pages = self.make_pages({'A': '{{!B}}', 'B': '{{!C}}', 'C': '{{!D}}', 'D': 'd'})
+        swiki.expand_transclusions(pages, 3)
+        self.assertEqual(pages['a']['expanded_content'], 'd')
+        pages = self.make_pages({'D': 'd', 'C': '{{!D}}', 'B': '{{!C}}', 'A': '{{!B}}'})
+        with self.assertRaises(RuntimeError):
+            swiki.expand_transclusions(pages, 2)
+
+
 class FillFrameTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -551,6 +1013,28 @@ class FillFrameTestCase(unittest.TestCase):
                 </body>
             </html>"""))
 
+    def test_split_chunks(self):
+        test_text = 'one\ntwo\nthree'
+        self.assertListEqual(['one\n', 'two\n', 'three'], list(swiki.split_chunks(test_text, 1)))
+        self.assertListEqual([test_text], list(swiki.split_chunks(test_text)))
+
+    def test_stream_frame_matches_fill_frame(self):
+        test_page = {'metadata': {'title': 'Big Page', 'description': 'Big',
+                                  'last_modified': time.gmtime(86400)},
+                     'content': 'A {{local link}}\n\n\tIndented code\n\nAn <a href="https://example.com">external link</a>',
+                     'backlinks': [{'title': 'Other', 'filename': 'other'}]}
+        expected_output = swiki.fill_frame(self.test_frame, swiki.prepare_page_for_file(
+            dict(test_page), 'big-page', 2), test_page['metadata'])
+        chunks = swiki.stream_page_for_file(dict(test_page), 'big-page', 2)
+        actual_output = ''.join(swiki.stream_frame(self.test_frame, chunks, test_page['metadata']))
+        self.assertEqual(expected_output, actual_output)
+
+        test_frame = '{{content}}<hr>{{content}}'
+        content = ''.join(swiki.stream_page_for_file(dict(test_page), 'big-page', 2))
+        chunks = swiki.stream_page_for_file(dict(test_page), 'big-page', 2)
+        self.assertEqual(swiki.fill_frame(test_frame, content, test_page['metadata']),
+                         ''.join(swiki.stream_frame(test_frame, chunks, test_page['metadata'])))
+
 
 class MakeSitemapTestCase(unittest.TestCase):
     @classmethod
@@ -801,6 +1285,59 @@ class MakeWikiTestCase(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             swiki.make_wiki(self.test_input_folder, self.test_output_folder, self.test_config)
 
+    def test_all_conflicts(self):
+        # SET UP
+        touch(os.path.join(self.test_input_folder, 'test_duplicate.md'), '---\ntitle: Example File\n---\n')
+        test_folder = os.path.join(self.test_input_folder, 'folder')
+        os.mkdir(test_folder)
+        touch(os.path.join(test_folder, 'another_duplicate.md'), '---\ntitle: Another File\n---\n')
+        touch(os.path.join(self.test_input_folder, 'file_1.txt'), 'test')
+        touch(os.path.join(test_folder, 'file_1.txt'), 'test')
+        touch(os.path.join(test_folder, 'example-file.html'), 'test')
+
+        # TESTS
+        with self.assertRaises(RuntimeError) as e:
+            swiki.make_wiki(self.test_input_folder, self.test_output_folder, self.test_config)
+        expected_conflicts = [
+            'Page "Example File" with filename "example-file" conflicts with page "Example File" with filename "example-file".',
+            'Page "folder/Another File" with filename "another-file" conflicts with page "Another File" with filename "another-file".',
+            'File "folder/example-file.html" conflicts with page "Example File" with filename "example-file".',
+            'File "folder/file_1.txt" conflicts with file "file_1.txt".',
+        ]
+        self.assertEqual(expected_conflicts, str(e.exception).splitlines())
+        # Nothing is written before conflicts are found
+        self.assertEqual([], os.listdir(self.test_output_folder))
+
+    def test_check_wiki(self):
+        # SET UP
+        long_title = 'Long ' * 50
+        touch(os.path.join(self.test_input_folder, 'long_1.md'), f'---\ntitle: {long_title}One\n---\n')
+        touch(os.path.join(self.test_input_folder, 'long_2.md'), f'---\ntitle: {long_title}Two\n---\n')
+        touch(os.path.join(self.test_input_folder, 'index.md'), 'No title')
+
+        # TESTS
+        conflicts, warnings = swiki.check_wiki(self.test_input_folder)
+        self.assertEqual(1, len(conflicts))
+        self.assertTrue(conflicts[0].endswith('Titles are cut to 200 characters for filenames.'))
+        self.assertIn('Page "index" has filename "index_" because "index" is reserved.', warnings)
+        self.assertEqual(3, len(warnings))
+        self.assertEqual([], os.listdir(self.test_output_folder))
+
+    def test_check_wiki_generated_files(self):
+        # SET UP
+        test_folder = os.path.join(self.test_input_folder, 'folder')
+        os.mkdir(test_folder)
+        touch(os.path.join(self.test_input_folder, 'sitemap.xml'), 'test')
+        touch(os.path.join(test_folder, 'graph.json'), 'test')
+        touch(os.path.join(self.test_input_folder, 'sitemap-1.xml'), 'test')
+        touch(os.path.join(self.test_input_folder, 'robots.txt'), 'test')
+
+        # TESTS
+        conflicts, _ = swiki.check_wiki(self.test_input_folder)
+        self.assertEqual(['File "folder/graph.json" conflicts with the generated file "graph.json".',
+                          'File "sitemap-1.xml" conflicts with the generated file "sitemap-1.xml".',
+                          'File "sitemap.xml" conflicts with the generated file "sitemap.xml".'], sorted(conflicts))
+
     def test_index(self):
         # SET UP
         test_index_file_path = os.path.join(self.test_input_folder, '_swiki', 'index.md')
@@ -867,5 +1404,610 @@ class MakeWikiTestCase(unittest.TestCase):
             shutil.rmtree(cls.test_path)
 
 
+
+class BuildCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_path = make_test_directory()
+        self.test_input_folder = os.path.join(self.test_path, 'input')
+        os.makedirs(os.path.join(self.test_input_folder, '_swiki'))
+        touch(os.path.join(self.test_input_folder, '_swiki', 'frame.html'), '{{content}}')
+        self.test_file_path = os.path.join(self.test_input_folder, 'test.md')
+        touch(self.test_file_path, '---\ntitle: Example File\n---\n\nLinks to {{Another File}}.')
+        touch(os.path.join(self.test_input_folder, 'another_test.md'), '---\ntitle: Another File\n---\n\nSome content.')
+        self.test_output_folder = os.path.join(self.test_path, 'output')
+        os.mkdir(self.test_output_folder)
+        self.test_config = {'tab_size': 2, 'recent_list': False, 'recent_list_length': 10}
+
+    def tearDown(self):
+        shutil.rmtree(self.test_path)
+
+    def test_rebuild_uses_cache(self):
+        cache = swiki.new_build_cache()
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder, self.test_config, cache)
+        self.assertEqual(len(cache['sources']), 2)
+        another_file_path = os.path.join(self.test_output_folder, 'another-file.html')
+        another_file_mtime = os.stat(another_file_path).st_mtime_ns
+
+        # Rewrite one page; only the changed output should be rewritten
+        os.remove(self.test_file_path)
+        touch(self.test_file_path, '---\ntitle: Example File\n---\n\nNew content.')
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder, self.test_config, cache)
+        with open(os.path.join(self.test_output_folder, 'example-file.html'), 'r') as f:
+            self.assertIn('New content.', f.read())
+        self.assertNotEqual(another_file_mtime, os.stat(another_file_path).st_mtime_ns)
+        with open(another_file_path, 'r') as f:
+            self.assertNotIn('backlinks', f.read())
+
+    def test_rebuild_trusts_changed_paths(self):
+        cache = swiki.new_build_cache()
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder, self.test_config, cache)
+        cached_page = cache['sources'][self.test_file_path][1]
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder, self.test_config, cache,
+                        changed_paths=set())
+        self.assertIs(cached_page, cache['sources'][self.test_file_path][1])
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder, self.test_config, cache,
+                        changed_paths={self.test_file_path})
+        self.assertIsNot(cached_page, cache['sources'][self.test_file_path][1])
+
+    def test_unchanged_output_not_rewritten(self):
+        cache = swiki.new_build_cache()
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder, self.test_config, cache)
+        test_file_path = os.path.join(self.test_output_folder, 'example-file.html')
+        os.utime(test_file_path, ns=(0, 0))
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder, self.test_config, cache)
+        self.assertEqual(os.stat(test_file_path).st_mtime_ns, 0)
+        os.remove(test_file_path)
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder, self.test_config, cache)
+        self.assertTrue(os.path.isfile(test_file_path))
+
+
+class TwoPageWikiTestCase(unittest.TestCase):
+    """ Builds a wiki of two pages, one linking to the other, with incremental builds on """
+    def setUp(self):
+        self.test_path = make_test_directory()
+        self.test_input_folder = os.path.join(self.test_path, 'input')
+        os.makedirs(os.path.join(self.test_input_folder, '_swiki'))
+        self.test_frame_path = os.path.join(self.test_input_folder, '_swiki', 'frame.html')
+        touch(self.test_frame_path, '{{content}}')
+        touch(os.path.join(self.test_input_folder, 'test.md'), '---\ntitle: Example File\n---\n\nLinks to {{Another File}}.')
+        touch(os.path.join(self.test_input_folder, 'another_test.md'), '---\ntitle: Another File\n---\n\nSome content.')
+        self.test_output_folder = os.path.join(self.test_path, 'output')
+        os.mkdir(self.test_output_folder)
+        self.test_config = {'tab_size': 2, 'recent_list': False, 'recent_list_length': 10, 'incremental': True}
+
+    def tearDown(self):
+        shutil.rmtree(self.test_path)
+
+    def build(self, cache: dict = None, output_folder: str = None, **config):
+        """ Build the wiki with these settings on top of test_config """
+        swiki.make_wiki(self.test_input_folder, output_folder or self.test_output_folder,
+                        {**self.test_config, **config}, cache)
+
+    def edit_page(self, file: str, content: str):
+        """ Append content to a page """
+        touch(os.path.join(self.test_input_folder, file), content)
+
+    def read_output(self, file: str) -> str:
+        with open(os.path.join(self.test_output_folder, file), 'r') as f:
+            return f.read()
+
+    def read_outputs(self, output_folder: str = None) -> dict:
+        """ Every output file but build state, as {path in output folder: content} """
+        output_folder = output_folder or self.test_output_folder
+        outputs = dict()
+        for subfolder, _, files in os.walk(output_folder):
+            for file in files:
+                if not file.startswith('.swiki-'):
+                    with open(os.path.join(subfolder, file), 'r') as f:
+                        outputs[os.path.relpath(os.path.join(subfolder, file), output_folder)] = f.read()
+        return outputs
+
+    def age_outputs(self, *files: str):
+        """ Set output files' modified time to 0, so a build that rewrites them shows """
+        for file in files:
+            os.utime(os.path.join(self.test_output_folder, file), ns=(0, 0))
+
+    def assertRebuilt(self, file: str):
+        self.assertNotEqual(0, os.stat(os.path.join(self.test_output_folder, file)).st_mtime_ns, f'{file} not rebuilt')
+
+    def assertNotRebuilt(self, file: str):
+        self.assertEqual(0, os.stat(os.path.join(self.test_output_folder, file)).st_mtime_ns, f'{file} rebuilt')
+
+    def assertSameOutputs(self, **config):
+        """ Building into an empty folder with these settings writes what the last build wrote """
+        another_output_folder = os.path.join(self.test_path, 'another_output')
+        os.mkdir(another_output_folder)
+        self.build(output_folder=another_output_folder, **config)
+        self.assertEqual(self.read_outputs(), self.read_outputs(another_output_folder))
+
+
+class IncrementalBuildTestCase(TwoPageWikiTestCase):
+    def test_skips_unchanged_pages(self):
+        self.build()
+        self.age_outputs('example-file.html', 'another-file.html')
+        touch(os.path.join(self.test_input_folder, '_swiki', 'style.css'), 'body { color: blue; }')
+        self.edit_page('another_test.md', ' More content.')
+        self.build()
+        self.assertNotRebuilt('example-file.html')
+        self.assertRebuilt('another-file.html')
+
+    def test_rebuilds_transcluding_pages(self):
+        self.edit_page('snippet.md', '---\ntitle: Snippet\n---\n\nShared text.')
+        self.edit_page('test.md', ' {{!Snippet}}')
+        self.build()
+        self.age_outputs('example-file.html', 'another-file.html')
+        self.edit_page('snippet.md', ' Edited.')
+        self.assertIn('transcluded_content changed', swiki.explain_page(
+            self.test_input_folder, self.test_output_folder, self.test_config, 'Example File'))
+        self.build()
+        self.assertIn('Shared text. Edited.', self.read_output('example-file.html'))
+        self.assertNotRebuilt('another-file.html')
+
+    def test_explain_page(self):
+        self.build()
+        self.assertListEqual([], swiki.explain_page(self.test_input_folder, self.test_output_folder,
+                                                    self.test_config, 'Example File'))
+        touch(self.test_frame_path, '<hr>')
+        self.assertListEqual(['frame changed'], swiki.explain_page(
+            self.test_input_folder, self.test_output_folder, self.test_config, 'example-file'))
+        with self.assertRaises(ValueError):
+            swiki.explain_page(self.test_input_folder, self.test_output_folder, self.test_config, 'Nothing')
+
+    def test_backlink_context(self):
+        cache = swiki.new_build_cache()
+        self.build(cache, backlink_context=40)
+        self.assertIn('<a href="example-file.html">Example File</a><p class="backlink-context">Links to Another File.</p>',
+                      self.read_output('another-file.html'))
+        self.age_outputs('another-file.html')
+
+        # Only text around the link changes what the linked page shows
+        self.edit_page('test.md', '\n\nUnrelated.')
+        self.build(cache, backlink_context=40)
+        self.assertNotRebuilt('another-file.html')
+        self.edit_page('test.md', ' Also {{Another File}} again.')
+        self.build(cache, backlink_context=40)
+        self.assertIn('<p class="backlink-context">Also Another File again.</p>', self.read_output('another-file.html'))
+
+        # Cached pages are parsed again without contexts
+        self.build(cache)
+        self.assertNotIn('backlink-context', self.read_output('another-file.html'))
+
+    def test_hashed_assets(self):
+        def hashed_name(name: str, content: bytes) -> str:
+            return f'{name}.{hashlib.sha256(content).hexdigest()[:10]}.png'
+
+        touch(self.test_frame_path, '<link href="main.css">{{content}}')
+        touch(os.path.join(self.test_input_folder, '_swiki', 'main.css'), 'body { background: url(dog.png); }')
+        touch(os.path.join(self.test_input_folder, 'dog.png'), 'woof')
+        touch(os.path.join(self.test_input_folder, 'cat.png'), 'meow')
+        self.edit_page('another_test.md', ' ![Cat](cat.png)')
+        self.build(hashed_assets=True)
+        css_files = [file for file in os.listdir(self.test_output_folder) if file.endswith('.css')]
+        self.assertRegex(''.join(css_files), r'^main\.[0-9a-f]{10}\.css$')
+        self.assertEqual(f'body {{ background: url({hashed_name("dog", b"woof")}); }}', self.read_output(css_files[0]))
+        self.assertIn(f'src="{hashed_name("cat", b"meow")}"', self.read_output('another-file.html'))
+        self.age_outputs('example-file.html')
+
+        # Changing an image renames it, removes its old copy and rebuilds only the page showing it
+        touch(os.path.join(self.test_input_folder, 'cat.png'), ' purr')
+        self.assertEqual(['assets changed'], swiki.explain_page(
+            self.test_input_folder, self.test_output_folder, {**self.test_config, 'hashed_assets': True}, 'Another File'))
+        self.build(hashed_assets=True)
+        self.assertFalse(os.path.isfile(os.path.join(self.test_output_folder, hashed_name('cat', b'meow'))))
+        self.assertIn(f'src="{hashed_name("cat", b"meow purr")}"', self.read_output('another-file.html'))
+        self.assertNotRebuilt('example-file.html')
+
+        # Changing an image the CSS uses renames the CSS too, and so every page linking it
+        touch(os.path.join(self.test_input_folder, 'dog.png'), ' bark')
+        self.build(hashed_assets=True)
+        self.assertFalse(os.path.isfile(os.path.join(self.test_output_folder, css_files[0])))
+        self.assertNotIn(css_files[0], self.read_output('example-file.html'))
+        self.assertRebuilt('example-file.html')
+
+    def test_sitemap_removes_stale_parts(self):
+        with mock.patch.object(sitemaps, 'SITEMAP_URL_LIMIT', 2):
+            self.build(site_url='https://example.com')
+        self.assertTrue(os.path.isfile(os.path.join(self.test_output_folder, 'sitemap-2.xml')))
+        self.build(site_url='https://example.com')
+        self.assertEqual(['sitemap.xml'], sorted(file for file in os.listdir(self.test_output_folder) if 'sitemap' in file))
+
+        with mock.patch.object(sitemaps, 'SITEMAP_URL_LIMIT', 2):
+            self.build(site_url='https://example.com')
+        swiki.delete_current_html(self.test_output_folder)
+        self.assertFalse(os.path.isfile(os.path.join(self.test_output_folder, 'sitemap-1.xml')))
+
+
+class SameOutputTestCase(TwoPageWikiTestCase):
+    """ Ways of building that must not change what is built """
+    def setUp(self):
+        super().setUp()
+        self.edit_page('snippet.md', '---\ntitle: Snippet\n---\n\nShared text.')
+        self.edit_page('test.md', ' {{!Snippet}} {{A Stub}}')
+        self.test_config.update({'recent_list': True, 'graph': True, 'previews': True, 'site_url': 'https://example.com'})
+
+    def test_large_pages(self):
+        self.build()
+        self.assertSameOutputs(large_file_size=0)
+
+    def test_max_memory(self):
+        # Enough pages that most page records are kept on disk
+        for i in range(600):
+            self.edit_page(f'page_{i}.md', f'---\ntitle: Page {i}\n---\n\nLinks to {{{{Page {(i + 1) % 700}}}}} and {{{{Example File}}}}.')
+        self.build()
+        with self.assertLogs('make_wiki', logging.INFO) as logs:
+            self.assertSameOutputs(max_memory=1)
+        self.assertTrue(any('keeping it on disk' in line for line in logs.output))
+
+    def test_reproducible(self):
+        self.test_config.update({'reproducible': True, 'source_date_epoch': 86400})
+        self.build()
+        self.assertIn('Last modified: 197001020000', self.read_output('example-file.html'))
+        self.assertEqual(build_state.file_sha256(os.path.join(self.test_output_folder, 'example-file.html')),
+                         build_state.load_state(self.test_output_folder)['manifest']['example-file.html'][2])
+        os.utime(os.path.join(self.test_input_folder, 'test.md'), (2 * 86400, 2 * 86400))
+        self.assertSameOutputs()
+
+
+class PageIdsTestCase(TwoPageWikiTestCase):
+    def test_page_ids(self):
+        with open(os.path.join(self.test_input_folder, 'another_test.md'), 'w') as f:
+            f.write('---\ntitle: Another File\nid: 42\n---\n\nSome content.')
+        self.build(page_ids=True)
+        self.assertIn('href="42.html"', self.read_output('example-file.html'))
+
+        # Renaming the page keeps its URL
+        with open(os.path.join(self.test_input_folder, 'another_test.md'), 'w') as f:
+            f.write('---\ntitle: Renamed File\nid: 42\n---\n\nSome content.')
+        self.edit_page('test.md', ' And {{Renamed File}}.')
+        self.build(page_ids=True)
+        self.assertIn('<h1 id="title">Renamed File</h1>', self.read_output('42.html'))
+        self.assertIn('href="42.html">Renamed File</a>', self.read_output('example-file.html'))
+
+        # Two pages can't share an id
+        with open(os.path.join(self.test_input_folder, 'test.md'), 'w') as f:
+            f.write('---\ntitle: Example File\nid: 42\n---\n\nSome content.')
+        with self.assertRaises(RuntimeError):
+            self.build(page_ids=True)
+
+
+class BuildEventLogTestCase(TwoPageWikiTestCase):
+    def test_event_log(self):
+        test_events_path = os.path.join(self.test_path, 'events.jsonl')
+        self.build(event_log=test_events_path)
+        self.edit_page('another_test.md', ' More content.')
+        self.build(event_log=test_events_path)
+        with open(test_events_path, 'r') as f:
+            events = [json.loads(line) for line in f]
+
+        self.assertEqual(['page', 'page', 'build'] * 2, [event['event'] for event in events])
+        pages = {(event['page'], event['action']): event for event in events[3:5]}
+        self.assertEqual(['source'], pages[('another-file', 'rendered')]['reasons'])
+        self.assertIn(('example-file', 'skipped'), pages)
+        self.assertEqual(['new_output'], events[0]['reasons'])
+        self.assertEqual(len('Some content. More content.'), pages[('another-file', 'rendered')]['bytes_in'])
+        with open(os.path.join(self.test_output_folder, 'another-file.html'), 'rb') as f:
+            self.assertEqual(len(f.read()), pages[('another-file', 'rendered')]['bytes_out'])
+        summary = events[-1]
+        self.assertEqual((2, 1, 1), (summary['pages'], summary['rendered'], summary['skipped']))
+        self.assertEqual(['parse', 'pages', 'index', 'data', 'write', 'finish'], list(summary['phases']))
+
+        # A failed build still closes the log
+        with self.assertRaises(RuntimeError):
+            self.build(event_log=test_events_path, highlight_style='unknown')
+        self.assertNotIn('event-log', [thread.name for thread in threading.enumerate()])
+
+
+@unittest.skipUnless(shutil.which('git'), 'git is not installed')
+class GitHistoryTestCase(TwoPageWikiTestCase):
+    def run_git(self, *args):
+        subprocess.run(['git', '-C', self.test_input_folder, '-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                        *args], check=True, capture_output=True, env={**os.environ, 'GIT_COMMITTER_DATE': '@86400 +0000'})
+
+    def test_git_history(self):
+        self.run_git('init')
+        self.run_git('add', '.')
+        self.run_git('commit', '-m', 'Add pages')
+        commit = git.head_commit(self.test_input_folder)
+        self.assertEqual(set(), git.changed_files(self.test_input_folder, commit))
+        self.assertEqual({'test.md': 86400, 'another_test.md': 86400},
+                         git.last_commit_times(self.test_input_folder, {'test.md', 'another_test.md', 'missing.md'}))
+
+        self.test_config['git'] = True
+        self.build()
+        self.assertIn('Last modified: 197001020000', self.read_output('example-file.html'))
+        state = build_state.load_state(self.test_output_folder)
+        self.assertEqual((commit, True), (state['git_commit'], state['git_clean']))
+
+        self.edit_page('test.md', ' Edited.')
+        self.edit_page('new.md', 'New page.')
+        self.assertEqual({'test.md', 'new.md'}, git.changed_files(self.test_input_folder, commit))
+        self.build()
+        self.assertNotIn('Last modified: 197001020000', self.read_output('example-file.html'))
+        self.assertFalse(build_state.load_state(self.test_output_folder)['git_clean'])
+
+    def test_git_changed_pages(self):
+        self.run_git('init')
+        self.run_git('add', '.')
+        self.run_git('commit', '-m', 'Add pages')
+        self.test_config['git'] = True
+        self.build()
+
+        def fresh_checkout_build(mtime_ns: int) -> list:
+            # Every file gets a new mtime, so only git can tell which pages changed
+            for file in ('test.md', 'another_test.md'):
+                os.utime(os.path.join(self.test_input_folder, file), ns=(mtime_ns, mtime_ns))
+            with mock.patch.object(swiki, 'make_page_dict', wraps=swiki.make_page_dict) as make_page_dict:
+                self.build()
+            return sorted(call.args[2] for call in make_page_dict.call_args_list)
+
+        self.edit_page('another_test.md', ' More content.')
+        self.run_git('commit', '-am', 'Edit a page')
+        self.assertEqual(['another_test.md'], fresh_checkout_build(2 * 10 ** 18))
+        self.assertIn('Some content. More content.', self.read_output('another-file.html'))
+
+        # Without the last build's commit, as in a shallow clone, every page is read again
+        state = build_state.load_state(self.test_output_folder)
+        build_state.save_state(self.test_output_folder, {**state, 'git_commit': '0' * 40})
+        self.assertEqual(['another_test.md', 'test.md'], fresh_checkout_build(3 * 10 ** 18))
+
+
+class StagedBuildTestCase(TwoPageWikiTestCase):
+    def test_staged(self):
+        swiki.make_wiki_staged(self.test_input_folder, self.test_output_folder, self.test_config)
+        test_file_path = os.path.join(self.test_output_folder, 'example-file.html')
+        another_file_path = os.path.join(self.test_output_folder, 'another-file.html')
+        test_file_inode = os.stat(test_file_path).st_ino
+        # A web server may still be reading the previous build's files
+        served_file_path = os.path.join(self.test_path, 'served.html')
+        os.link(another_file_path, served_file_path)
+        self.edit_page('another_test.md', ' More content.')
+
+        swiki.make_wiki_staged(self.test_input_folder, self.test_output_folder, self.test_config)
+        # Unchanged outputs are reused, changed ones are new files
+        self.assertEqual(test_file_inode, os.stat(test_file_path).st_ino)
+        with open(another_file_path, 'r') as f:
+            self.assertIn('More content.', f.read())
+        with open(served_file_path, 'r') as f:
+            self.assertNotIn('More content.', f.read())
+        self.assertEqual(['input', 'output', 'served.html'], sorted(os.listdir(self.test_path)))
+
+    def test_staged_symlink(self):
+        output_link = os.path.join(self.test_path, 'site')
+        os.symlink('output', output_link)
+        swiki.make_wiki_staged(self.test_input_folder, output_link, self.test_config)
+        first_build = os.readlink(output_link)
+        self.assertTrue(first_build.startswith('.site.swiki-'))
+        self.assertTrue(os.path.isfile(os.path.join(output_link, 'example-file.html')))
+        # The folder the link pointed to first isn't one of the builds, so it is kept
+        self.assertTrue(os.path.isdir(self.test_output_folder))
+
+        swiki.make_wiki_staged(self.test_input_folder, output_link, self.test_config)
+        self.assertNotEqual(first_build, os.readlink(output_link))
+        self.assertFalse(os.path.exists(os.path.join(self.test_path, first_build)))
+
+    def test_staged_failure(self):
+        swiki.make_wiki_staged(self.test_input_folder, self.test_output_folder, self.test_config)
+        outputs = sorted(os.listdir(self.test_output_folder))
+        self.edit_page('duplicate.md', '---\ntitle: Example File\n---\n')
+        with self.assertRaises(RuntimeError):
+            swiki.make_wiki_staged(self.test_input_folder, self.test_output_folder, self.test_config,
+                                   delete_html=True)
+        self.assertEqual(outputs, sorted(os.listdir(self.test_output_folder)))
+        self.assertEqual(['input', 'output'], sorted(os.listdir(self.test_path)))
+
+
+class BatchBuildTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_path = make_test_directory()
+        for wiki in ('small', 'large'):
+            input_folder = os.path.join(self.test_path, wiki)
+            os.makedirs(os.path.join(input_folder, '_swiki'))
+            touch(os.path.join(input_folder, '_swiki', 'frame.html'), f'{wiki}: {{{{content}}}}')
+            touch(os.path.join(input_folder, 'shared.md'), '---\ntitle: Shared\n---\n\nThe same *text*.')
+        touch(os.path.join(self.test_path, 'large', 'large.md'), '---\ntitle: Large\n---\n\n' + 'Text. ' * 1000)
+        touch(os.path.join(self.test_path, 'large', '_swiki', 'config.ini'), 'tab_size = 4')
+        self.test_manifest_path = os.path.join(self.test_path, 'wikis.json')
+        touch(self.test_manifest_path, json.dumps([{'input': 'small', 'output': 'out/small'},
+                                                   {'input': 'large', 'output': 'out/large'},
+                                                   {'input': 'missing', 'output': 'out/missing'}]))
+        os.mkdir(os.path.join(self.test_path, 'out'))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_path)
+
+    def test_load_batch_manifest(self):
+        expected_wikis = [(os.path.join(self.test_path, 'small'), os.path.join(self.test_path, 'out/small')),
+                          (os.path.join(self.test_path, 'large'), os.path.join(self.test_path, 'out/large')),
+                          (os.path.join(self.test_path, 'missing'), os.path.join(self.test_path, 'out/missing'))]
+        self.assertEqual(expected_wikis, swiki.load_batch_manifest(self.test_manifest_path))
+        touch(self.test_manifest_path, '[')
+        with self.assertRaises(RuntimeError):
+            swiki.load_batch_manifest(self.test_manifest_path)
+
+    def test_build_wikis(self):
+        wikis = swiki.load_batch_manifest(self.test_manifest_path)
+        results = swiki.build_wikis(wikis, {'jobs': 2}, workers=2)
+        self.assertEqual([None, None, f'Input folder not found: {wikis[2][0]}'], [error for *_, error in results])
+        for wiki in ('small', 'large'):
+            with open(os.path.join(self.test_path, 'out', wiki, 'shared.html'), 'r') as f:
+                self.assertTrue(f.read().startswith(f'{wiki}: '))
+        self.assertTrue(os.path.isfile(os.path.join(self.test_path, 'out', 'large', 'large.html')))
+
+    def test_build_wikis_same_input(self):
+        # The same wiki built twice, once to an output that can't be written
+        small = os.path.join(self.test_path, 'small')
+        touch(os.path.join(self.test_path, 'out', 'file'), 'Not a folder')
+        wikis = [(small, os.path.join(self.test_path, 'out', 'flat')),
+                 (small, os.path.join(self.test_path, 'out', 'file', 'small'))]
+        results = swiki.build_wikis(wikis, {'jobs': 2}, workers=2)
+        self.assertEqual(wikis, [(input_dir, output_dir) for input_dir, output_dir, _ in results])
+        self.assertIsNone(results[0][2])
+        self.assertIsNotNone(results[1][2])
+
+    def test_shared_cache(self):
+        shared = swiki.new_shared_cache()
+        for wiki in ('small', 'large'):
+            swiki.make_wiki(os.path.join(self.test_path, wiki), os.path.join(self.test_path, 'out'),
+                            {'tab_size': 2, 'recent_list_length': 10}, swiki.new_build_cache(shared))
+        # The shared page is rendered once for both wikis
+        self.assertEqual(2, len(shared['renders']))
+
+
+class OutputLayoutTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_path = make_test_directory()
+        self.test_input_folder = os.path.join(self.test_path, 'input')
+        os.makedirs(os.path.join(self.test_input_folder, '_swiki'))
+        os.makedirs(os.path.join(self.test_input_folder, 'Big Docs'))
+        touch(os.path.join(self.test_input_folder, '_swiki', 'frame.html'), '<link href="main.css">{{content}}')
+        touch(os.path.join(self.test_input_folder, 'test.md'),
+              '---\ntitle: Example File\n---\n\nLinks to {{Another File}} and {{Missing}}. ![Cat](cat.png)')
+        touch(os.path.join(self.test_input_folder, 'Big Docs', 'another_test.md'),
+              '---\ntitle: Another File\n---\n\nText.')
+        touch(os.path.join(self.test_input_folder, 'cat.png'))
+        self.test_output_folder = os.path.join(self.test_path, 'output')
+        os.mkdir(self.test_output_folder)
+        self.test_config = {'tab_size': 2, 'recent_list': True, 'recent_list_length': 10, 'incremental': True,
+                            'site_url': 'https://example.com'}
+
+    def tearDown(self):
+        shutil.rmtree(self.test_path)
+
+    def read_output(self, path: str) -> str:
+        with open(os.path.join(self.test_output_folder, path), 'r') as f:
+            return f.read()
+
+    def test_hashed(self):
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder, {**self.test_config, 'output_layout': 'hashed'})
+        page_path = swiki.make_page_path(dict(), 'hashed')
+        example_path, another_path = page_path('example-file'), page_path('another-file')
+        self.assertEqual(f'{hashlib.sha1(b"example-file").hexdigest()[:2]}/example-file.html', example_path)
+        example_html = self.read_output(example_path)
+        self.assertIn('<link href="../main.css">', example_html)
+        self.assertIn(f'<a href="../{another_path}">Another File</a>', example_html)
+        self.assertIn('<img src="../cat.png"', example_html)
+        self.assertIn(f'<a href="../{example_path}">Example File</a>', self.read_output(another_path))
+        index_html = self.read_output('index.html')
+        self.assertIn('<link href="main.css">', index_html)
+        self.assertIn(f'<a href="{example_path}">Example File</a>', index_html)
+        self.assertIn(f'https://example.com/{example_path}', self.read_output('sitemap.xml'))
+        self.assertTrue(os.path.isfile(os.path.join(self.test_output_folder, 'cat.png')))
+        self.assertFalse(os.path.isfile(os.path.join(self.test_output_folder, 'example-file.html')))
+
+    def test_folders(self):
+        test_config = {**self.test_config, 'output_layout': 'folders', 'graph': True}
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder, test_config)
+        example_html = self.read_output('example-file.html')
+        self.assertIn('<a href="big-docs/another-file.html">Another File</a>', example_html)
+        self.assertIn('<a href="wiki-stubs/missing.html">Missing</a>', example_html)
+        self.assertIn('<a href="../example-file.html">Example File</a>', self.read_output('big-docs/another-file.html'))
+        self.assertIn('<link href="../main.css">', self.read_output('wiki-stubs/missing.html'))
+        self.assertEqual(['big-docs/another-file.html', 'example-file.html', 'wiki-stubs/missing.html'],
+                         json.loads(self.read_output('graph.json'))['paths'])
+
+        # Moving a page rebuilds the pages linking to it
+        os.makedirs(os.path.join(self.test_input_folder, 'Other'))
+        os.rename(os.path.join(self.test_input_folder, 'Big Docs', 'another_test.md'),
+                  os.path.join(self.test_input_folder, 'Other', 'another_test.md'))
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder, test_config)
+        self.assertIn('<a href="other/another-file.html">Another File</a>', self.read_output('example-file.html'))
+        self.assertEqual([], swiki.explain_page(self.test_input_folder, self.test_output_folder, test_config,
+                                                'other/another-file.html'))
+
+    def test_delete_current_html(self):
+        swiki.make_wiki(self.test_input_folder, self.test_output_folder,
+                        {**self.test_config, 'output_layout': 'folders'})
+        swiki.delete_current_html(self.test_output_folder, 'folders')
+        self.assertFalse(os.path.isfile(os.path.join(self.test_output_folder, 'big-docs', 'another-file.html')))
+        self.assertTrue(os.path.isfile(os.path.join(self.test_output_folder, 'cat.png')))
+
+    def test_unknown_layout(self):
+        with self.assertRaises(RuntimeError):
+            swiki.make_wiki(self.test_input_folder, self.test_output_folder,
+                            {**self.test_config, 'output_layout': 'deep'})
+        self.assertEqual([], os.listdir(self.test_output_folder))
+
+
+@unittest.skipUnless(os.environ.get('SWIKI_PERF_TESTS'), 'set SWIKI_PERF_TESTS=1 to run performance tests')
+class PerformanceTestCase(unittest.TestCase):
+    """ Builds generated wikis to catch work that grows faster than the number of pages.
+    Timings are compared with each other rather than fixed times, so they hold on slow machines. """
+    page_counts = [1000, 2000, 4000, 8000]
+    # Steepest the build time may grow with the number of pages, as the slope of log time against log pages
+    # fitted over every size. Linear work gives 1, and builds measure about 0.85 as setup is shared by more
+    # pages. 1.2 lets time per page grow by half from 1000 to 8000 pages, far past the noise between runs, so
+    # it fails on work growing with the square of the number of pages once that outgrows the rest of the build.
+    scaling_slope = 1.2
+    scaling_runs = 3  # Builds timed at each size, taking the fastest
+    incremental_share = 0.6  # Most of a full build an incremental build with one page changed may take
+    cached_share = 0.5  # Same, when parsed pages and renders are cached from the last build
+    unchanged_share = 0.1  # Most of a full build checking that nothing changed may take
+    rebuild_runs = 3  # Rebuilds timed for each check, taking the fastest, as one can be slowed by the machine
+
+    def setUp(self):
+        self.test_path = make_test_directory()
+        # The fastest installed engine, so rendering doesn't hide the cost of everything else
+        engine = next(engine for engine in ('cmarkgfm', 'mistune', markdown.DEFAULT_ENGINE)
+                      if markdown.is_installed(engine))
+        self.test_settings = {'markdown_engine': engine, 'recent_list': True}
+
+    def tearDown(self):
+        shutil.rmtree(self.test_path)
+
+    def make_wiki(self, page_count: int, incremental: bool = False) -> tuple:
+        input_folder = bench.make_test_wiki(os.path.join(self.test_path, str(page_count)), page_count)
+        output_folder = os.path.join(self.test_path, str(page_count), 'output')
+        os.mkdir(output_folder)
+        return input_folder, output_folder, swiki.load_config(input_folder, {**self.test_settings,
+                                                                             'incremental': incremental})
+
+    def time_build(self, *args) -> float:
+        # CPU time of every thread, which waiting on the disk doesn't add to
+        start = time.process_time()
+        swiki.make_wiki(*args)
+        return time.process_time() - start
+
+    def time_rebuild(self, changed_fp: str, *args) -> float:
+        # Each run has an edit to rebuild, so none of them is skipped
+        times = []
+        for run in range(self.rebuild_runs):
+            touch(changed_fp, f'\nEdit {run}.\n')
+            times.append(self.time_build(*args))
+        return min(times)
+
+    def test_scaling(self):
+        times = dict()
+        for page_count in self.page_counts:
+            build = self.make_wiki(page_count)
+            # The fastest, which also leaves out the first build importing and setting up the Markdown engine
+            times[page_count] = min(self.time_build(*build) for _ in range(self.scaling_runs))
+        # Least squares fit of log time against log pages
+        points = [(math.log(page_count), math.log(seconds)) for page_count, seconds in times.items()]
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / sum((x - mean_x) ** 2 for x, _ in points)
+        self.assertLess(slope, self.scaling_slope, f'Seconds by wiki size: {times}')
+
+    def test_rebuilds(self):
+        input_folder, output_folder, config = self.make_wiki(self.page_counts[-1], incremental=True)
+        full_time = self.time_build(input_folder, output_folder, config)
+        changed_fp = os.path.join(input_folder, 'folder-0', 'page-0.md')
+
+        start = time.process_time()
+        fingerprint, unchanged = swiki.incremental_fingerprint(input_folder, output_folder, config)
+        self.assertFalse(unchanged)
+        swiki.record_fingerprint(output_folder, fingerprint)
+        self.assertTrue(swiki.incremental_fingerprint(input_folder, output_folder, config)[1])
+        self.assertLess((time.process_time() - start) / 2, full_time * self.unchanged_share)
+
+        incremental_time = self.time_rebuild(changed_fp, input_folder, output_folder, config)
+        self.assertLess(incremental_time, full_time * self.incremental_share)
+
+        cache = swiki.new_build_cache()
+        swiki.make_wiki(input_folder, output_folder, config, cache)
+        cached_time = self.time_rebuild(changed_fp, input_folder, output_folder, config, cache)
+        self.assertLess(cached_time, full_time * self.cached_share)
+
+
 if __name__ == '__main__':
     unittest.main()